@@ -0,0 +1,318 @@
+'''
+Benchmark suite for the trajectoid pipeline: rolling, spherical traces, mismatch and area computations, root finding,
+bridge construction, shape computation and tracking of the videos.
+
+All inputs are made by the path generators of existence-testing.py (and make_random_path()) with fixed seeds, so
+that the results of different commits are comparable. Every benchmark is run once for warm-up (numba compilation,
+caches) and then timed repeats times; the results are saved as JSON into results_dir, one file per run, named after
+the commit. If the previous results (of the latest run on another commit, or those given by --baseline) are found,
+the timings are compared and the regressions are flagged.
+
+Usage (from the repository root):
+    python benchmarks.py [--filter SUBSTRING] [--repeats N] [--threshold FRACTION] [--baseline FILE]
+    python benchmarks.py --compare OLD_RESULTS.json NEW_RESULTS.json
+Exits with nonzero status if there are regressions or failed benchmarks.
+'''
+import argparse
+import atexit
+import datetime
+import glob
+import importlib
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from functools import partial
+
+import numpy as np
+from skimage import io
+
+import compute_trajectoid as ct
+import trajectory_analysis
+
+existence_testing = importlib.import_module('existence-testing')
+
+RESULTS_DIR = 'benchmark_results'
+REGRESSION_THRESHOLD = 0.25
+MIN_SAMPLE_TIME = 0.05
+
+BENCHMARKS = dict()
+
+
+def benchmark(*params):
+    '''
+    Registers a benchmark for each of the params (or a single one if there are no params). The decorated function
+    takes the param and returns a function without arguments, which is timed. Everything before the return
+    is a setup and is not timed.
+    '''
+    def register(setup_function):
+        for param in params or (None,):
+            if param is None:
+                BENCHMARKS[setup_function.__name__] = setup_function
+            else:
+                BENCHMARKS[f'{setup_function.__name__}[{param}]'] = partial(setup_function, param)
+        return setup_function
+
+    return register
+
+
+def temporary_folder():
+    '''Temporary folder for the outputs of a benchmark, removed at exit'''
+    folder = tempfile.mkdtemp(prefix='trajectoid_benchmark_')
+    atexit.register(shutil.rmtree, folder, ignore_errors=True)
+    return folder
+
+
+def reference_path(path_type):
+    '''Single period of one of the reference paths of existence-testing.py, always the same.'''
+    if path_type == 'penannular':
+        return existence_testing.make_path(xlen=3.81, r=1.23, Npath=150, do_double=False)
+    elif path_type == 'random':
+        return ct.make_random_path(seed=0, make_ends_horizontal=False, start_from_zero=True, end_with_zero=True,
+                                   amplitude=3)
+    else:
+        return existence_testing.select_path_by_path_type(None, path_type)
+
+
+def brownian_path(npoints):
+    return existence_testing.make_brownian_path(Npath=npoints, seed=0, travel_length=0.1)
+
+
+@benchmark(100, 400, 1600)
+def rotation_to_origin(npoints):
+    path = brownian_path(npoints)
+    return partial(ct.rotation_to_origin, npoints - 1, path, use_cache=False, recursive=False)
+
+
+@benchmark(100, 400, 1600)
+def rotations_to_origin(npoints):
+    return partial(ct.rotations_to_origin, brownian_path(npoints))
+
+
+@benchmark(100, 400, 1600)
+def trace_on_sphere(npoints):
+    return partial(ct.trace_on_sphere, brownian_path(npoints), kx=1, ky=1)
+
+
+@benchmark('brownian', 'spiral', 'zigzag', 'penannular')
+def mismatch_angle_for_path(path_type):
+    # doubled without sorting by x, as in test_trajectoid_existence(): sorting the spiral by x breaks it
+    return partial(ct.mismatch_angle_for_path, existence_testing.double_the_path_nosort(reference_path(path_type)))
+
+
+@benchmark('adaptive', 'uniform')
+def gb_areas_for_all_scales(sampling):
+    return partial(ct.gb_areas_for_all_scales, reference_path('brownian'), minscale=0.01, maxscale=2, nframes=30,
+                   adaptive_sampling=(sampling == 'adaptive'), verbose=False)
+
+
+@benchmark('random', 'penannular')
+def minimize_mismatch_by_scaling(path_type):
+    # scale ranges are the ones of random_doubled-1.py and penannular.py
+    scale_range = {'random': (0.5, 0.7), 'penannular': (0.9, 1.1)}[path_type]
+    return partial(ct.minimize_mismatch_by_scaling, ct.double_the_path(reference_path(path_type), lazy=True),
+                   scale_range=scale_range)
+
+
+@benchmark()
+def find_best_smooth_bridge():
+    return partial(ct.find_best_smooth_bridge, reference_path('random'), npoints=30, do_plot=False)
+
+
+@benchmark('brownian', 'spiral')
+def path_from_trace(path_type):
+    return partial(ct.path_from_trace, ct.trace_on_sphere(reference_path(path_type), kx=1, ky=1))
+
+
+@benchmark('brownian', 'spiral', 'zigzag', 'penannular')
+def spherical_trace_is_self_intersecting(path_type):
+    return partial(ct.spherical_trace_is_self_intersecting, ct.trace_on_sphere(reference_path(path_type), kx=1, ky=1))
+
+
+@benchmark('transforms_npy', 'merged_stl')
+def compute_shape(export_mode):
+    # best scale of random_doubled-1.py
+    input_path = 0.6387022944333781 * np.asarray(ct.double_the_path(reference_path('random')))
+    target_folder = temporary_folder()
+
+    def run():
+        ct.compute_shape(input_path, kx=1, ky=1, folder_for_path=target_folder, folder_for_meshes=target_folder,
+                         export_mode=export_mode)
+
+    return run
+
+
+def make_synthetic_video(target_folder, nframes=64, frame_shape=(240, 320), object_radius=12, seed=0):
+    '''Frames of a disk rolling along a sine over a noisy background, saved like the frames of the experiments.'''
+    rng = np.random.default_rng(seed)
+    os.makedirs(target_folder + '/frames', exist_ok=True)
+    rows, columns = np.ogrid[:frame_shape[0], :frame_shape[1]]
+    background = np.empty(shape=frame_shape + (3,), dtype=float)
+    background[:] = (100, 150, 100)
+    for frame_id in range(nframes):
+        x = object_radius * 2 + (frame_shape[1] - object_radius * 4) * frame_id / (nframes - 1)
+        y = frame_shape[0] / 2 + frame_shape[0] / 4 * np.sin(2 * np.pi * frame_id / nframes)
+        frame = background + rng.normal(scale=3, size=background.shape)
+        frame[(rows - y) ** 2 + (columns - x) ** 2 <= object_radius ** 2] = (200, 50, 200)
+        io.imsave(trajectory_analysis.frame_filename(target_folder, frame_id),
+                  np.clip(frame, 0, 255).astype(np.uint8))
+
+
+@benchmark('full_frame', 'roi')
+def track_video_frames(mode):
+    target_folder = temporary_folder()
+    make_synthetic_video(target_folder)
+    return partial(trajectory_analysis.trace_trajectory_from_video_frames, target_folder, processes=1,
+                   do_annotated_frames=False, roi_mode=('constant_velocity' if mode == 'roi' else None))
+
+
+def time_benchmark(setup_function, repeats=5, min_sample_time=MIN_SAMPLE_TIME):
+    '''
+    Times a registered benchmark. Fast functions are called several times per sample so that every sample takes
+    at least min_sample_time.
+
+    :return: Dictionary with median and minimum time per call, all the samples and the number of calls per sample
+    '''
+    function = setup_function()
+    t0 = time.perf_counter()
+    function()
+    warmup_time = time.perf_counter() - t0
+    number = int(min(1000, max(1, np.ceil(min_sample_time / max(warmup_time, 1e-9)))))
+    samples = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        for _ in range(number):
+            function()
+        samples.append((time.perf_counter() - t0) / number)
+    return {'median': float(np.median(samples)), 'min': float(np.min(samples)), 'samples': samples, 'number': number}
+
+
+def current_commit():
+    '''Hash of the current commit and whether the working tree has uncommitted changes (None if not in git)'''
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], check=True, capture_output=True, text=True).stdout
+        status = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], check=True,
+                                capture_output=True, text=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit.strip(), bool(status.strip())
+
+
+def run_benchmarks(name_filter='', repeats=5):
+    '''
+    Runs the registered benchmarks whose names contain name_filter and returns the results with metadata.
+    If a benchmark raises, its result is {'failed': True, 'error': repr of the exception} and the others still run.
+    '''
+    commit, is_dirty = current_commit()
+    results = dict()
+    for benchmark_id, setup_function in BENCHMARKS.items():
+        if name_filter not in benchmark_id:
+            continue
+        try:
+            results[benchmark_id] = time_benchmark(setup_function, repeats=repeats)
+        except Exception as error:
+            # a broken benchmark is recorded and does not stop the others
+            logging.exception(f'Benchmark {benchmark_id} failed')
+            results[benchmark_id] = {'failed': True, 'error': repr(error)}
+            print(f'{benchmark_id:<55} {"FAILED":>12}', flush=True)
+            continue
+        print(f'{benchmark_id:<55} {results[benchmark_id]["median"]:10.4f} s', flush=True)
+    return {'commit': commit,
+            'dirty': is_dirty,
+            'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'machine': platform.platform(),
+            'processor': platform.processor(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'repeats': repeats,
+            'results': results}
+
+
+def save_results(run, results_dir=RESULTS_DIR):
+    os.makedirs(results_dir, exist_ok=True)
+    commit_label = (run['commit'] or 'nocommit')[:10] + ('-dirty' if run['dirty'] else '')
+    filename = os.path.join(results_dir, f'{run["date"].replace(":", "")}_{commit_label}.json')
+    with open(filename, 'w') as f:
+        json.dump(run, f, indent=1)
+    return filename
+
+
+def latest_results_of_other_commit(commit, results_dir=RESULTS_DIR):
+    '''Filename of the latest saved results of a commit different from the given one, or None'''
+    for filename in sorted(glob.glob(os.path.join(results_dir, '*.json')), reverse=True):
+        with open(filename) as f:
+            if json.load(f)['commit'] != commit:
+                return filename
+    return None
+
+
+def compare_results(old_run, new_run, threshold=REGRESSION_THRESHOLD):
+    '''
+    Compares the median timings of two runs and prints them. A benchmark has regressed if its median time grew
+    by more than the threshold fraction and by more than the spread of the old samples.
+
+    Failed benchmarks are printed and not compared.
+
+    :return: List of the ids of regressed benchmarks
+    '''
+    print(f'Comparing {(old_run["commit"] or "?")[:10]} ({old_run["date"]}) '
+          f'-> {(new_run["commit"] or "?")[:10]} ({new_run["date"]})')
+    regressions = []
+    for benchmark_id, new_result in new_run['results'].items():
+        old_result = old_run['results'].get(benchmark_id)
+        if new_result.get('failed'):
+            print(f'{benchmark_id:<55} FAILED: {new_result["error"]}')
+            continue
+        if old_result is None or old_result.get('failed'):
+            continue
+        ratio = new_result['median'] / old_result['median']
+        old_spread = np.max(old_result['samples']) - np.min(old_result['samples'])
+        if ratio > 1 + threshold and new_result['median'] - old_result['median'] > old_spread:
+            flag = 'REGRESSION'
+            regressions.append(benchmark_id)
+        elif ratio < 1 / (1 + threshold):
+            flag = 'faster'
+        else:
+            flag = ''
+        print(f'{benchmark_id:<55} {old_result["median"]:10.4f} s {new_result["median"]:10.4f} s '
+              f'{ratio:6.2f}x  {flag}')
+    return regressions
+
+
+def load_results(filename):
+    with open(filename) as f:
+        return json.load(f)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the benchmarks of the trajectoid pipeline.')
+    parser.add_argument('--filter', default='', help='Run only the benchmarks whose names contain this substring')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD,
+                        help='Relative slowdown flagged as a regression')
+    parser.add_argument('--results-dir', default=RESULTS_DIR)
+    parser.add_argument('--baseline', default=None,
+                        help='Results to compare with. By default, the latest results of another commit')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), default=None,
+                        help='Only compare two saved results')
+    args = parser.parse_args()
+
+    if args.compare:
+        regressions = compare_results(load_results(args.compare[0]), load_results(args.compare[1]),
+                                      threshold=args.threshold)
+    else:
+        logging.disable(logging.INFO)
+        new_run = run_benchmarks(name_filter=args.filter, repeats=args.repeats)
+        print(f'Results saved to {save_results(new_run, results_dir=args.results_dir)}')
+        baseline = args.baseline or latest_results_of_other_commit(new_run['commit'], results_dir=args.results_dir)
+        regressions = compare_results(load_results(baseline), new_run, threshold=args.threshold) if baseline else []
+        failures = [benchmark_id for benchmark_id, result in new_run['results'].items() if result.get('failed')]
+        if failures:
+            print(f'Failed benchmarks: {", ".join(failures)}')
+            regressions += failures
+    sys.exit(1 if regressions else 0)
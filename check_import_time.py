@@ -0,0 +1,71 @@
+'''
+Checks the import time of the compute-only modules against a budget.
+
+Each module is imported in a fresh interpreter (so nothing is cached in sys.modules) several times, and the median
+wall time of the import is compared to the budget. It is also checked that importing for computations alone does not
+pull in the plotting backends or the optional dependencies, which are loaded lazily on first use
+(see LazyModule in compute_trajectoid.py).
+
+Usage (from the repository root):
+    python check_import_time.py [--budget SECONDS] [--repeats N] [module ...]
+Exits with nonzero status if the budget is exceeded or if a heavy module was imported.
+'''
+import argparse
+import json
+import subprocess
+import sys
+
+import numpy as np
+
+IMPORT_TIME_BUDGET_SECONDS = 1.5
+COMPUTE_ONLY_MODULES = ('compute_trajectoid', 'trajectory_comparison')
+LAZILY_IMPORTED_MODULES = ('mayavi', 'plotly', 'matplotlib', 'skimage', 'sklearn')
+
+_MEASURING_CODE = '''
+import json, sys, time
+t0 = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - t0
+print(json.dumps({{'seconds': seconds,
+                  'heavy_modules': [m for m in {heavy_modules!r} if m in sys.modules]}}))
+'''
+
+
+def measure_import_time(module, repeats=5):
+    '''
+    Imports the module in a fresh interpreter, repeats times.
+
+    :return: Median import time in seconds, sorted list of heavy modules that got imported along with the module
+    '''
+    times = []
+    heavy_modules = set()
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, '-c',
+                                 _MEASURING_CODE.format(module=module, heavy_modules=LAZILY_IMPORTED_MODULES)],
+                                check=True, capture_output=True, text=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        times.append(result['seconds'])
+        heavy_modules.update(result['heavy_modules'])
+    return float(np.median(times)), sorted(heavy_modules)
+
+
+def check_import_time(modules=COMPUTE_ONLY_MODULES, budget=IMPORT_TIME_BUDGET_SECONDS, repeats=5):
+    '''Prints import time of each module and returns True if all of them are within budget and import nothing heavy.'''
+    all_good = True
+    for module in modules:
+        seconds, heavy_modules = measure_import_time(module, repeats=repeats)
+        is_good = (seconds <= budget) and not heavy_modules
+        all_good = all_good and is_good
+        print(f'{module}: {seconds:.3f} s (budget {budget:.3f} s)'
+              + (f', imported {", ".join(heavy_modules)}' if heavy_modules else '')
+              + ('' if is_good else '  <-- FAILED'))
+    return all_good
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check import time of compute-only modules against a budget.')
+    parser.add_argument('modules', nargs='*', default=list(COMPUTE_ONLY_MODULES))
+    parser.add_argument('--budget', type=float, default=IMPORT_TIME_BUDGET_SECONDS)
+    parser.add_argument('--repeats', type=int, default=5)
+    args = parser.parse_args()
+    sys.exit(0 if check_import_time(args.modules, budget=args.budget, repeats=args.repeats) else 1)
@@ -2,24 +2,50 @@ import numpy as np
 from numpy.linalg import norm as lnorm
 import trimesh
 import time
-import matplotlib.pyplot as plt
-from matplotlib.collections import LineCollection
-from skimage import io
 from math import atan2
 from scipy.optimize import fsolve, brentq, minimize
 from scipy import interpolate
-from sklearn.metrics import pairwise_distances
 from numba import jit
-from scipy.signal import savgol_filter
-from functools import lru_cache
+from scipy.spatial import HalfspaceIntersection, cKDTree
+from functools import lru_cache, reduce, partial
 from tqdm import tqdm
+import importlib
 import logging
 import sys
+import os
+import json
+import itertools
+import multiprocessing
+import instrumentation
 
-sys.setrecursionlimit(3000)
 
-logging.basicConfig(level=logging.INFO)
-# logging.basicConfig(level=logging.DEBUG)
+class LazyModule:
+    '''
+    Stand-in for a module that is imported only at the first access to its attributes. Used for the plotting
+    backends and for the optional dependencies (skimage, sklearn), so that importing this module for computations
+    alone (for instance, in worker processes) is fast and does not require VTK or a display.
+    '''
+    def __init__(self, module_name):
+        self._module_name = module_name
+        self._module = None
+
+    def __getattr__(self, name):
+        if self._module is None:
+            self._module = importlib.import_module(self._module_name)
+        return getattr(self._module, name)
+
+    def __repr__(self):
+        return f'<lazily imported module {self._module_name!r}>'
+
+
+plt = LazyModule('matplotlib.pyplot')
+mcollections = LazyModule('matplotlib.collections')
+io = LazyModule('skimage.io')
+skimage_measure = LazyModule('skimage.measure')
+sklearn_metrics = LazyModule('sklearn.metrics')
+scipy_signal = LazyModule('scipy.signal')
+
+# Logging is configured by the scripts using this module, e.g. by logging.basicConfig(level=logging.INFO)
 
 # from great_circle_arc import intersects\
 
@@ -27,26 +53,21 @@ USED_3D_PLOTTING_PACKAGE = 'mayavi'
 
 # USED_3D_PLOTTING_PACKAGE = 'plotly'
 
-# if USED_3D_PLOTTING_PACKAGE == 'mayavi':
-#     from mayavi import mlab
-# elif USED_3D_PLOTTING_PACKAGE == 'plotly':
-#     import plotly.express as px
-
-from mayavi import mlab
-import plotly.graph_objects as go
+mlab = LazyModule('mayavi.mlab')
+go = LazyModule('plotly.graph_objects')
 
 last_path = np.array([0, 0])
 cached_rotations_to_origin = dict()
 
 
-@jit(nopython=True)
+@jit(nopython=True, cache=True)
 def numbacross(a, b):
     return [a[1] * b[2] - b[1] * a[2],
             -a[0] * b[2] + b[0] * a[2],
             a[0] * b[1] - b[0] * a[1]]
 
 
-@jit(nopython=True)
+@jit(nopython=True, cache=True)
 def numbadotsign(a, b):
     x = a[0] * b[0] + a[1] * b[1] + a[2] * b[2]
     if x > 0:
@@ -58,7 +79,7 @@ def numbadotsign(a, b):
     return r
 
 
-@jit(nopython=True)
+@jit(nopython=True, cache=True)
 def intersects(A, B, C, D):
     ABX = numbacross(A, B)
     CDX = numbacross(C, D)
@@ -73,7 +94,7 @@ def intersects(A, B, C, D):
 
 def sort_path(arr2D):
     columnIndex = 0
-    return arr2D[arr2D[:, columnIndex].argsort()]
+    return arr2D[arr2D[:, columnIndex].argsort(kind='stable')]
 
 
 def split_by_mask(signal, input_mask):
@@ -93,6 +114,7 @@ def better_mayavi_lights(fig):
         camera_light0.activate = True
 
 
+@instrumentation.instrumented('plotting')
 def make_orbit_animation(folder_for_frames, nframes=60, elevation=60):
     mlab.view(elevation=elevation)
     for frame_id, azimuth in enumerate(np.linspace(0, 359, nframes)):
@@ -104,6 +126,54 @@ def make_orbit_animation(folder_for_frames, nframes=60, elevation=60):
         mlab.savefig(f'{folder_for_frames}/{frame_id:08d}.png')
 
 
+class SphereTraceScene:
+    '''
+    Offscreen mayavi scene with the sphere (see plot_sphere()), one trace on it colored by trace_scalars and
+    spherical markers of marker_colors. The scene is built once; every frame only updates the coordinates of
+    the trace and of the markers (update()) before taking a screenshot(), so long animations do not rebuild
+    the sphere and the tubes for every frame. The number of trace points must stay the same.
+    '''
+
+    def __init__(self, initial_trace, trace_scalars, marker_colors=(), marker_radius=0.1, sphere_opacity=.8,
+                 size=(1024, 1024), zoom=1.7, core_radius=1, tube_radius=0.01):
+        mlab.options.offscreen = True
+        self.figure = mlab.figure(size=size, bgcolor=(1, 1, 1), fgcolor=(0.5, 0.5, 0.5))
+        plot_sphere(r0=core_radius - tube_radius, line_radius=tube_radius / 4, sphere_opacity=sphere_opacity)
+        self.trace = mlab.plot3d(initial_trace[:, 0], initial_trace[:, 1], initial_trace[:, 2], trace_scalars,
+                                 colormap='viridis', tube_radius=tube_radius)
+        self.markers = [mlab.points3d(0, 0, 0, scale_factor=marker_radius, color=color) for color in marker_colors]
+        self.figure.scene.camera.zoom(zoom)
+
+    def update(self, trace, marker_positions=()):
+        self.trace.mlab_source.set(x=trace[:, 0], y=trace[:, 1], z=trace[:, 2])
+        for marker, position in zip(self.markers, marker_positions):
+            marker.mlab_source.set(x=[position[0]], y=[position[1]], z=[position[2]])
+
+    def screenshot(self):
+        return mlab.screenshot(figure=self.figure, mode='rgba', antialiased=True)
+
+    def close(self):
+        mlab.close(self.figure)
+
+
+def render_frames_in_parallel(render_frame_range, frame_ids, processes=1):
+    '''
+    Splits frame_ids into contiguous ranges, one per process, and calls render_frame_range(list_of_frame_ids) for
+    each range in a pool of processes (in this process if processes == 1). Every range builds its scenes once
+    and renders its frames one after another, so render_frame_range must be picklable (for example,
+    a module-level function wrapped in functools.partial).
+    '''
+    frame_ids = list(frame_ids)
+    if processes == 1:
+        render_frame_range(frame_ids)
+        return
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    frame_ranges = [list(frame_range) for frame_range in np.array_split(frame_ids, processes) if len(frame_range)]
+    with multiprocessing.Pool(processes=processes) as pool:
+        pool.map(render_frame_range, frame_ranges)
+
+
 def signed_angle_between_2d_vectors(vector1, vector2):
     """Calculate the signed angle between two 2-dimensional vectors using the atan2 formula.
     The angle is positive if rotation from vector1 to vector2 is counterclockwise, and negative
@@ -152,6 +222,7 @@ def rotate_3d_vector(input_vector, axis_of_rotation, angle):
     return np.array(point1_trimesh.vertices[0])
 
 
+@instrumentation.instrumented('geometry')
 def spherical_trace_is_self_intersecting(sphere_trace):
     # t0 = time.time()
     arcs = [[sphere_trace[i], sphere_trace[i + 1]] for i in range(sphere_trace.shape[0] - 1)]
@@ -163,7 +234,7 @@ def spherical_trace_is_self_intersecting(sphere_trace):
             else:
                 if intersects(arcs[i][0], arcs[i][1], arcs[j][0], arcs[j][1]):
                     intersection_detected = True
-                    print(f'self-intersection at i={i}, j={j}')
+                    logging.debug('self-intersection at i=%d, j=%d', i, j)
                     break
         if intersection_detected:
             break
@@ -171,15 +242,91 @@ def spherical_trace_is_self_intersecting(sphere_trace):
     return intersection_detected
 
 
-def get_trajectory_from_raster_image(filename, do_plotting=True):
-    image = io.imread(filename)[:, :, 0]
-    trajectory_points = np.zeros(shape=(image.shape[0], 2))
-    for i in range(image.shape[0]):
-        trajectory_points[i, 0] = i / image.shape[0] * 2 * np.pi  # assume that x dimension of path is 2*pi
-        trajectory_points[i, 1] = np.argmin(image[i, :]) / image.shape[1] * np.pi - np.pi / 2
+def load_raster_image(filename):
+    '''Image as an array. Arrays (including np.memmap) are used as they are, and .npy files are memory-mapped,
+    so that very large scans are never loaded into memory as a whole.'''
+    if isinstance(filename, np.ndarray):
+        return filename
+    if filename.endswith('.npy'):
+        return np.load(filename, mmap_mode='r')
+    return io.imread(filename)
+
+
+def extract_raster_path(image, axis=1, method='argmin', white_level=255, tile_size=4096):
+    '''
+    Finds the dark line drawn on the image: for every line of pixels (rows for axis=1, columns for axis=0) finds the
+    subpixel position of the line along this axis. The drawing must therefore be a function of the line index.
+    The image is processed in tiles of tile_size lines, all lines of a tile at once.
+
+    :param image: Array of shape (H, W) or (H, W, channels), for example a memory map. Only the first channel is used.
+    :param method: String. "argmin" takes the darkest pixel and refines its position by a parabola through it and
+                   its two neighbours. "centroid" takes the centroid of darkness (white_level minus intensity).
+                   "mean" takes the unweighted mean position of the pixels darker than white_level.
+    :param white_level: Lines without pixels darker than this are skipped.
+    :return: Tuple of indices of the lines that contain the drawing and the positions of the drawing in them
+    '''
+    number_of_lines = image.shape[1 - axis]
+    line_indices = []
+    positions = []
+    for tile_start in range(0, number_of_lines, tile_size):
+        if axis == 1:
+            tile = np.asarray(image[tile_start:tile_start + tile_size])
+        else:
+            tile = np.swapaxes(np.asarray(image[:, tile_start:tile_start + tile_size]), 0, 1)
+        if tile.ndim == 3:
+            tile = tile[:, :, 0]
+        tile = tile.astype(np.float32)
+        has_drawing = np.min(tile, axis=1) < white_level
+        if method == 'argmin':
+            darkest = np.argmin(tile, axis=1)
+            rows = np.arange(tile.shape[0])
+            left = tile[rows, np.maximum(darkest - 1, 0)]
+            center = tile[rows, darkest]
+            right = tile[rows, np.minimum(darkest + 1, tile.shape[1] - 1)]
+            curvatures = left - 2 * center + right
+            shifts = np.where(curvatures > 0, 0.5 * (left - right) / np.where(curvatures > 0, curvatures, 1), 0)
+            tile_positions = darkest + np.clip(shifts, -0.5, 0.5)
+        elif method == 'centroid':
+            darkness = np.clip(white_level - tile, 0, None)
+            tile_positions = darkness @ np.arange(tile.shape[1], dtype=np.float32) / \
+                             np.maximum(np.sum(darkness, axis=1), 1e-12)
+        elif method == 'mean':
+            is_dark = (tile < white_level).astype(np.float32)
+            tile_positions = is_dark @ np.arange(tile.shape[1], dtype=np.float32) / \
+                             np.maximum(np.sum(is_dark, axis=1), 1)
+        else:
+            raise ValueError(f'Unknown method: {method}')
+        line_indices.append(tile_start + np.flatnonzero(has_drawing))
+        positions.append(tile_positions[has_drawing])
+    return np.concatenate(line_indices), np.concatenate(positions).astype(float)
+
+
+def resample_by_arc_length(input_path, npoints):
+    '''Resamples the path to npoints spaced uniformly along its length'''
+    length_along_the_path = np.insert(np.cumsum(np.linalg.norm(np.diff(input_path, axis=0), axis=1)), 0, 0)
+    new_lengths = np.linspace(0, length_along_the_path[-1], npoints)
+    return np.stack([np.interp(new_lengths, length_along_the_path, input_path[:, k])
+                     for k in range(input_path.shape[1])]).T
+
+
+def get_trajectory_from_raster_image(filename, do_plotting=True, resample_to=None, tile_size=4096):
+    '''
+    Path drawn as a dark line on the image, one point per row of pixels (see extract_raster_path()).
+    Rows without the drawing are skipped. The path is then resampled uniformly along its length.
+
+    :param filename: Image file, .npy file (which is memory-mapped) or array
+    :param resample_to: Integer or None. Number of points of the path; if None, one point per five rows.
+    '''
+    image = load_raster_image(filename)
+    row_indices, positions = extract_raster_path(image, axis=1, method='argmin', tile_size=tile_size)
+    trajectory_points = np.zeros(shape=(row_indices.shape[0], 2))
+    trajectory_points[:, 0] = row_indices / image.shape[0] * 2 * np.pi  # assume that x dimension of path is 2*pi
+    trajectory_points[:, 1] = positions / image.shape[1] * np.pi - np.pi / 2
     trajectory_points[:, 1] -= trajectory_points[0, 1]  # make path relative to first point
-    trajectory_points = trajectory_points[::5, :]  # decimation by a factor 5
-    print('Decimated to {0} elements'.format(trajectory_points.shape[0]))
+    if resample_to is None:
+        resample_to = int(np.ceil(row_indices.shape[0] / 5))
+    trajectory_points = resample_by_arc_length(trajectory_points, resample_to)
+    print('Resampled to {0} elements'.format(trajectory_points.shape[0]))
     if do_plotting:
         print(trajectory_points[0, 1])
         print(trajectory_points[0, 1] - trajectory_points[-1, 1])
@@ -189,6 +336,181 @@ def get_trajectory_from_raster_image(filename, do_plotting=True):
     return trajectory_points
 
 
+PATH_FILE_MAGIC = b'TRJPATH1'
+PATH_FILE_HEADER_SIZE = 256
+
+
+def _header_bytes(header):
+    header_bytes = PATH_FILE_MAGIC + json.dumps(header).encode('utf-8')
+    if len(header_bytes) > PATH_FILE_HEADER_SIZE - 1:
+        raise ValueError('Path file header is too long')
+    return header_bytes + b' ' * (PATH_FILE_HEADER_SIZE - 1 - len(header_bytes)) + b'\n'
+
+
+def save_path_binary(filename, path, units='radians', normalization='none', scale=1):
+    '''
+    Saves the path into compact binary path file (.trj): a header of PATH_FILE_HEADER_SIZE bytes starting with
+    PATH_FILE_MAGIC and holding a JSON dictionary (number of points, units, normalization, scale), followed by
+    the points as little-endian float64 pairs.
+
+    :param path: Array of shape (N, 2) or an iterable of such arrays (chunks), which are written one by one
+    :return: Header dictionary
+    '''
+    header = {'npoints': 0, 'units': units, 'normalization': normalization, 'scale': scale}
+    chunks = [path] if isinstance(path, np.ndarray) else path
+    with open(filename, 'wb') as f:
+        f.write(_header_bytes(header))
+        for chunk in chunks:
+            chunk = np.ascontiguousarray(chunk, dtype='<f8').reshape(-1, 2)
+            f.write(chunk.tobytes())
+            header['npoints'] += chunk.shape[0]
+        f.seek(0)
+        f.write(_header_bytes(header))
+    return header
+
+
+def read_path_header(filename):
+    with open(filename, 'rb') as f:
+        header_bytes = f.read(PATH_FILE_HEADER_SIZE)
+    if not header_bytes.startswith(PATH_FILE_MAGIC):
+        raise ValueError(f'{filename} is not a binary path file')
+    return json.loads(header_bytes[len(PATH_FILE_MAGIC):].decode('utf-8'))
+
+
+def _is_number_line(line, delimiter):
+    fields = line.split(delimiter)
+    try:
+        float(fields[0])
+    except (ValueError, IndexError):
+        return False
+    return True
+
+
+def _iter_text_column_chunks(filename, chunk_size, delimiter=',', usecols=None):
+    '''Columns of the text file as arrays of at most chunk_size rows. Lines at the top of the file that do not start
+    with a number (header with column names, blank lines) are skipped.'''
+    with open(filename, 'r') as f:
+        lines = itertools.dropwhile(lambda line: not _is_number_line(line, delimiter), f)
+        while True:
+            chunk_lines = list(itertools.islice(lines, chunk_size))
+            if not chunk_lines:
+                return
+            chunk = np.loadtxt(chunk_lines, delimiter=delimiter, usecols=usecols, ndmin=2)
+            if chunk.shape[0] > 0:
+                yield chunk
+
+
+def _mapped_path(filename):
+    if isinstance(filename, np.ndarray):
+        return filename
+    if filename.endswith('.npy'):
+        return np.load(filename, mmap_mode='r')
+    if filename.endswith('.trj'):
+        header = read_path_header(filename)
+        return np.memmap(filename, dtype='<f8', mode='r', offset=PATH_FILE_HEADER_SIZE,
+                         shape=(header['npoints'], 2))
+    return None
+
+
+def iter_path_chunks(filename, chunk_size=65536, delimiter=','):
+    '''
+    Reads the path by chunks of at most chunk_size points, so that the whole file is never loaded into memory.
+
+    :param filename: Array, .npy file or binary path file (.trj) -- these are memory-mapped; any other file is
+                     read as text with columns x and y separated by delimiter (e.g. CSV). A tuple of two text files
+                     is read as separate x and y columns, as saved by trace_trajectory_from_video_frames().
+    :return: Generator of arrays of shape (n, 2)
+    '''
+    if isinstance(filename, tuple):
+        x_chunks = _iter_text_column_chunks(filename[0], chunk_size, delimiter=None)
+        y_chunks = _iter_text_column_chunks(filename[1], chunk_size, delimiter=None)
+        for x_chunk, y_chunk in zip(x_chunks, y_chunks):
+            yield np.hstack((x_chunk[:, :1], y_chunk[:, :1]))
+        return
+    mapped_path = _mapped_path(filename)
+    if mapped_path is None:
+        yield from _iter_text_column_chunks(filename, chunk_size, delimiter=delimiter, usecols=(0, 1))
+        return
+    for chunk_start in range(0, mapped_path.shape[0], chunk_size):
+        yield np.array(mapped_path[chunk_start:chunk_start + chunk_size], dtype=float)
+
+
+def path_end_points(filename, chunk_size=65536, delimiter=','):
+    '''First and last points of the path. Only text files have to be read through (by chunks) to find them.'''
+    mapped_path = None if isinstance(filename, tuple) else _mapped_path(filename)
+    if mapped_path is not None:
+        return np.array(mapped_path[0], dtype=float), np.array(mapped_path[-1], dtype=float)
+    first_point = None
+    for chunk in iter_path_chunks(filename, chunk_size=chunk_size, delimiter=delimiter):
+        if first_point is None:
+            first_point = chunk[0]
+        last_point = chunk[-1]
+    return first_point, last_point
+
+
+def iter_normalized_path_chunks(filename, start_from_zero=True, end_with_zero=True, chunk_size=65536,
+                                delimiter=','):
+    '''
+    Same as iter_path_chunks(), but every chunk is normalized on the fly: if start_from_zero, the path is shifted
+    so that it starts at the origin; if end_with_zero, the linear trend is subtracted from y so that the
+    path ends at the same y where it starts (as in make_random_path()).
+    '''
+    first_point, last_point = path_end_points(filename, chunk_size=chunk_size, delimiter=delimiter)
+    slope = (last_point[1] - first_point[1]) / (last_point[0] - first_point[0])
+    for chunk in iter_path_chunks(filename, chunk_size=chunk_size, delimiter=delimiter):
+        if end_with_zero:
+            chunk[:, 1] -= (chunk[:, 0] - first_point[0]) * slope
+        if start_from_zero:
+            chunk -= first_point
+        yield chunk
+
+
+def load_path(filename, start_from_zero=False, end_with_zero=False, chunk_size=65536, delimiter=','):
+    '''
+    Loads the path from any file understood by iter_path_chunks(). Without normalization, .npy and .trj files
+    are returned as read-only memory maps; otherwise the (normalized) chunks are collected into an array.
+    '''
+    if not (start_from_zero or end_with_zero) and not isinstance(filename, tuple):
+        mapped_path = _mapped_path(filename)
+        if mapped_path is not None:
+            return mapped_path
+    return np.concatenate(list(iter_normalized_path_chunks(filename, start_from_zero=start_from_zero,
+                                                           end_with_zero=end_with_zero, chunk_size=chunk_size,
+                                                           delimiter=delimiter)))
+
+
+def convert_path_file(source, destination, start_from_zero=True, end_with_zero=True, chunk_size=65536,
+                      units='radians', scale=1, delimiter=','):
+    '''Streams the path from source (any file understood by iter_path_chunks()) into the binary path file,
+    normalizing it on the way. Returns the header of the new file.'''
+    normalization = [name for name, flag in (('start_from_zero', start_from_zero), ('end_with_zero', end_with_zero))
+                     if flag]
+    chunks = iter_normalized_path_chunks(source, start_from_zero=start_from_zero, end_with_zero=end_with_zero,
+                                         chunk_size=chunk_size, delimiter=delimiter)
+    return save_path_binary(destination, chunks, units=units, normalization='+'.join(normalization) or 'none',
+                            scale=scale)
+
+
+def net_rotation_for_path_chunks(chunks, kx=1, ky=1):
+    '''
+    Net rotation of the sphere after rolling along the path given by chunks (for example,
+    from iter_path_chunks()), as 4x4 matrix equal to rotation_to_origin(N - 1, path) for the whole path scaled by
+    kx and ky. Only one chunk is in memory at a time.
+    '''
+    net_rotation_matrix = np.eye(3)
+    previous_point = None
+    for chunk in chunks:
+        chunk = chunk * np.array([kx, ky])
+        if previous_point is not None:
+            chunk = np.vstack((previous_point, chunk))
+        if chunk.shape[0] > 1:
+            net_rotation_matrix = reduce(np.matmul, rotations_for_steps(chunk[:-1] - chunk[1:]), net_rotation_matrix)
+        previous_point = chunk[-1]
+    result = trimesh.transformations.identity_matrix()
+    result[:3, :3] = net_rotation_matrix
+    return result
+
+
 def rotation_from_point_to_point(point, previous_point):
     vector_to_previous_point = previous_point - point
     axis_of_rotation = [vector_to_previous_point[1], -vector_to_previous_point[0], 0]
@@ -213,7 +535,9 @@ def rotation_to_origin(index_in_trajectory, data, use_cache=True, recursive=True
         if data.shape == last_path.shape:
             if np.isclose(data, last_path).all():
                 if index_in_trajectory in cached_rotations_to_origin.keys():
+                    instrumentation.count('rotation_cache_hits')
                     return cached_rotations_to_origin[index_in_trajectory]
+        instrumentation.count('rotation_cache_misses')
 
     if not recursive:
         theta_sum = 0
@@ -233,6 +557,9 @@ def rotation_to_origin(index_in_trajectory, data, use_cache=True, recursive=True
         if index_in_trajectory == 0:
             net_rotation_matrix = trimesh.transformations.identity_matrix()
         else:
+            # recursion goes as deep as the path is long
+            if sys.getrecursionlimit() < 3000:
+                sys.setrecursionlimit(3000)
             net_rotation_matrix, theta = rotation_to_previous_point(index_in_trajectory, data)
             net_rotation_matrix = trimesh.transformations.concatenate_matrices(
                 rotation_to_origin(index_in_trajectory - 1,
@@ -245,7 +572,7 @@ def rotation_to_origin(index_in_trajectory, data, use_cache=True, recursive=True
             if np.isclose(data, last_path).all():
                 cache_have_same_path = True
                 cached_rotations_to_origin[index_in_trajectory] = net_rotation_matrix
-                logging.debug(f'Updated cache, index_in_trajectory = {index_in_trajectory}')
+                logging.debug('Updated cache, index_in_trajectory = %d', index_in_trajectory)
         if not cache_have_same_path:
             # clear cache
             logging.debug('Clearing cache.')
@@ -256,62 +583,922 @@ def rotation_to_origin(index_in_trajectory, data, use_cache=True, recursive=True
     return net_rotation_matrix
 
 
+def rotations_for_steps(steps):
+    '''Rotations of the rolling sphere for steps of shape (N, 2), each from a point to the previous point
+    (as in rotation_from_point_to_point()), built at once by Rodrigues formula. Returns array of shape (N, 3, 3).'''
+    thetas = np.linalg.norm(steps, axis=1)
+    # axis of rotation for each step is [dy, -dx, 0], normalized. Zero-length steps give identity.
+    safe_thetas = np.where(thetas > 0, thetas, 1)
+    kx = steps[:, 1] / safe_thetas
+    ky = -1 * steps[:, 0] / safe_thetas
+    # rotation is by angle (-theta) around the axis, see rotation_from_point_to_point()
+    sines = np.sin(-1 * thetas)
+    one_minus_cosines = 1 - np.cos(thetas)
+    rotations = np.zeros(shape=(steps.shape[0], 3, 3))
+    rotations[:, [0, 1, 2], [0, 1, 2]] = 1
+    rotations[:, 0, 0] -= one_minus_cosines * ky ** 2
+    rotations[:, 1, 1] -= one_minus_cosines * kx ** 2
+    rotations[:, 2, 2] -= one_minus_cosines
+    rotations[:, 0, 1] = one_minus_cosines * kx * ky
+    rotations[:, 1, 0] = one_minus_cosines * kx * ky
+    rotations[:, 0, 2] = sines * ky
+    rotations[:, 2, 0] = -1 * sines * ky
+    rotations[:, 1, 2] = -1 * sines * kx
+    rotations[:, 2, 1] = sines * kx
+    return rotations
+
+
+@instrumentation.instrumented('rolling')
+def rotations_to_origin(data):
+    '''Batched version of rotation_to_origin(): returns an array of shape (N, 4, 4) whose i-th element is equal to
+    rotation_to_origin(i, data). Single-step rotations are built at once by Rodrigues formula and then
+    accumulated by a parallel prefix product (log2(N) batched matrix multiplications), without any caching.'''
+    if isinstance(data, PeriodicPath):
+        return data.rotations_to_origin()
+    rotations = np.zeros(shape=(data.shape[0], 3, 3))
+    rotations[0] = np.eye(3)
+    rotations[1:] = rotations_for_steps(data[:-1] - data[1:])
+
+    # inclusive prefix product R_1 @ R_2 @ ... @ R_i (Hillis-Steele scan)
+    offset = 1
+    while offset < rotations.shape[0]:
+        rotations[offset:] = rotations[:-offset] @ rotations[offset:]
+        offset *= 2
+
+    net_rotation_matrices = np.zeros(shape=(data.shape[0], 4, 4))
+    net_rotation_matrices[:, :3, :3] = rotations
+    net_rotation_matrices[:, 3, 3] = 1
+    return net_rotation_matrices
+
+
+def line_segment(angle, length):
+    '''Straight segment of a primitive-based path, in the same terms as add_interval() of existence-testing.py.
+    Segments are rows [heading at the start, length, signed curvature] and are stacked into an array of shape (K, 3).'''
+    return np.array([angle, length, 0])
+
+
+def arc_segment(start_angle, end_angle, radius):
+    '''Circular arc segment going from polar angle start_angle to end_angle around its center,
+    in the same terms as add_arc() of existence-testing.py. See line_segment().'''
+    direction = np.sign(end_angle - start_angle)
+    return np.array([start_angle + direction * np.pi / 2, radius * np.abs(end_angle - start_angle), direction / radius])
+
+
+def rotations_along_segments(segments, arc_lengths, scale=1):
+    '''
+    Exact rotation of the sphere of unit radius rolled from the start of each segment over the given arc length along it.
+    It is the continuous limit of rotation_to_origin() for the densely sampled segment.
+
+    When heading phi(s) = phi_0 + k * s changes at constant rate k, the net rotation M(s) obeys M' = M [n(s)]_x, where
+    n(s) = Rz(phi(s)) [0, -1, 0]. In the frame co-rotating with the heading the generator is constant, which gives
+    M(s) = Rz(phi_0) Rot([0, -1, k], s * sqrt(1 + k^2)) Rz(phi_0 + k * s)^T. Straight lines are the case k = 0.
+
+    :param segments: Array of shape (K, 3) of segments, see line_segment() and arc_segment()
+    :param arc_lengths: Array of shape (K,) or (K, P) of arc lengths (before scaling) along each segment.
+    :param scale: Float. Uniform scale factor of the path.
+    :return: Array of shape (K, 3, 3) or (K, P, 3, 3)
+    '''
+    arc_lengths = np.asarray(arc_lengths, dtype=float)
+    extra_dims = (None,) * (arc_lengths.ndim - 1)
+    headings = segments[(slice(None),) + (0,) + extra_dims]
+    curvatures = segments[(slice(None),) + (2,) + extra_dims] / scale
+    arc_lengths = arc_lengths * scale
+
+    def rotations_around_z(angles):
+        rotations = np.zeros(shape=angles.shape + (3, 3))
+        rotations[..., 0, 0] = np.cos(angles)
+        rotations[..., 0, 1] = -1 * np.sin(angles)
+        rotations[..., 1, 0] = np.sin(angles)
+        rotations[..., 1, 1] = np.cos(angles)
+        rotations[..., 2, 2] = 1
+        return rotations
+
+    # Rodrigues formula for unit axis [0, -1, k] / sqrt(1 + k^2)
+    norms = np.sqrt(1 + curvatures ** 2) * np.ones_like(arc_lengths)
+    axes = np.stack((np.zeros_like(norms), -1 / norms, curvatures / norms), axis=-1)
+    angles = arc_lengths * norms
+    cross_matrices = np.zeros(shape=norms.shape + (3, 3))
+    cross_matrices[..., 0, 1] = -1 * axes[..., 2]
+    cross_matrices[..., 0, 2] = axes[..., 1]
+    cross_matrices[..., 1, 0] = axes[..., 2]
+    cross_matrices[..., 1, 2] = -1 * axes[..., 0]
+    cross_matrices[..., 2, 0] = -1 * axes[..., 1]
+    cross_matrices[..., 2, 1] = axes[..., 0]
+    axial_rotations = np.eye(3) + np.sin(angles)[..., None, None] * cross_matrices + \
+                      (1 - np.cos(angles))[..., None, None] * (cross_matrices @ cross_matrices)
+    start_frames = rotations_around_z(headings * np.ones_like(arc_lengths))
+    end_frames = rotations_around_z(headings + curvatures * arc_lengths)
+    return start_frames @ axial_rotations @ np.swapaxes(end_frames, -1, -2)
+
+
+def rotation_for_segments(segments, scale=1):
+    '''Net rotation after rolling the unit sphere along the whole primitive-based path, as a 4x4 matrix
+    (same as rotation_to_origin() for the last point of the densely sampled path). Costs O(number of segments).'''
+    segment_rotations = rotations_along_segments(segments, segments[:, 1], scale=scale)
+    net_rotation_matrix = trimesh.transformations.identity_matrix()
+    for segment_rotation in segment_rotations:
+        net_rotation_matrix[:3, :3] = net_rotation_matrix[:3, :3] @ segment_rotation
+    return net_rotation_matrix
+
+
+def mismatch_angle_for_segments(segments, scale=1):
+    '''Exact version of mismatch_angle_for_path() for a primitive-based path.'''
+    return trimesh.transformations.rotation_from_matrix(rotation_for_segments(segments, scale=scale))[0]
+
+
+def sample_segments(segments, points_per_segment=30, scale=1):
+    '''
+    Samples a primitive-based path into points, like add_interval() and add_arc() do. The start of the path is at
+    the origin. The endpoints of neighbouring segments are not duplicated.
+
+    :return: Tuple of the flat path of shape (M, 2) and arc lengths within each segment of shape (K, points_per_segment)
+    '''
+    arc_lengths = np.linspace(0, 1, points_per_segment)[None, :] * segments[:, 1][:, None]
+    headings = segments[:, 0][:, None]
+    curvatures = segments[:, 2][:, None]
+    turns = curvatures * arc_lengths
+    is_straight = np.abs(curvatures) < 1e-12
+    safe_curvatures = np.where(is_straight, 1, curvatures)
+    dxs = np.where(is_straight, arc_lengths * np.cos(headings),
+                   (np.sin(headings + turns) - np.sin(headings)) / safe_curvatures)
+    dys = np.where(is_straight, arc_lengths * np.sin(headings),
+                   (np.cos(headings) - np.cos(headings + turns)) / safe_curvatures)
+    displacements = np.stack((dxs, dys), axis=-1)
+    segment_starts = np.cumsum(np.vstack((np.zeros(2), displacements[:-1, -1])), axis=0)
+    points = segment_starts[:, None, :] + displacements
+    flat_path = np.vstack((points[0, :1], points[:, 1:].reshape(-1, 2)))
+    return flat_path * scale, arc_lengths
+
+
+@instrumentation.instrumented('rolling')
+def trace_on_sphere_for_segments(segments, points_per_segment=30, scale=1, core_radius=1):
+    '''Trace of the contact point on the rolling sphere for a primitive-based path, sampled at the points given by
+    sample_segments(). The same as trace_on_sphere() of that sampled path, but rolled exactly along lines and arcs.'''
+    instrumentation.count('trace_evaluations')
+    arc_lengths = sample_segments(segments, points_per_segment=points_per_segment)[1]
+    local_rotations = rotations_along_segments(segments, arc_lengths, scale=scale)
+    segment_start_rotations = np.zeros(shape=(segments.shape[0], 3, 3))
+    segment_start_rotations[0] = np.eye(3)
+    for k in range(1, segments.shape[0]):
+        segment_start_rotations[k] = segment_start_rotations[k - 1] @ local_rotations[k - 1, -1]
+    rotations = segment_start_rotations[:, None] @ local_rotations
+    rotations = np.vstack((rotations[0, :1], rotations[:, 1:].reshape(-1, 3, 3)))
+    return rotations @ np.array([0, 0, -1 * core_radius])
+
+
+@instrumentation.instrumented('rolling')
+def net_rotations_for_scalings(data0, kxs, kys, max_batch_elements=2 ** 20):
+    '''
+    Net rotations (as rotation_to_origin() for the last point, 3x3 part) after rolling along the path data0 with
+    x scaled by kx and y scaled by ky, for all pairs of kxs and kys at once. Single-step rotations of up to
+    max_batch_elements steps are built together, and the product along the path is taken by pairwise
+    batched matrix multiplications.
+
+    :return: Array of shape (K, 3, 3)
+    '''
+    kxs = np.atleast_1d(kxs)
+    kys = np.atleast_1d(kys)
+    instrumentation.count('net_rotation_evaluations', kxs.shape[0])
+    steps0 = data0[:-1] - data0[1:]
+    net_rotations = np.empty(shape=(kxs.shape[0], 3, 3))
+    batch_size = max(1, max_batch_elements // steps0.shape[0])
+    for batch_start in range(0, kxs.shape[0], batch_size):
+        scalings = np.stack((kxs[batch_start:batch_start + batch_size],
+                             kys[batch_start:batch_start + batch_size]), axis=1)
+        steps = steps0[None, :, :] * scalings[:, None, :]
+        rotations = rotations_for_steps(steps.reshape(-1, 2)).reshape(scalings.shape[0], -1, 3, 3)
+        while rotations.shape[1] > 1:
+            # multiply neighbours (2i, 2i+1) keeping the order, the odd last one is carried over
+            number_of_pairs = rotations.shape[1] // 2
+            products = rotations[:, 0:2 * number_of_pairs:2] @ rotations[:, 1:2 * number_of_pairs:2]
+            rotations = np.concatenate((products, rotations[:, 2 * number_of_pairs:]), axis=1)
+        net_rotations[batch_start:batch_start + batch_size] = rotations[:, 0]
+    return net_rotations
+
+
+def _rotations_in_pool(rotations_function, kxs, kys, processes, chunk_size=256):
+    if processes == 1 or kxs.shape[0] <= chunk_size:
+        return rotations_function(kxs, kys)
+    chunks = [(kxs[chunk_start:chunk_start + chunk_size], kys[chunk_start:chunk_start + chunk_size])
+              for chunk_start in range(0, kxs.shape[0], chunk_size)]
+    with multiprocessing.Pool(processes=processes) as pool:
+        return np.concatenate(pool.starmap(rotations_function, chunks))
+
+
+def _angles_and_signed_field(rotations, principal_axis):
+    # Mismatch angle and a smooth signed field that changes sign at zero mismatch: the component of
+    # sin(angle) * axis (the antisymmetric part of the rotation matrix) along the principal axis.
+    angles = np.arccos(np.clip((np.trace(rotations, axis1=1, axis2=2) - 1) / 2, -1, 1))
+    sine_axes = 0.5 * np.stack((rotations[:, 2, 1] - rotations[:, 1, 2],
+                                rotations[:, 0, 2] - rotations[:, 2, 0],
+                                rotations[:, 1, 0] - rotations[:, 0, 1]), axis=1)
+    return angles, sine_axes @ principal_axis
+
+
+@instrumentation.instrumented('root_finding')
+def compute_mismatch_map(rotations_function, kx_range=(0.1, 2), ky_range=(0.1, 2), N=30, M=30, refine_levels=0,
+                         refine_threshold=0.2, contour_tolerance=1e-3, processes=1):
+    '''
+    Mismatch angle over the N x M grid of two parameters (kx, ky) and the curves along which it is zero.
+
+    The grid is evaluated at once by rotations_function(kxs, kys), which returns net rotations of shape (K, 3, 3)
+    for flat arrays of parameters (NaN for invalid parameters), e.g. functools.partial(net_rotations_for_scalings,
+    data0). With processes other than 1 it is called on chunks of the grid in a pool of processes, so it must be
+    picklable. Each of refine_levels doubles the resolution of the grid, but new nodes are evaluated only in the
+    cells where the mismatch gets to zero or below refine_threshold; elsewhere they are interpolated.
+
+    Zero mismatch of a doubled path happens along curves, where the smooth signed field (see
+    _angles_and_signed_field()) changes sign. Its zero contours are found on the final grid, each vertex is then
+    brought to the zero along its grid edge by regula falsi, and only the vertices where the actual mismatch angle
+    is below contour_tolerance are kept.
+
+    :return: Tuple of kx and ky grids, mismatch angles on them (with the sign of the signed field) and list of
+             zero-mismatch polylines of shape (L, 2) with columns kx and ky
+    '''
+    kx_values = np.linspace(kx_range[0], kx_range[1], N)
+    ky_values = np.linspace(ky_range[0], ky_range[1], M)
+    kxs, kys = np.meshgrid(kx_values, ky_values, indexing='ij')
+    rotations = _rotations_in_pool(rotations_function, kxs.ravel(), kys.ravel(), processes)
+    # the sign of the field is defined by the principal direction of the rotation axes over the grid
+    sine_axes = 0.5 * np.stack((rotations[:, 2, 1] - rotations[:, 1, 2],
+                                rotations[:, 0, 2] - rotations[:, 2, 0],
+                                rotations[:, 1, 0] - rotations[:, 0, 1]), axis=1)
+    principal_axis = np.linalg.svd(sine_axes[np.all(np.isfinite(sine_axes), axis=1)], full_matrices=False)[2][0]
+    angles, field = _angles_and_signed_field(rotations, principal_axis)
+    angles = angles.reshape(kxs.shape)
+    field = field.reshape(kxs.shape)
+
+    for level in range(refine_levels):
+        finer_kx_values = np.linspace(kx_range[0], kx_range[1], 2 * kx_values.shape[0] - 1)
+        finer_ky_values = np.linspace(ky_range[0], ky_range[1], 2 * ky_values.shape[0] - 1)
+        finer_angles = np.full(shape=(finer_kx_values.shape[0], finer_ky_values.shape[0]), fill_value=np.nan)
+        finer_field = np.full_like(finer_angles, np.nan)
+        finer_angles[::2, ::2] = angles
+        finer_field[::2, ::2] = field
+        # new nodes are interpolated from the corners of their coarse cells...
+        for values, finer_values in ((angles, finer_angles), (field, finer_field)):
+            finer_values[1::2, ::2] = (values[:-1, :] + values[1:, :]) / 2
+            finer_values[::2, 1::2] = (values[:, :-1] + values[:, 1:]) / 2
+            finer_values[1::2, 1::2] = (values[:-1, :-1] + values[1:, :-1] + values[:-1, 1:] + values[1:, 1:]) / 4
+        # ...except in the cells close to zero mismatch, where they are evaluated
+        corners = np.stack((field[:-1, :-1], field[1:, :-1], field[:-1, 1:], field[1:, 1:]))
+        corner_angles = np.stack((angles[:-1, :-1], angles[1:, :-1], angles[:-1, 1:], angles[1:, 1:]))
+        # (fmin and fmax skip NaN of invalid parameters)
+        cells_to_refine = (np.fmin.reduce(corners, axis=0) <= 0) & (np.fmax.reduce(corners, axis=0) >= 0) | \
+                          (np.fmin.reduce(corner_angles, axis=0) < refine_threshold)
+        nodes_to_evaluate = np.zeros_like(finer_angles, dtype=bool)
+        for di in range(3):
+            for dj in range(3):
+                nodes_to_evaluate[di:di + 2 * cells_to_refine.shape[0]:2,
+                                  dj:dj + 2 * cells_to_refine.shape[1]:2] |= cells_to_refine
+        nodes_to_evaluate[::2, ::2] = False
+        node_indices = np.nonzero(nodes_to_evaluate)
+        if node_indices[0].shape[0] > 0:
+            new_angles, new_field = _angles_and_signed_field(
+                _rotations_in_pool(rotations_function, finer_kx_values[node_indices[0]],
+                                   finer_ky_values[node_indices[1]], processes), principal_axis)
+            finer_angles[node_indices] = new_angles
+            finer_field[node_indices] = new_field
+        kx_values, ky_values, angles, field = finer_kx_values, finer_ky_values, finer_angles, finer_field
+    kxs, kys = np.meshgrid(kx_values, ky_values, indexing='ij')
+
+    # zero contours of the signed field; invalid cells are set away from zero, so that they do not produce contours
+    finite_field = np.where(np.isfinite(field), field, np.nanmax(np.abs(field)))
+    contours = []
+    for contour in skimage_measure.find_contours(finite_field, 0):
+        # every contour vertex lies on a grid edge between nodes a and b
+        rows_a = np.floor(contour[:, 0]).astype(int)
+        cols_a = np.floor(contour[:, 1]).astype(int)
+        rows_b = np.minimum(np.ceil(contour[:, 0]).astype(int), kxs.shape[0] - 1)
+        cols_b = np.minimum(np.ceil(contour[:, 1]).astype(int), kxs.shape[1] - 1)
+        kxs_a, kys_a, field_a = kx_values[rows_a], ky_values[cols_a], finite_field[rows_a, cols_a]
+        kxs_b, kys_b, field_b = kx_values[rows_b], ky_values[cols_b], finite_field[rows_b, cols_b]
+        fractions = contour[:, 0] - rows_a + contour[:, 1] - cols_a
+        for iteration in range(8):
+            contour_kxs = kxs_a + fractions * (kxs_b - kxs_a)
+            contour_kys = kys_a + fractions * (kys_b - kys_a)
+            contour_angles, contour_field = _angles_and_signed_field(
+                _rotations_in_pool(rotations_function, contour_kxs, contour_kys, processes), principal_axis)
+            same_sign_as_a = np.sign(contour_field) == np.sign(field_a)
+            kxs_a, kys_a, field_a = [np.where(same_sign_as_a, new, old) for new, old in
+                                     ((contour_kxs, kxs_a), (contour_kys, kys_a), (contour_field, field_a))]
+            kxs_b, kys_b, field_b = [np.where(same_sign_as_a, old, new) for new, old in
+                                     ((contour_kxs, kxs_b), (contour_kys, kys_b), (contour_field, field_b))]
+            denominators = field_a - field_b
+            fractions = np.where(denominators != 0, field_a / np.where(denominators != 0, denominators, 1), 0.5)
+        # split the contour where it is a sign change of the field but not zero mismatch
+        is_root = contour_angles < contour_tolerance
+        root_points = np.stack((contour_kxs, contour_kys), axis=1)
+        breaks = np.flatnonzero(np.diff(is_root.astype(int))) + 1
+        for part, part_is_root in zip(np.split(root_points, breaks), np.split(is_root, breaks)):
+            if part_is_root[0] and part.shape[0] > 1:
+                contours.append(part)
+    return kxs, kys, angles * np.where(field < 0, -1, 1), contours
+
+
+@instrumentation.instrumented('plotting')
 def plot_mismatch_map_for_scale_tweaking(data0, N=30, M=30, kx_range=(0.1, 2), ky_range=(0.1, 2), vmin=0, vmax=np.pi,
-                                         signed_angle=False):
+                                         signed_angle=False, refine_levels=0, processes=1):
+    '''Plots the map of mismatch angles of the path data0 scaled by kx along x and by ky along y, with the curves
+    of zero mismatch (see compute_mismatch_map()). Returns these curves as list of arrays of (kx, ky) points.'''
     # sweeping parameter space for optimal match of the starting and ending orientation
-    angles = np.zeros(shape=(N, M))
-    xs = np.zeros_like(angles)
-    ys = np.zeros_like(angles)
-    for i, kx in enumerate(np.linspace(kx_range[0], kx_range[1], N)):
-        for j, ky in enumerate(np.linspace(ky_range[0], ky_range[1], M)):
-            data = np.copy(data0)
-            data[:, 0] = data[:, 0] * kx
-            data[:, 1] = data[:, 1] * ky  # +  kx * np.sin(data0[:, 0])
-            rotation_of_entire_traj = trimesh.transformations.rotation_from_matrix(
-                rotation_to_origin(data.shape[0] - 1, data))
-            angle = rotation_of_entire_traj[0]
-            xs[i, j] = kx
-            ys[i, j] = ky
-            angles[i, j] = angle
-
-    print('Min angle = {0}'.format(np.min(np.abs(angles))))
+    xs, ys, angles, contours = compute_mismatch_map(partial(net_rotations_for_scalings, data0), kx_range=kx_range,
+                                                    ky_range=ky_range, N=N, M=M, refine_levels=refine_levels,
+                                                    processes=processes)
+    print('Min angle = {0}'.format(np.nanmin(np.abs(angles))))
     f3 = plt.figure(3)
     if signed_angle:
         plt.pcolormesh(xs, ys, angles, cmap='viridis', vmin=-vmax, vmax=vmax)
     else:
         plt.pcolormesh(xs, ys, np.abs(angles), cmap='viridis', vmin=vmin, vmax=vmax)
     plt.colorbar()
+    for contour in contours:
+        plt.plot(contour[:, 0], contour[:, 1], color='red')
     plt.show()
-
-
+    return contours
+
+
+def make_base_box(core_radius=1, cut_size=10):
+    '''Cutting box of the first path point: a cube lying entirely below the plane z = -core_radius
+    and touching it with its top face.'''
+    return trimesh.creation.box(extents=[cut_size * core_radius, cut_size * core_radius, cut_size * core_radius],
+                                transform=trimesh.transformations.translation_matrix(
+                                    [0, 0, -core_radius - 1 * cut_size * core_radius / 2]))
+
+
+def merge_cutting_boxes(base_box, transforms):
+    '''Makes a single mesh containing all the cutting boxes. Box i is the base_box transformed by transforms[i].
+    Vertices of all boxes are transformed in one batched operation.'''
+    vertices = np.einsum('nij,vj->nvi', transforms[:, :3, :3], base_box.vertices) + transforms[:, None, :3, 3]
+    faces = base_box.faces[None, :, :] + (np.arange(transforms.shape[0]) * base_box.vertices.shape[0])[:, None, None]
+    return trimesh.Trimesh(vertices=vertices.reshape(-1, 3), faces=faces.reshape(-1, 3), process=False)
+
+
+def make_half_with_cavity(trajectoid, cavity_radius, plane_normal, plane_offset, side, cavity_segments=128):
+    '''
+    Makes one half of a convex trajectoid with a spherical cavity centered at the origin. The kept half is
+    side * (n.x - plane_offset) <= 0. The cavity is inserted directly as an inward-facing spherical cap joined to the
+    cross-section, so no mesh booleans are needed: the cavity lies inside the core sphere and therefore strictly
+    inside the trajectoid.
+    '''
+    n = np.array(plane_normal, dtype=float)
+    n /= np.linalg.norm(n)
+    # outward normal of the flat face of the half
+    cap_normal = side * n
+    cross_section_center = n * plane_offset
+    half_vertices, half_faces = trimesh.intersections.slice_faces_plane(trajectoid.vertices, trajectoid.faces,
+                                                                        plane_normal=-1 * cap_normal,
+                                                                        plane_origin=cross_section_center)[:2]
+    half = trimesh.Trimesh(vertices=half_vertices, faces=half_faces, process=False)
+    half.merge_vertices()
+
+    # orthonormal basis with e3 pointing into the kept half
+    e3 = -1 * cap_normal
+    e1 = np.cross(e3, [1, 0, 0] if np.abs(e3[0]) < 0.9 else [0, 1, 0])
+    e1 /= np.linalg.norm(e1)
+    e2 = np.cross(e3, e1)
+
+    # the cross section of the convex solid is a convex polygon bounded by the open edges of the sliced mesh
+    edges, edge_counts = np.unique(half.edges_sorted, axis=0, return_counts=True)
+    outer_indices = np.unique(edges[edge_counts == 1])
+    relative = half.vertices[outer_indices] - cross_section_center
+    outer_angles = np.arctan2(relative @ e2, relative @ e1)
+    outer_indices = outer_indices[np.argsort(outer_angles)]
+    outer_angles = np.sort(outer_angles)
+
+    vertices = [half.vertices]
+    new_faces = []
+    cavity_is_cut = (cavity_radius is not None) and (cavity_radius > np.abs(plane_offset))
+    if not cavity_is_cut:
+        # cross section is triangulated as a fan around its center
+        center_index = half.vertices.shape[0]
+        vertices.append(cross_section_center[None, :])
+        new_faces.append(np.stack((np.full(outer_indices.shape[0], center_index), outer_indices,
+                                   np.roll(outer_indices, -1))).T)
+    else:
+        # spherical cap of the cavity: pole at theta = 0, rim in the halving plane
+        rim_theta = np.arccos(-1 * side * plane_offset / cavity_radius)
+        number_of_rings = max(2, int(np.ceil(rim_theta / (2 * np.pi / cavity_segments))))
+        thetas = np.linspace(0, rim_theta, number_of_rings + 1)[1:]
+        phis = np.linspace(-np.pi, np.pi, cavity_segments, endpoint=False)
+        theta_grid, phi_grid = np.meshgrid(thetas, phis, indexing='ij')
+        ring_points = cavity_radius * (np.sin(theta_grid)[..., None] * (np.cos(phi_grid)[..., None] * e1 +
+                                                                         np.sin(phi_grid)[..., None] * e2) +
+                                       np.cos(theta_grid)[..., None] * e3)
+        # put the rim exactly into the plane
+        ring_points[-1] += (plane_offset - ring_points[-1] @ n)[:, None] * n
+        pole_index = half.vertices.shape[0]
+        ring_index = (pole_index + 1 + np.arange(number_of_rings * cavity_segments)).reshape(number_of_rings,
+                                                                                              cavity_segments)
+        vertices.extend([cavity_radius * e3[None, :], ring_points.reshape(-1, 3)])
+        next_ring_index = np.roll(ring_index, -1, axis=1)
+        new_faces.append(np.stack((np.full(cavity_segments, pole_index), ring_index[0], next_ring_index[0])).T)
+        for k in range(number_of_rings - 1):
+            new_faces.append(np.stack((ring_index[k], ring_index[k + 1], next_ring_index[k])).T)
+            new_faces.append(np.stack((next_ring_index[k], ring_index[k + 1], next_ring_index[k + 1])).T)
+
+        # flat annulus between the outer cross section and the rim of the cavity, zipped by polar angle
+        rim_indices = ring_index[-1]
+        number_of_outer, number_of_rim = outer_indices.shape[0], rim_indices.shape[0]
+        annulus_faces = []
+        i, j = 0, 0
+        while i < number_of_outer or j < number_of_rim:
+            next_outer_angle = outer_angles[(i + 1) % number_of_outer] + 2 * np.pi * ((i + 1) // number_of_outer)
+            next_rim_angle = phis[(j + 1) % number_of_rim] + 2 * np.pi * ((j + 1) // number_of_rim)
+            if j >= number_of_rim or (i < number_of_outer and next_outer_angle < next_rim_angle):
+                annulus_faces.append([outer_indices[i % number_of_outer], outer_indices[(i + 1) % number_of_outer],
+                                      rim_indices[j % number_of_rim]])
+                i += 1
+            else:
+                annulus_faces.append([outer_indices[i % number_of_outer], rim_indices[(j + 1) % number_of_rim],
+                                      rim_indices[j % number_of_rim]])
+                j += 1
+        new_faces.append(np.array(annulus_faces))
+
+    vertices = np.vstack(vertices)
+    new_faces = np.vstack(new_faces)
+    # orient the new faces: flat faces look along cap_normal, faces of the cavity look toward its center
+    triangles = vertices[new_faces]
+    face_normals = np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0])
+    on_cavity = np.abs(triangles[:, :, :] @ n - plane_offset).max(axis=1) > 1e-9
+    desired_directions = np.where(on_cavity[:, None], -1 * triangles.mean(axis=1), cap_normal[None, :])
+    flipped = np.einsum('ij,ij->i', face_normals, desired_directions) < 0
+    new_faces[flipped] = new_faces[flipped][:, ::-1]
+
+    shell = trimesh.Trimesh(vertices=vertices, faces=np.vstack((half.faces, new_faces)), process=False)
+    shell.merge_vertices()
+    shell.update_faces(shell.nondegenerate_faces())
+    shell.remove_unreferenced_vertices()
+    if cavity_radius is not None and not cavity_is_cut and side * plane_offset >= 0:
+        # cavity does not reach the halving plane and lies entirely in this half
+        cavity = trimesh.creation.icosphere(subdivisions=4, radius=cavity_radius)
+        cavity.invert()
+        shell = trimesh.util.concatenate([shell, cavity])
+    return shell
+
+
+@instrumentation.instrumented('mesh_export')
+def make_printable_halves(trajectoid, cavity_radius, plane_normal=(0, 1, 0), plane_offset=0, masterscale=1,
+                          folder_for_meshes=None, cavity_segments=128):
+    '''
+    Subtracts the spherical cavity from the computed (convex) trajectoid solid and splits it into two halves along
+    a plane, all in Python and without external software.
+
+    :param trajectoid: trimesh.Trimesh. Convex trajectoid solid, e.g. from make_trajectoid_mesh()
+    :param cavity_radius: Float or None. Radius of the cavity centered at origin. If None, there is no cavity.
+    :param plane_normal: Normal of the halving plane n.x = plane_offset
+    :param masterscale: Float. The halves are finally scaled by this factor (e.g. core radius in millimeters).
+    :param folder_for_meshes: String or None. If not None, the halves are saved into this folder as binary STL files
+                              trajectoid_half_left.stl (side n.x < plane_offset) and trajectoid_half_right.stl
+    :param cavity_segments: Integer. Number of segments of the cavity along the circle of latitude.
+    :return: Tuple of two trimesh.Trimesh: left and right halves.
+    '''
+    halves = []
+    for side in [1, -1]:
+        half = make_half_with_cavity(trajectoid, cavity_radius, plane_normal, plane_offset, side,
+                                     cavity_segments=cavity_segments)
+        half.apply_scale(masterscale)
+        halves.append(half)
+    if folder_for_meshes is not None:
+        for half, name in zip(halves, ['left', 'right']):
+            half.export(f'{folder_for_meshes}/trajectoid_half_{name}.stl')
+    return tuple(halves)
+
+
+def make_openscad_code(transforms, core_radius=1, cut_size=10, outer_radius=1.25, cavity_radius=None, masterscale=1,
+                       halving=None, halving_cube_size=20, geosphere=None, geosphere_subdivisions=4):
+    '''
+    Makes a self-contained OpenSCAD program for the trajectoid: a single cutting cube is defined once and then
+    placed by an inline multmatrix() for every cutting box. Geosphere is embedded as a polyhedron, so no files
+    are imported during rendering.
+
+    :param transforms: Array of shape (N, 4, 4), transforms of the cutting boxes (see compute_shape())
+    :param outer_radius: Float. Radius of the outer geosphere, in the same units as core_radius
+    :param cavity_radius: Float or None. Radius of the inner spherical cavity. If None, there is no cavity.
+    :param masterscale: Float. The whole shape is finally scaled by this factor (e.g. core radius in millimeters).
+    :param halving: None, "left" or "right". If not None, one half of the shape is cut away by a cube,
+                    leaving the left (y < 0) or right (y > 0) half.
+    :param halving_cube_size: Float. Size of the cube used for halving. Must be larger than 2 * outer_radius.
+    :param geosphere: trimesh.Trimesh or None. Convex mesh of the unit sphere, for example
+                      trimesh.load('unit_geosphere.stl'). If None, an icosphere is used.
+    :return: String with OpenSCAD code
+    '''
+    if geosphere is None:
+        geosphere = trimesh.creation.icosphere(subdivisions=geosphere_subdivisions)
+
+    def format_vector(vector):
+        return '[' + ', '.join(f'{x:.10g}' for x in vector) + ']'
+
+    lines = [f'masterscale = {masterscale:.10g};',
+             '',
+             'module cutter_cube() {',
+             f'    translate([0, 0, {-core_radius - cut_size * core_radius / 2:.10g}]) '
+             f'cube(size = {cut_size * core_radius:.10g}, center = true);',
+             '}',
+             '',
+             'module geosphere(radius) {',
+             '    scale([radius, radius, radius]) polyhedron(',
+             '        points = [' + ', '.join(format_vector(v) for v in geosphere.vertices) + '],',
+             # OpenSCAD wants faces ordered clockwise when looking from outside
+             '        faces = [' + ', '.join(format_vector(f[::-1]) for f in geosphere.faces) + ']);',
+             '}',
+             '',
+             'module cube_for_halving() {',
+             f'    translate([{-halving_cube_size / 2:.10g}, 0, {-halving_cube_size / 2:.10g}]) '
+             f'cube(size = [{halving_cube_size:.10g}, {halving_cube_size:.10g}, {halving_cube_size:.10g}], '
+             f'center = false);',
+             '}',
+             '',
+             'scale([masterscale, masterscale, masterscale]) difference() {',
+             f'    geosphere(radius = {outer_radius:.10g});']
+    if cavity_radius is not None:
+        lines.append(f'    geosphere(radius = {cavity_radius:.10g});')
+    if halving == 'left':
+        lines.append('    cube_for_halving();')
+    elif halving == 'right':
+        lines.append(f'    translate([0, {-halving_cube_size:.10g}, 0]) cube_for_halving();')
+    elif halving is not None:
+        raise ValueError(f'Unknown halving: {halving}')
+    for transform in transforms:
+        lines.append('    multmatrix(m = [' + ', '.join(format_vector(row) for row in transform[:3]) + ']) '
+                     'cutter_cube();')
+    lines.append('}')
+    return '\n'.join(lines) + '\n'
+
+
+@instrumentation.instrumented('mesh_export')
 def compute_shape(data0, kx, ky, folder_for_path, folder_for_meshes='cut_meshes', core_radius=1,
-                  cut_size=10):
+                  cut_size=10, export_mode='separate_files', prune_tolerance=None, outer_radius=1.25,
+                  cavity_radius=None, masterscale=1, halving=None, decimation_tolerance=None):
+    '''
+    Computes the positions and orientations of the boxes for cutting and saves them.
+
+    :param export_mode: String. "separate_files" saves each box to its own file test_{i}.obj
+                        (these boxes are later loaded to 3dsmax and subtracted from a sphere),
+                        "transforms_npy" saves the stacked Nx4x4 array of box transforms into
+                        folder_for_meshes/cutting_transforms.npy, "merged_stl" saves all the boxes as a single
+                        binary STL file folder_for_meshes/cutting_boxes.stl, "openscad" saves a self-contained
+                        OpenSCAD program folder_for_meshes/trajectoid.scad (see make_openscad_code(), which also
+                        explains the parameters outer_radius, cavity_radius, masterscale and halving)
+    :param prune_tolerance: Float or None. If not None, boxes that change the final solid (sphere of radius
+                            outer_radius minus the boxes) by less than this distance are not exported.
+                            See prune_cutting_transforms().
+    :param decimation_tolerance: Float or None. If not None, the scaled path is first reduced to fewer points that
+                                 change the rolling by at most this angle (radians), see decimate_path().
+    :return: Array of shape (N, 4, 4) with transforms of the base box (see make_base_box()) for every exported box.
+    '''
     data = np.copy(data0)
     data[:, 0] = data[:, 0] * kx
     data[:, 1] = data[:, 1] * ky
-    # This code computes the positions and orientations of the boxes_for_cutting, and saves each box to a file.
-    # These boxes are later loaded to 3dsmax and subtracted from a sphere
-    rotation_of_entire_traj = trimesh.transformations.rotation_from_matrix(rotation_to_origin(data.shape[0] - 1, data))
-    # print(rotation_of_entire_traj)
-    angle = rotation_of_entire_traj[0]
-    # print('Angle: {0}'.format(angle))
-
+    if decimation_tolerance is not None:
+        data = decimate_path(data, decimation_tolerance)[0]
     np.save(folder_for_path + '/path_data', data)
-    base_box = trimesh.creation.box(extents=[cut_size * core_radius, cut_size * core_radius, cut_size * core_radius],
-                                    transform=trimesh.transformations.translation_matrix(
-                                        [0, 0, -core_radius - 1 * cut_size * core_radius / 2]))
-    boxes_for_cutting = []
-    for i, point in enumerate(data):
-        # make a copy of the base box
-        box_for_cutting = base_box.copy()
-        # roll the sphere (without slipping) on the xy plane along with the box "glued" to it to the (0,0) point of origin
-        # Not optimized here. Would become vastly faster if, for example, you cache the rotation matrices.
-        box_for_cutting.apply_transform(rotation_to_origin(i, data))
-        boxes_for_cutting.append(box_for_cutting.copy())
 
-    for i, box in enumerate(boxes_for_cutting):
-        print('Saving box for cutting: {0}'.format(i))
-        box.export('{0}/test_{1}.obj'.format(folder_for_meshes, i))
+    # roll the sphere (without slipping) on the xy plane along with the box "glued" to it to the (0,0) point of origin.
+    # Rotations for all the points are computed at once.
+    transforms = rotations_to_origin(data)
+    angle = trimesh.transformations.rotation_from_matrix(transforms[-1])[0]
+    logging.debug('Mismatch angle: %s', angle)
+    if prune_tolerance is not None:
+        kept_indices, max_protrusion = prune_cutting_transforms(transforms, prune_tolerance, core_radius=core_radius,
+                                                                outer_radius=outer_radius)
+        transforms = transforms[kept_indices]
+
+    base_box = make_base_box(core_radius=core_radius, cut_size=cut_size)
+    if export_mode == 'separate_files':
+        for i, transform in enumerate(transforms):
+            print('Saving box for cutting: {0}'.format(i))
+            box_for_cutting = base_box.copy()
+            box_for_cutting.apply_transform(transform)
+            box_for_cutting.export('{0}/test_{1}.obj'.format(folder_for_meshes, i))
+    elif export_mode == 'transforms_npy':
+        np.save(folder_for_meshes + '/cutting_transforms.npy', transforms)
+    elif export_mode == 'merged_stl':
+        merge_cutting_boxes(base_box, transforms).export(folder_for_meshes + '/cutting_boxes.stl')
+    elif export_mode == 'openscad':
+        with open(folder_for_meshes + '/trajectoid.scad', 'w') as scad_file:
+            scad_file.write(make_openscad_code(transforms, core_radius=core_radius, cut_size=cut_size,
+                                               outer_radius=outer_radius, cavity_radius=cavity_radius,
+                                               masterscale=masterscale, halving=halving))
+    else:
+        raise ValueError(f'Unknown export mode: {export_mode}')
+    return transforms
+
+
+def cutting_halfspaces(transforms, core_radius=1):
+    '''Each cutting box lies entirely below the plane z = -core_radius, so within the outer sphere subtracting the
+    box is the same as keeping only the half-space above that plane. After rolling, the kept half-space is u.x <= r,
+    where u = -transform[:3, 2] is the (unit) direction from the center to the respective point of the spherical trace.
+
+    :return: Array of shape (N, 4) with the half-spaces in the format of scipy.spatial.HalfspaceIntersection, i.e.
+             rows [u_x, u_y, u_z, -r] of inequalities u.x - r <= 0
+    '''
+    halfspaces = np.empty(shape=(transforms.shape[0], 4))
+    halfspaces[:, :3] = -1 * transforms[:, :3, 2]
+    halfspaces[:, 3] = -1 * core_radius
+    return halfspaces
+
+
+def geosphere_halfspaces(geosphere):
+    '''Half-spaces (in scipy.spatial.HalfspaceIntersection format) whose intersection is the convex geosphere mesh'''
+    normals = geosphere.face_normals
+    offsets = np.einsum('ij,ij->i', normals, geosphere.triangles[:, 0, :])
+    return np.hstack((normals, -1 * offsets[:, None]))
+
+
+def support_of_two_cuts(directions, normal_a, normal_b, core_radius=1, outer_radius=1.25):
+    '''Support function h(u) = max u.x of the convex set {u_a.x <= r, u_b.x <= r, |x| <= R} (outer sphere cut by
+    two kept cutting planes), evaluated for all the unit vectors in array "directions" of shape (M, 3) at once.
+    The maximum lies either on the sphere surface inside both half-spaces, or on the circle where sphere meets one
+    of the planes, or at one of the two points where sphere meets both planes.'''
+    def feasible(points):
+        return (points @ normal_a <= core_radius + 1e-12) & (points @ normal_b <= core_radius + 1e-12)
+
+    circle_radius = np.sqrt(outer_radius ** 2 - core_radius ** 2)
+    support = np.full(directions.shape[0], -np.inf)
+
+    candidates = outer_radius * directions
+    support = np.where(feasible(candidates), outer_radius, support)
+
+    for normal in [normal_a, normal_b]:
+        in_plane = directions - np.outer(directions @ normal, normal)
+        in_plane_norms = np.linalg.norm(in_plane, axis=1)
+        in_plane = in_plane / np.where(in_plane_norms > 0, in_plane_norms, 1)[:, None]
+        candidates = core_radius * normal + circle_radius * in_plane
+        values = np.einsum('ij,ij->i', directions, candidates)
+        support = np.where(feasible(candidates), np.maximum(support, values), support)
+
+    # points where the sphere meets both planes
+    line_direction = np.cross(normal_a, normal_b)
+    sine_squared = np.dot(line_direction, line_direction)
+    if sine_squared > 1e-24:
+        cosine = np.dot(normal_a, normal_b)
+        point_on_line = core_radius / (1 + cosine) * (normal_a + normal_b)
+        half_chord_squared = outer_radius ** 2 - np.dot(point_on_line, point_on_line)
+        if half_chord_squared >= 0:
+            half_chord = np.sqrt(half_chord_squared / sine_squared) * line_direction
+            for candidate in [point_on_line + half_chord, point_on_line - half_chord]:
+                support = np.maximum(support, directions @ candidate)
+    return support
+
+
+@instrumentation.instrumented('mesh_export')
+def prune_cutting_transforms(transforms, tolerance, core_radius=1, outer_radius=1.25):
+    '''
+    Finds the cutting boxes that can be dropped without changing the final solid by more than a given tolerance.
+    Walks along the path and greedily skips as many boxes as possible between two kept boxes a and b. Skipped box i
+    is allowed if the sphere cut only by the planes of a and b does not protrude beyond the plane of box i by more
+    than the tolerance (support function test, see support_of_two_cuts()). The other kept boxes only shrink the
+    solid further, so this bound is conservative.
+
+    :param transforms: Array of shape (N, 4, 4), transforms of the cutting boxes (see compute_shape())
+    :param tolerance: Float. Maximum allowed protrusion of the final solid beyond the plane of any dropped box,
+                      in the same units as core_radius
+    :return: Tuple: integer array of indices of the kept boxes (first and last box are always kept) and the maximum
+             protrusion beyond the planes of the dropped boxes.
+    '''
+    normals = cutting_halfspaces(transforms, core_radius=core_radius)[:, :3]
+    number_of_boxes = normals.shape[0]
+
+    def protrusion(a, b):
+        return np.max(support_of_two_cuts(normals[a + 1:b], normals[a], normals[b],
+                                          core_radius=core_radius, outer_radius=outer_radius)) - core_radius
+
+    kept_indices = [0]
+    max_protrusion = 0
+    a = 0
+    while a < number_of_boxes - 1:
+        b = a + 1
+        protrusion_here = 0
+        while b + 1 < number_of_boxes:
+            candidate_protrusion = protrusion(a, b + 1)
+            if candidate_protrusion > tolerance:
+                break
+            protrusion_here = candidate_protrusion
+            b += 1
+        kept_indices.append(b)
+        max_protrusion = max(max_protrusion, protrusion_here)
+        a = b
+    logging.info(f'Pruning kept {len(kept_indices)} of {number_of_boxes} cutting boxes.')
+    return np.array(kept_indices), max_protrusion
+
+
+def convex_mesh_from_halfspaces(halfspaces, interior_point, decimals=9):
+    '''Convex polytope given by half-spaces (scipy.spatial.HalfspaceIntersection format) as a watertight mesh.
+    When more than three planes meet at a vertex, Qhull reports almost coincident copies of that vertex.
+    They are snapped together before making the convex hull, otherwise the hull gets slivers.'''
+    intersection = HalfspaceIntersection(halfspaces, interior_point=interior_point)
+    points = np.unique(np.round(intersection.intersections, decimals=decimals), axis=0)
+    return trimesh.convex.convex_hull(points), intersection
+
+
+@instrumentation.instrumented('mesh_export')
+def make_trajectoid_mesh(data0, kx=1, ky=1, core_radius=1, outer_radius=1.25, geosphere=None,
+                         geosphere_subdivisions=4, return_number_of_cuts=False, decimation_tolerance=None):
+    '''
+    Computes the trajectoid solid directly, without boolean operations in external software (OpenSCAD, 3ds Max).
+    The solid is the outer geosphere intersected with one half-space per cutting box (see cutting_halfspaces()),
+    which is a convex polytope. Half-spaces that do not contribute any facet are dropped by Qhull.
+
+    :param outer_radius: Float. Radius R of the outer sphere, in the same units as core_radius
+    :param geosphere: trimesh.Trimesh or None. Convex mesh of the unit sphere, for example
+                      trimesh.load('unit_geosphere.stl'). If None, an icosphere is used.
+    :param geosphere_subdivisions: Integer. Subdivisions of the icosphere used if geosphere is None.
+    :param return_number_of_cuts: Bool. Whether to also return the number of cutting planes that
+                                  actually make facets of the solid.
+    :param decimation_tolerance: Float or None. If not None, the path is first decimated, see compute_shape().
+    :return: Watertight trimesh.Trimesh of the trajectoid
+    '''
+    data = np.copy(data0)
+    data[:, 0] = data[:, 0] * kx
+    data[:, 1] = data[:, 1] * ky
+    if decimation_tolerance is not None:
+        data = decimate_path(data, decimation_tolerance)[0]
+    if geosphere is None:
+        geosphere = trimesh.creation.icosphere(subdivisions=geosphere_subdivisions)
+    geosphere = geosphere.copy()
+    geosphere.apply_scale(outer_radius)
+
+    cuts = cutting_halfspaces(rotations_to_origin(data), core_radius=core_radius)
+    # consecutive points of densely sampled paths often give exactly the same planes
+    cuts = np.unique(np.round(cuts, decimals=12), axis=0)
+    halfspaces = np.vstack((geosphere_halfspaces(geosphere), cuts))
+    # center of sphere is strictly inside the solid since core_radius > 0
+    trajectoid, intersection = convex_mesh_from_halfspaces(halfspaces, interior_point=np.zeros(3))
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug('Trajectoid mesh: %d vertices, watertight=%s', trajectoid.vertices.shape[0],
+                      trajectoid.is_watertight)
+
+    if return_number_of_cuts:
+        facet_halfspaces = np.unique(np.concatenate(intersection.dual_facets))
+        number_of_cuts = np.count_nonzero(facet_halfspaces >= geosphere.faces.shape[0])
+        return trajectoid, number_of_cuts
+    else:
+        return trajectoid
+
+
+def roll_trajectoid_mesh(trajectoid, core_radius=1, downhill_direction=(1, 0), rolling_distance=None,
+                         max_steps=100000, contact_tolerance=1e-7, return_orientations=False):
+    '''
+    Kinematic simulation of a trajectoid rolling without slipping on a tilted plane. Only the convex hull of the
+    mesh matters, since the plane touches nothing else. At the start the body frame coincides with the lab frame and
+    the body rests on the plane z = -core_radius, as for the first point of the path in compute_shape().
+
+    The body is a polytope, so rolling is a sequence of tilts about an edge of the contact polygon. The edge is the one
+    crossed by the ray from the center of the body going downhill. The tilt angle is found exactly by a single batched
+    query over all vertices: the first vertex that reaches the plane stops the tilt and becomes part of the
+    next contact polygon. The center is recorded after each tilt.
+
+    :param trajectoid: trimesh.Trimesh of the trajectoid, e.g. from make_trajectoid_mesh()
+    :param downhill_direction: Direction of the slope in the plane, in the xy coordinates of the path
+    :param rolling_distance: Float or None. The simulation stops when the body has rolled this distance, i.e. when
+                             the net angle of tilts times core_radius reaches it.
+    :param max_steps: Integer. Maximum number of tilts
+    :param contact_tolerance: Float. Vertices closer than this to the plane are in contact with it.
+    :param return_orientations: Bool. Whether to also return the rotation matrices of the body after each tilt.
+    :return: Array of shape (M, 2) with positions of center of the body, starting from [0, 0]. If
+             return_orientations is True, also an array of shape (M, 3, 3) of orientations.
+    '''
+    downhill = np.array(downhill_direction, dtype=float)
+    downhill /= np.linalg.norm(downhill)
+    body_vertices = trajectoid.vertices
+    orientation = np.eye(3)
+    center = np.array([0, 0, -1 * np.min(body_vertices[:, 2])])
+    centers = [center[:2]]
+    orientations = [orientation]
+    travelled_distance = 0
+    for step in range(max_steps):
+        vertices = body_vertices @ orientation.T + center
+        # keep the body touching the plane despite accumulation of rounding errors
+        center[2] -= np.min(vertices[:, 2])
+        vertices[:, 2] -= np.min(vertices[:, 2])
+        in_contact = vertices[:, 2] < contact_tolerance
+        contact_points = vertices[in_contact, :2]
+
+        # pivot line goes through pivot_point; tilting moves the center along tilt_direction (unit, in plane)
+        centroid = np.mean(contact_points, axis=0)
+        singular_values, principal_directions = np.linalg.svd(contact_points - centroid)[1:]
+        if contact_points.shape[0] == 1:
+            pivot_point = contact_points[0]
+            tilt_direction = downhill
+        elif singular_values.shape[0] < 2 or singular_values[1] < contact_tolerance:
+            # contact is a segment
+            pivot_point = centroid
+            tilt_direction = np.array([-1 * principal_directions[0, 1], principal_directions[0, 0]])
+            if np.dot(tilt_direction, downhill) < 0:
+                tilt_direction *= -1
+        else:
+            # contact polygon is convex, so its vertices are ordered by polar angle around its centroid
+            relative = contact_points - centroid
+            polygon = contact_points[np.argsort(np.arctan2(relative[:, 1], relative[:, 0]))]
+            edges = np.roll(polygon, -1, axis=0) - polygon
+            # solve center + t * downhill = polygon + s * edges for all edges at once
+            determinants = edges[:, 0] * downhill[1] - edges[:, 1] * downhill[0]
+            safe_determinants = np.where(np.abs(determinants) > 1e-15, determinants, 1e-15)
+            to_center = center[:2] - polygon
+            ts = (edges[:, 1] * to_center[:, 0] - edges[:, 0] * to_center[:, 1]) / safe_determinants
+            ss = (downhill[1] * to_center[:, 0] - downhill[0] * to_center[:, 1]) / safe_determinants
+            crossing = (np.abs(determinants) > 1e-15) & (ss >= -1e-9) & (ss <= 1 + 1e-9)
+            exit_edge = np.argmax(np.where(crossing, ts, -np.inf))
+            pivot_point = polygon[exit_edge]
+            tilt_direction = np.array([edges[exit_edge, 1], -1 * edges[exit_edge, 0]])
+            tilt_direction /= np.linalg.norm(tilt_direction)
+            if np.dot(tilt_direction, pivot_point - centroid) < 0:
+                tilt_direction *= -1
+
+        # Tilt by angle theta about the horizontal axis [-m_y, m_x, 0] through the pivot point. Height of each vertex
+        #   is then z(theta) = z cos(theta) + s sin(theta), which first reaches zero at theta = atan2(s, z) + pi/2
+        axis = np.array([-1 * tilt_direction[1], tilt_direction[0], 0])
+        relative = vertices - np.array([pivot_point[0], pivot_point[1], 0])
+        sines = axis[0] * relative[:, 1] - axis[1] * relative[:, 0]
+        thetas = np.arctan2(sines, relative[:, 2]) + np.pi / 2
+        thetas[in_contact | (np.abs(sines) + relative[:, 2] < contact_tolerance)] = np.inf
+        theta = np.min(thetas)
+        if not np.isfinite(theta):
+            logging.warning(f'Rolling simulation stalled at step {step}.')
+            break
+        # stop at the tilt that ends closest to the required rolling distance
+        if rolling_distance is not None and travelled_distance + theta * core_radius / 2 > rolling_distance:
+            break
+        rotation_matrix = trimesh.transformations.rotation_matrix(angle=theta, direction=axis,
+                                                                  point=[pivot_point[0], pivot_point[1], 0])
+        orientation = rotation_matrix[:3, :3] @ orientation
+        center = rotation_matrix[:3, :3] @ center + rotation_matrix[:3, 3]
+        # rolling distance is measured like for the core sphere: by the angle of rotation
+        travelled_distance += theta * core_radius
+        centers.append(center[:2])
+        orientations.append(orientation)
+    centers = np.array(centers)
+    if return_orientations:
+        return centers, np.array(orientations)
+    else:
+        return centers
+
+
+def polyline_segment_tree(polyline):
+    '''KD-tree over the midpoints of the segments of the polyline, for offsets_to_polyline()'''
+    polyline = np.asarray(polyline, dtype=float)
+    return cKDTree((polyline[1:] + polyline[:-1]) / 2)
+
+
+def offsets_to_polyline(points, polyline, tree=None):
+    '''
+    Vectors from the closest points of the polyline to the points. Only the segments that can contain the closest
+    point are checked: the closest point is not farther than the closest midpoint of a segment, and every point of
+    a segment is within half of the longest segment from its midpoint. These segments are found with the KD-tree
+    over the midpoints (see polyline_segment_tree()), which is built once and reused if given as tree.
+
+    :param points: Array of shape (N, 2) or (N, 3)
+    :param polyline: Array of shape (M, 2) or (M, 3), with at least two points
+    :return: Array of shape (N, 2) or (N, 3)
+    '''
+    points = np.asarray(points, dtype=float)
+    polyline = np.asarray(polyline, dtype=float)
+    if tree is None:
+        tree = polyline_segment_tree(polyline)
+    segment_starts = polyline[:-1]
+    segments = polyline[1:] - polyline[:-1]
+    squared_lengths = np.sum(segments ** 2, axis=1)
+    closest_midpoint_distances, _ = tree.query(points)
+    search_radii = (closest_midpoint_distances + np.sqrt(np.max(squared_lengths)) / 2) * (1 + 1e-9) + 1e-12
+    candidates = tree.query_ball_point(points, search_radii)
+    point_ids = np.repeat(np.arange(points.shape[0]), [len(segment_ids) for segment_ids in candidates])
+    segment_ids = np.concatenate([np.asarray(segment_ids, dtype=np.intp) for segment_ids in candidates])
+    relative = points[point_ids] - segment_starts[segment_ids]
+    fractions = np.clip(np.sum(relative * segments[segment_ids], axis=1) /
+                        np.where(squared_lengths[segment_ids] > 0, squared_lengths[segment_ids], 1), 0, 1)
+    offsets = relative - fractions[:, None] * segments[segment_ids]
+    # the closest candidate of every point
+    order = np.lexsort((np.sum(offsets ** 2, axis=1), point_ids))
+    _, first_of_each_point = np.unique(point_ids[order], return_index=True)
+    return offsets[order[first_of_each_point]]
+
+
+def distances_to_polyline(points, polyline, tree=None):
+    '''Distance from each of the points to the closest point of the polyline (see offsets_to_polyline())'''
+    return np.linalg.norm(offsets_to_polyline(points, polyline, tree=tree), axis=1)
+
+
+@instrumentation.instrumented('verification')
+def verify_rolling(data0, trajectoid, kx=1, ky=1, core_radius=1, downhill_direction=(1, 0), max_steps=100000):
+    '''
+    Rolls the trajectoid mesh (see roll_trajectoid_mesh()) over the length of the design path and compares
+    the path of its center with the design path.
+
+    :param data0: Design path, as passed to compute_shape() or make_trajectoid_mesh()
+    :param trajectoid: trimesh.Trimesh of the trajectoid for this path, with the same kx, ky and core_radius
+    :return: rolled_path, deviations. Path of the center of the rolling body in the coordinates of data0
+             scaled by kx, ky; and the distance of each of its points from the design path.
+    '''
+    data = np.copy(data0)
+    data[:, 0] = data[:, 0] * kx
+    data[:, 1] = data[:, 1] * ky
+    rolled_path = roll_trajectoid_mesh(trajectoid, core_radius=core_radius, downhill_direction=downhill_direction,
+                                       rolling_distance=length_of_the_path(data), max_steps=max_steps) + data[0]
+    deviations = distances_to_polyline(rolled_path, data)
+    logging.info(f'Rolled over {rolled_path.shape[0] - 1} edges, max deviation from the path is '
+                 f'{np.max(deviations):.2e}, deviation at the end is {np.linalg.norm(rolled_path[-1] - data[-1]):.2e}')
+    return rolled_path, deviations
 
 
 def plot_sphere(r0, line_radius, sphere_opacity=.8):
@@ -339,7 +1526,9 @@ def plot_sphere(r0, line_radius, sphere_opacity=.8):
             r * np.cos(phi) * np.ones_like(theta), tube_radius=line_radius)
 
 
+@instrumentation.instrumented('rolling')
 def trace_on_sphere(data0, kx, ky, core_radius=1, do_plot=False):
+    instrumentation.count('trace_evaluations')
     data = np.copy(data0)
     data[:, 0] = data[:, 0] * kx
     data[:, 1] = data[:, 1] * ky  # +  kx * np.sin(data0[:, 0]/2)
@@ -371,6 +1560,35 @@ def trace_on_sphere(data0, kx, ky, core_radius=1, do_plot=False):
     return sphere_trace
 
 
+@instrumentation.instrumented('rolling')
+def traces_on_sphere_for_scales(data0, scales, core_radius=1, max_batch_elements=2 ** 22):
+    '''
+    Same as trace_on_sphere(scale * data0, kx=1, ky=1) for all the scales at once: rotations of all steps are built
+    together and accumulated by a batched prefix product, up to max_batch_elements steps at a time.
+
+    :return: Array of shape (len(scales), N, 3)
+    '''
+    scales = np.atleast_1d(scales)
+    instrumentation.count('trace_evaluations', scales.shape[0])
+    steps0 = data0[:-1] - data0[1:]
+    traces = np.empty(shape=(scales.shape[0], data0.shape[0], 3))
+    batch_size = max(1, max_batch_elements // data0.shape[0])
+    for batch_start in range(0, scales.shape[0], batch_size):
+        batch_scales = scales[batch_start:batch_start + batch_size]
+        rotations = np.zeros(shape=(batch_scales.shape[0], data0.shape[0], 3, 3))
+        rotations[:, 0] = np.eye(3)
+        rotations[:, 1:] = rotations_for_steps((batch_scales[:, None, None] * steps0[None, :, :]).reshape(-1, 2)
+                                               ).reshape(batch_scales.shape[0], -1, 3, 3)
+        # inclusive prefix product along the path, as in rotations_to_origin()
+        offset = 1
+        while offset < data0.shape[0]:
+            rotations[:, offset:] = rotations[:, :-offset] @ rotations[:, offset:]
+            offset *= 2
+        # rotated point [0, 0, -core_radius] is the last column of the rotation times -core_radius
+        traces[batch_start:batch_start + batch_size] = -1 * core_radius * rotations[:, :, :, 2]
+    return traces
+
+
 def trace_on_sphere_nonocontact_point(data0, kx, ky, core_radius=1, do_plot=False, startpoint=[0, 0, -1]):
     data = np.copy(data0)
     data[:, 0] = data[:, 0] * kx
@@ -403,6 +1621,7 @@ def trace_on_sphere_nonocontact_point(data0, kx, ky, core_radius=1, do_plot=Fals
     return sphere_trace
 
 
+@instrumentation.instrumented('rolling')
 def path_from_trace(sphere_trace, core_radius=1):
     sphere_trace_cloud = trimesh.PointCloud(sphere_trace)
     translation_vectors = []
@@ -440,9 +1659,12 @@ def path_from_trace(sphere_trace, core_radius=1):
     return position_vectors
 
 
-def plot_three_path_periods(input_path, savetofile=False, plot_midpoints=False):
+@instrumentation.instrumented('plotting')
+def plot_three_path_periods(input_path, savetofile=False, plot_midpoints=False, pixel_size=None):
     figtraj = plt.figure(10, figsize=(10, 5))
     dataxlen = np.max(input_path[:, 0])
+    if pixel_size is None:
+        pixel_size = axes_pixel_size(plt.gca(), np.vstack((input_path, input_path + np.array([3 * dataxlen, 0]))))
 
     def plot_periods(data, linestyle, linewidth):
         plt.plot(data[:, 0], data[:, 1], color='black', alpha=1, linestyle=linestyle, linewidth=linewidth)
@@ -453,7 +1675,7 @@ def plot_three_path_periods(input_path, savetofile=False, plot_midpoints=False):
                  linewidth=linewidth)
 
     # plot_periods(data, '--', linewidth=0.5)
-    plot_periods(input_path, '-', linewidth=1)
+    plot_periods(input_path[decimate_polyline_for_display(input_path, pixel_size)], '-', linewidth=1)
     # plot_periods(projection_centers, '-', linewidth=1)
 
     for shift in dataxlen * np.arange(3):
@@ -615,7 +1837,11 @@ def make_corner_bridge_candidate(input_declination_angle, input_path, npoints, d
     return input_path_with_bridge
 
 
+@instrumentation.instrumented('rolling')
 def mismatch_angle_for_path(input_path, recursive=False, use_cache=False):
+    instrumentation.count('net_rotation_evaluations')
+    if isinstance(input_path, PeriodicPath):
+        return trimesh.transformations.rotation_from_matrix(input_path.net_rotation())[0]
     rotation_of_entire_traj = trimesh.transformations.rotation_from_matrix(
         rotation_to_origin(input_path.shape[0] - 1, input_path, recursive=recursive, use_cache=use_cache))
     angle = rotation_of_entire_traj[0]
@@ -661,6 +1887,7 @@ def mismatch_angle_for_smooth_bridge(declination_angle, input_path, npoints=30,
         return angle
 
 
+@instrumentation.instrumented('bridges')
 def find_best_smooth_bridge(input_path, npoints=30, do_plot=True, max_declination=np.pi / 180 * 80,
                             min_curvature_radius=0.2):
     declination_angles = np.linspace(-max_declination, max_declination, 20)
@@ -668,7 +1895,7 @@ def find_best_smooth_bridge(input_path, npoints=30, do_plot=True, max_declinatio
     for i, declination_angle in enumerate(declination_angles):
         mismatches.append(mismatch_angle_for_smooth_bridge(declination_angle, input_path, npoints=npoints,
                                                            min_curvature_radius=min_curvature_radius))
-        logging.debug(f'Preliminary screening, step {i} completed')
+        logging.debug('Preliminary screening, step %d completed', i)
     mismatches = np.array(mismatches)
     # use split by mask here and find roots in each subsection
     mask_here = mismatches[:, 1]
@@ -689,25 +1916,27 @@ def find_best_smooth_bridge(input_path, npoints=30, do_plot=True, max_declinatio
         position = np.argmax(declination_angles > initial_guess)
         maxangle = declination_angles[position]
         minangle = declination_angles[position - 1]
-        logging.debug(f'Sign-changing interval: from {minangle} to {maxangle}')
+        logging.debug('Sign-changing interval: from %s to %s', minangle, maxangle)
         # initial_guess = declination_angles[np.argmin(np.abs(np.array(mismatches)))]
-        logging.debug(f'Initial guess: {initial_guess}')
+        logging.debug('Initial guess: %s', initial_guess)
         if do_plot:
             # mlab.show()
             plt.plot(declination_angles, mismatches, 'o-')
             plt.show()
 
         def left_hand_side(x):  # the function whose root we want to find
-            logging.debug(f'Sampling function at x={x}')
+            logging.debug('Sampling function at x=%s', x)
             return mismatch_angle_for_smooth_bridge(x, input_path, npoints=npoints, return_error_messages=False,
                                                     min_curvature_radius=min_curvature_radius)
 
         best_declination = brentq(left_hand_side, a=minangle, b=maxangle, maxiter=20, xtol=0.001, rtol=0.004)
-        logging.debug(f'Best declination: {best_declination}')
-        logging.debug(f'Best mismatch: {left_hand_side(best_declination)}')
+        logging.debug('Best declination: %s', best_declination)
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug('Best mismatch: %s', left_hand_side(best_declination))
         return best_declination
 
 
+@instrumentation.instrumented('bridges')
 def make_smooth_bridge_candidate(input_declination_angle, input_path, npoints, min_curvature_radius=0.2,
                                  do_plot=True, mlab_show=False, make_animation=False,
                                  default_forward_angle='downward',
@@ -745,8 +1974,8 @@ def make_smooth_bridge_candidate(input_declination_angle, input_path, npoints, m
         default_backward_angle = sign_here * unsigned_angle_between_vectors(axis_at_first_point, axis_of_direct_bridge)
 
     forward_declination_angle = filter_forward_declination(input_declination_angle - default_forward_angle, input_path)
-    print(
-        f'Forward angle:  raw={input_declination_angle}, plusdef={input_declination_angle - default_forward_angle}, filtered={forward_declination_angle}')
+    logging.debug('Forward angle:  raw=%s, plusdef=%s, filtered=%s', input_declination_angle,
+                  input_declination_angle - default_forward_angle, forward_declination_angle)
     turn_angle_increment = forward_declination_angle / npoints
     geodesic_length_of_single_step = np.abs(min_curvature_radius * forward_declination_angle / npoints)
     point_here = np.copy(sphere_trace[-1])
@@ -763,8 +1992,8 @@ def make_smooth_bridge_candidate(input_declination_angle, input_path, npoints, m
         axis_at_last_point = np.cross(sphere_trace[0], sphere_trace[1])
         backward_declination_angle = filter_backward_declination(input_declination_angle - default_backward_angle,
                                                                  input_path)
-        print(
-            f'Backward angle: raw={input_declination_angle},  plusdef={input_declination_angle - default_backward_angle}, filtered={backward_declination_angle}')
+        logging.debug('Backward angle: raw=%s,  plusdef=%s, filtered=%s', input_declination_angle,
+                      input_declination_angle - default_backward_angle, backward_declination_angle)
         turn_angle_increment = backward_declination_angle / npoints
         geodesic_length_of_single_step = np.abs(min_curvature_radius * backward_declination_angle / npoints)
         point_here = np.copy(sphere_trace[0])
@@ -803,13 +2032,13 @@ def make_smooth_bridge_candidate(input_declination_angle, input_path, npoints, m
         # backward_sign2 = np.dot(backward_arc_points[-1] - sphere_trace[0], reference_plane_normal2)
     if (forward_sign1 * backward_sign1 < 0):  # or (forward_sign2 * backward_sign2 < 0):
         # if still not on same side even despite the sign flip
-        print('Deflections are never on the same side. Escaping.')
+        logging.debug('Deflections are never on the same side. Escaping.')
         res = input_path
         is_successful = False
     else:
-        pd = pairwise_distances(forward_arc_points, backward_arc_points)
+        pd = sklearn_metrics.pairwise_distances(forward_arc_points, backward_arc_points)
         if np.min(pd) < 2 * geodesic_length_of_single_step:
-            print('Intersection of forward and backward arcs. Escaping.')
+            logging.debug('Intersection of forward and backward arcs. Escaping.')
             res = input_path
             is_successful = False
         else:
@@ -839,7 +2068,7 @@ def make_smooth_bridge_candidate(input_declination_angle, input_path, npoints, m
             backward_straight_section_length = geodesic_length_from_intersection_to_backward_arc - \
                                                geodesic_length_from_intersection_to_tangent_of_main_arc
             if (forward_straight_section_length <= 0) or (backward_straight_section_length <= 0):
-                print('Impossible to make main arc: intersection too close. Escaping')
+                logging.debug('Impossible to make main arc: intersection too close. Escaping')
                 res = input_path
                 is_successful = False
             else:
@@ -884,7 +2113,7 @@ def make_smooth_bridge_candidate(input_declination_angle, input_path, npoints, m
 
                 backward_straight_section_points = backward_straight_section_points[::-1]
                 backward_arc_points = backward_arc_points[::-1]
-                if True:
+                if do_plot:
                     core_radius = 1
                     mfig = mlab.figure(size=(1024, 768), bgcolor=(1, 1, 1), fgcolor=(0.5, 0.5, 0.5))
                     tube_radius = 0.01
@@ -936,17 +2165,25 @@ def make_smooth_bridge_candidate(input_declination_angle, input_path, npoints, m
                 if spherical_trace_is_self_intersecting(trace_with_bridge):
                     res = input_path
                     is_successful = False
-                    print('Self-intersection of whole trace_with_bridge. Escaping.')
+                    logging.debug('Self-intersection of whole trace_with_bridge. Escaping.')
                 else:
                     res = path_from_trace(trace_with_bridge)
                     is_successful = True
     return res, is_successful
 
 
-def plot_bridged_path(path, savetofilename=False, npoints=30, netscale=1, linewidth=5):
+@instrumentation.instrumented('plotting')
+def plot_bridged_path(path, savetofilename=False, npoints=30, netscale=1, linewidth=5, pixel_size=None):
     fig, ax = plt.subplots(figsize=(12, 2))
     alphabridge = 0.3
     bridgelen = npoints * 5 - 5
+    if pixel_size is None:
+        pixel_size = axes_pixel_size(ax, np.array([[-8, 0], [-8 + 35 * netscale, 0]]))
+
+    def plot_part(part, dx, dy, **kwargs):
+        part = part[decimate_polyline_for_display(part, pixel_size)]
+        plt.plot(part[:, 0] + dx, part[:, 1] + dy, '-', **kwargs)
+
     dxs = [0,
            - path[-1, 0],
            path[-1, 0],
@@ -962,20 +2199,13 @@ def plot_bridged_path(path, savetofilename=False, npoints=30, netscale=1, linewi
             alpha = 1
         else:
             alpha = 1
-        plt.plot(path[:, 0] + dx,
-                 path[:, 1] + dy, '-', alpha=alpha, color='black', linewidth=1, zorder=10)
-        plt.plot(path[-(bridgelen):, 0] + dx,
-                 path[-(bridgelen):, 1] + dy, '-', alpha=alphabridge, color='C1', linewidth=linewidth)
-        plt.plot(path[-(bridgelen):-(bridgelen) + npoints - 1, 0] + dx,
-                 path[-(bridgelen):-(bridgelen) + npoints - 1, 1] + dy, '-', alpha=alphabridge, color='red',
-                 linewidth=linewidth)
-        plt.plot(path[-(bridgelen) + npoints * 2 - 2:-(bridgelen) + npoints * 3 - 3, 0] + dx,
-                 path[-(bridgelen) + npoints * 2 - 2:-(bridgelen) + npoints * 3 - 3, 1] + dy, '-', alpha=alphabridge,
-                 color='red',
-                 linewidth=linewidth)
-        plt.plot(path[-(npoints - 1):, 0] + dx,
-                 path[-(npoints - 1):, 1] + dy, '-', alpha=alphabridge, color='red',
-                 linewidth=linewidth)
+        plot_part(path, dx, dy, alpha=alpha, color='black', linewidth=1, zorder=10)
+        plot_part(path[-(bridgelen):], dx, dy, alpha=alphabridge, color='C1', linewidth=linewidth)
+        plot_part(path[-(bridgelen):-(bridgelen) + npoints - 1], dx, dy, alpha=alphabridge, color='red',
+                  linewidth=linewidth)
+        plot_part(path[-(bridgelen) + npoints * 2 - 2:-(bridgelen) + npoints * 3 - 3], dx, dy, alpha=alphabridge,
+                  color='red', linewidth=linewidth)
+        plot_part(path[-(npoints - 1):], dx, dy, alpha=alphabridge, color='red', linewidth=linewidth)
     plt.scatter([path[0, 0], path[-1, 0], path[0, 0] + 2 * path[-1, 0]], [path[0, 1], path[-1, 1], 2 * path[-1, 1]],
                 s=35, alpha=0.8, color='black', zorder=100)
     # plt.scatter([path[0, 0], path[-1, 0]], [path[0, 1], path[-1, 1]], s=35, alpha=0.8, color='black', zorder=100)
@@ -990,12 +2220,16 @@ def plot_bridged_path(path, savetofilename=False, npoints=30, netscale=1, linewi
 
 def make_random_path(Npath=150, amplitude=2, x_span_in_2pis=0.8, seed=1, make_ends_horizontal=False,
                      start_from_zero=True,
-                     end_with_zero=False, savgom_window_1=31, savgol_window_2=7):
-    np.random.seed(seed)
+                     end_with_zero=False, savgom_window_1=31, savgol_window_2=7, rng=None):
+    # If rng (np.random.Generator) is given, it is used instead of the global random state seeded by seed
     xs = np.linspace(0, 2 * np.pi * x_span_in_2pis, Npath)
-    ys = np.random.rand(Npath)
-    ys = savgol_filter(amplitude * ys, savgom_window_1, 3)
-    ys = savgol_filter(ys, savgol_window_2, 1)
+    if rng is None:
+        np.random.seed(seed)
+        ys = np.random.rand(Npath)
+    else:
+        ys = rng.random(Npath)
+    ys = scipy_signal.savgol_filter(amplitude * ys, savgom_window_1, 3)
+    ys = scipy_signal.savgol_filter(ys, savgol_window_2, 1)
     if start_from_zero:
         ys = ys - ys[0]
     if end_with_zero:
@@ -1043,6 +2277,7 @@ def get_scale_that_minimizes_end_to_end(input_path, minimal_scale=0.1):
     return solution.x
 
 
+@instrumentation.instrumented('root_finding')
 def minimize_mismatch_by_scaling(input_path_0, scale_range=(0.8, 1.2)):
     scale_max = scale_range[1]
     scale_min = scale_range[0]
@@ -1054,50 +2289,185 @@ def minimize_mismatch_by_scaling(input_path_0, scale_range=(0.8, 1.2)):
         return False
 
     def left_hand_side(x):  # the function whose root we want to find
-        logging.debug(f'Sampling function at x={x}')
+        logging.debug('Sampling function at x=%s', x)
         return mismatch_angle_for_path(input_path_0 * x)
 
     best_scale = brentq(left_hand_side, a=scale_min, b=scale_max, maxiter=80, xtol=0.00001, rtol=0.00005)
-    logging.debug(f'Minimized mismatch angle = {left_hand_side(best_scale)}')
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug('Minimized mismatch angle = %s', left_hand_side(best_scale))
     return best_scale
 
 
-def double_the_path(input_path_0, do_plot=False, do_sort=True):
-    # input_path_0 = input_path
-    input_path_1 = np.copy(input_path_0)
-    # input_path_1[:,0] = 2*input_path_1[-1,0]-input_path_1[:,0]
-    input_path_1[:, 0] = input_path_1[-1, 0] + input_path_1[:, 0]
-    # input_path_1[:,1] = -1*input_path_1[:,1]
+class PeriodicPath:
+    '''
+    Lazy view of a path made of number_of_periods consecutive copies of one period, each shifted by offset
+    relative to the previous one. Like in double_the_path_nosort() of existence-testing.py, the path contains all
+    points of the first period and points [1:] of each of the following copies (double_the_path() additionally sorts
+    the points by x, which gives the same path if the period is sorted by x, and returns this PeriodicPath if lazy).
+    No copies are made: points are computed on indexing, and the full array is only built when numpy asks for it
+    (np.asarray(periodic_path)).
+
+    Rolling functions rotations_to_origin() and mismatch_angle_for_path() use the periodicity directly, so
+    that the net rotation costs one period of rolling plus a matrix power.
+    '''
+
+    def __init__(self, period, number_of_periods=2, offset=None):
+        '''
+        :param period: Array of shape (N, 2)
+        :param number_of_periods: Integer
+        :param offset: Shift between consecutive periods. If None, it is period[-1] - period[0], which makes
+                       the path continuous. double_the_path() and multiply_the_path() shift only along x,
+                       by (period[-1, 0], 0).
+        '''
+        self.period = np.asarray(period, dtype=float)
+        self.number_of_periods = number_of_periods
+        if offset is None:
+            offset = self.period[-1] - self.period[0]
+        self.offset = np.asarray(offset, dtype=float)
+
+    def __len__(self):
+        return self.number_of_periods * (self.period.shape[0] - 1) + 1
+
+    @property
+    def shape(self):
+        return len(self), self.period.shape[1]
+
+    @property
+    def period_offsets(self):
+        '''Shift of each of the periods, array of shape (number_of_periods, 2)'''
+        return np.arange(self.number_of_periods)[:, None] * self.offset
+
+    def points(self, indices):
+        '''Points at the given integer indices (negative indices count from the end).'''
+        indices = np.asarray(indices)
+        indices = np.where(indices < 0, indices + len(self), indices)
+        if np.any((indices < 0) | (indices >= len(self))):
+            raise IndexError('Index out of range of the periodic path')
+        period_indices = np.maximum(indices - 1, 0) // (self.period.shape[0] - 1)
+        local_indices = np.where(indices > 0, (indices - 1) % (self.period.shape[0] - 1) + 1, 0)
+        return self.period[local_indices] + period_indices[..., None] * self.offset
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            rows = self[key[0]]
+            if rows.ndim == 1:
+                return rows[key[1:]]
+            return rows[(slice(None),) + key[1:]]
+        if isinstance(key, slice):
+            return self.points(np.arange(*key.indices(len(self))))
+        return self.points(key)
+
+    def __iter__(self):
+        yield self.period[0]
+        for period_offset in self.period_offsets:
+            for point in self.period[1:]:
+                yield point + period_offset
+
+    def __array__(self, dtype=None, copy=None):
+        full_path = np.vstack((self.period[:1],
+                               (self.period[None, 1:] + self.period_offsets[:, None, :]).reshape(-1, 2)))
+        return full_path if dtype is None else full_path.astype(dtype)
+
+    def __mul__(self, factor):
+        return PeriodicPath(self.period * factor, self.number_of_periods, self.offset * factor)
+
+    __rmul__ = __mul__
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        # scaling by numpy scalars (e.g. np.float64(s) * periodic_path) keeps the lazy view;
+        # all other ufuncs work on the full array
+        if ufunc is np.multiply and method == '__call__' and len(inputs) == 2 and not kwargs:
+            factor = inputs[1] if inputs[0] is self else inputs[0]
+            if np.ndim(factor) == 0:
+                return self * factor
+        inputs = tuple(np.asarray(x) if isinstance(x, PeriodicPath) else x for x in inputs)
+        return getattr(ufunc, method)(*inputs, **kwargs)
+
+    def steps(self, period_index=0):
+        '''Step vectors (current point minus previous point) leading to the points of the given period.
+        All periods but the first start with the step from the last point of the previous period.'''
+        period_steps = np.diff(self.period, axis=0)
+        if period_index > 0:
+            period_steps[0] = self.period[1] + self.offset - self.period[-1]
+        return period_steps
+
+    def rotations_to_origin(self):
+        '''Same as rotations_to_origin() of the full path, with each period rolled only once.'''
+        first_period = np.zeros(shape=(self.period.shape[0], 3, 3))
+        first_period[0] = np.eye(3)
+        first_period[1:] = rotations_for_steps(-1 * self.steps(0))
+        later_period = rotations_for_steps(-1 * self.steps(1))
+        for rotations in [first_period, later_period]:
+            offset = 1
+            while offset < rotations.shape[0]:
+                rotations[offset:] = rotations[:-offset] @ rotations[offset:]
+                offset *= 2
+        rotations = [first_period]
+        for period_index in range(1, self.number_of_periods):
+            rotations.append(rotations[-1][-1] @ later_period)
+        net_rotation_matrices = np.zeros(shape=(len(self), 4, 4))
+        net_rotation_matrices[:, :3, :3] = np.concatenate(rotations, axis=0)
+        net_rotation_matrices[:, 3, 3] = 1
+        return net_rotation_matrices
+
+    def net_rotation(self):
+        '''Net rotation after rolling along the whole path, as 4x4 matrix (see rotation_to_origin()).'''
+        first_period = reduce(np.matmul, rotations_for_steps(-1 * self.steps(0)))
+        later_period = reduce(np.matmul, rotations_for_steps(-1 * self.steps(1)))
+        net_rotation_matrix = trimesh.transformations.identity_matrix()
+        net_rotation_matrix[:3, :3] = first_period @ np.linalg.matrix_power(later_period, self.number_of_periods - 1)
+        return net_rotation_matrix
+
+
+def _copies_are_sorted_by_x(period, m):
+    '''True if m copies of the period, the k-th of them shifted by k * period[-1, 0] along x and without its first
+    point, follow each other in the order of x, so that sorting the multiplied path would not reorder the points.'''
+    shifts = np.arange(m) * period[-1, 0]
+    return period.shape[0] > 1 and np.all(np.diff(period[:, 0]) >= 0) and \
+        np.all(period[-1, 0] + shifts[:-1] <= period[1, 0] + shifts[1:])
+
+
+def multiply_the_path(input_path_0, m, do_plot=False, do_sort=True, lazy=False):
+    '''
+    Path made of m copies of input_path_0, the k-th of them shifted by k * input_path_0[-1, 0] along x, sorted by x.
+    Of each shifted copy, the point with the smallest x is dropped. The result is sorted in any case; do_sort is
+    kept for compatibility.
+
+    If the period is sorted by x (as are the random and penannular paths), sorting changes nothing, and this is
+    the path PeriodicPath(input_path_0, m, offset=(input_path_0[-1, 0], 0)). It is then built without sorting,
+    and returned as this PeriodicPath instead of an array if lazy.
+    '''
+    input_path_0 = np.asarray(input_path_0)
+    if _copies_are_sorted_by_x(input_path_0, m):
+        periodic_path = PeriodicPath(input_path_0, m, offset=(input_path_0[-1, 0], 0))
+        return periodic_path if lazy else np.asarray(periodic_path)
+    pieces = [input_path_0]
+    for i in range(m - 1):
+        input_path_to_append = np.copy(input_path_0)
+        input_path_to_append[:, 0] = (i + 1) * input_path_0[-1, 0] + input_path_0[:, 0]
+        pieces.append(sort_path(input_path_to_append)[1:, ])
+    return sort_path(np.concatenate(pieces, axis=0))
+
 
-    # input_path_1 = np.concatenate((input_path_0, np.flipud))
+def double_the_path(input_path_0, do_plot=False, do_sort=True, lazy=False):
+    '''
+    Path made of input_path_0 followed by its copy shifted by input_path_0[-1, 0] along x, sorted by x. Of the shifted
+    copy, the point with the smallest x is dropped. See multiply_the_path() for do_sort and lazy.
+    '''
     if do_plot:
         plt.plot(input_path_0[:, 0], input_path_0[:, 1], '-', color='C2')  # , label='Asymmetric')
-        plt.plot(input_path_1[:, 0], input_path_1[:, 1], '-', color='C0')
+        plt.plot(input_path_0[-1, 0] + input_path_0[:, 0], input_path_0[:, 1], '-', color='C0')
         plt.axis('equal')
         # plt.legend(loc='upper left')
         plt.show()
 
-    input_path_0 = np.concatenate((input_path_0, sort_path(input_path_1)[1:, ]), axis=0)
-    if do_sort:
-        input_path_0 = sort_path(input_path_0)
+    doubled_path = multiply_the_path(input_path_0, 2, do_sort=do_sort, lazy=lazy)
     if do_plot:
-        plt.plot(input_path_0[:, 0], input_path_0[:, 1], '-o', alpha=0.5)
+        plt.plot(doubled_path[:, 0], doubled_path[:, 1], '-o', alpha=0.5)
         plt.axis('equal')
         plt.show()
 
-    return sort_path(input_path_0)
-
-
-def multiply_the_path(input_path_0, m, do_plot=False, do_sort=True):
-    input_path_to_append = np.copy(input_path_0)
-    multiplied_path = np.copy(input_path_0)
-    for i in range(m - 1):
-        input_path_to_append[:, 0] = (i + 1) * input_path_0[-1, 0] + input_path_0[:, 0]
-        # input_path_to_append[:,1] = -1*input_path_to_append[:,1]
-        multiplied_path = np.concatenate((multiplied_path, sort_path(input_path_to_append)[1:, ]), axis=0)
-    if do_sort:
-        multiplied_path = sort_path(multiplied_path)
-    return sort_path(multiplied_path)
+    return doubled_path
 
 
 ## This old implementation is wrong by a integer number of 2*pi
@@ -1145,8 +2515,8 @@ def get_gb_area_deprecated(input_path):
         sum_angle += angle
         gauss_bonnet_area = 2 * np.pi - sum_angle
     # print(angles)
-    logging.debug(f'Sum angle = {sum_angle / np.pi} pi')
-    logging.debug(f'Area = {gauss_bonnet_area / np.pi} pi')
+    logging.debug('Sum angle = %s pi', sum_angle / np.pi)
+    logging.debug('Area = %s pi', gauss_bonnet_area / np.pi)
     return gauss_bonnet_area
 
 
@@ -1159,6 +2529,7 @@ def plot_3d_vector_with_origin(vector, vector_origin, color, tube_radius=0.05):
                 points[:, 2], color=color, tube_radius=tube_radius / 5, opacity=0.7)
 
 
+@instrumentation.instrumented('areas')
 def get_gb_area(input_path, flat_path_change_of_direction='auto', do_plot=False, return_arc_normal=False):
     '''This function does not take into account the possibly changing rotation index of the spherical trace.
     It has to be accounted for in the downstream code.'''
@@ -1222,13 +2593,13 @@ def get_gb_area(input_path, flat_path_change_of_direction='auto', do_plot=False,
 
     # change of direction computed from the flat path angles
     net_change_of_direction = flat_path_change_of_direction
-    logging.debug(f'Flat path change of direction = {net_change_of_direction / np.pi} pi')
+    logging.debug('Flat path change of direction = %s pi', net_change_of_direction / np.pi)
 
     # change of direction from end of trace to the connecting arc
     net_change_of_direction += get_signed_change_of_direction_at_point(path_end_arc_normal,
                                                                        normal_of_arc_connecting_trace_ends,
                                                                        sphere_trace[-1])
-    logging.debug(f'Net change of direction path with first angle to arc = {net_change_of_direction / np.pi} pi')
+    logging.debug('Net change of direction path with first angle to arc = %s pi', net_change_of_direction / np.pi)
 
     # change of direction from connecting arc to the start of trace
     net_change_of_direction += get_signed_change_of_direction_at_point(normal_of_arc_connecting_trace_ends,
@@ -1237,8 +2608,8 @@ def get_gb_area(input_path, flat_path_change_of_direction='auto', do_plot=False,
 
     gauss_bonnet_area = 2 * np.pi - net_change_of_direction
     # print(angles)
-    logging.debug(f'Net change of direction = {net_change_of_direction / np.pi} pi')
-    logging.debug(f'Area = {gauss_bonnet_area / np.pi} pi')
+    logging.debug('Net change of direction = %s pi', net_change_of_direction / np.pi)
+    logging.debug('Area = %s pi', gauss_bonnet_area / np.pi)
 
     if do_plot:
         plot_3d_vector_with_origin(vector=path_start_direction_vector, vector_origin=np.array([0, 0, -1]),
@@ -1257,8 +2628,10 @@ def get_gb_area(input_path, flat_path_change_of_direction='auto', do_plot=False,
         return gauss_bonnet_area
 
 
+@instrumentation.instrumented('areas')
 def gb_areas_for_all_scales(input_path, minscale=0.01, maxscale=2, nframes=100, exclude_legitimate_discont=False,
-                            adaptive_sampling=True, diff_thresh=2 * np.pi * 0.1, max_number_of_subdivisions=15):
+                            adaptive_sampling=True, diff_thresh=2 * np.pi * 0.1, max_number_of_subdivisions=15,
+                            verbose=True):
     '''This function takes into account the possibly changing rotation index of the spherical trace.'''
     gauss_bonnet_areas = []
     connecting_arc_axes = []
@@ -1271,8 +2644,9 @@ def gb_areas_for_all_scales(input_path, minscale=0.01, maxscale=2, nframes=100,
                   for i in range(input_path.shape[0] - 2)
                   ]))
 
-    for frame_id, scale in enumerate(tqdm(sweeped_scales, desc='Computing oriented (Gauss-Bonnet) areas')):
-        logging.debug(f'Computing GB_area for scale {scale}')
+    for frame_id, scale in enumerate(tqdm(sweeped_scales, desc='Computing oriented (Gauss-Bonnet) areas',
+                                          disable=not verbose)):
+        logging.debug('Computing GB_area for scale %s', scale)
         input_path_scaled = input_path * scale
         gb_area_here, arc_axis, end_to_end = get_gb_area(input_path_scaled,
                                                          flat_path_change_of_direction,
@@ -1285,7 +2659,7 @@ def gb_areas_for_all_scales(input_path, minscale=0.01, maxscale=2, nframes=100,
 
     if adaptive_sampling:
         for subdivision_iteration in range(max_number_of_subdivisions):
-            logging.debug(f'Subvidision iteration: {subdivision_iteration}')
+            logging.debug('Subvidision iteration: %d', subdivision_iteration)
             area_diff = np.diff(gauss_bonnet_areas)
             if np.max(area_diff) < diff_thresh:
                 break
@@ -1298,7 +2672,7 @@ def gb_areas_for_all_scales(input_path, minscale=0.01, maxscale=2, nframes=100,
                 if np.abs(area_diff[i]) > diff_thresh:
                     insert_before_indices.append(i + 1)
                     new_scale_here = (sweeped_scales[i] + sweeped_scales[i + 1]) / 2
-                    logging.debug(f'Sampling at new scale {new_scale_here}')
+                    logging.debug('Sampling at new scale %s', new_scale_here)
                     insert_scales.append(new_scale_here)
                     if not exclude_legitimate_discont:
                         gb_area_here, arc_axis, end_to_end = get_gb_area(input_path * new_scale_here,
@@ -1359,6 +2733,143 @@ def gb_areas_for_all_scales(input_path, minscale=0.01, maxscale=2, nframes=100,
     return sweeped_scales, gb_areas
 
 
+def existence_of_two_period_trajectoid(input_path_single_section, minscale=0.01, maxscale=2, nframes=100):
+    '''
+    Tests whether a two-period trajectoid exists for this period of the path, as test_trajectoid_existence() in
+    existence-testing.py does, but without plotting: the root of mismatch angle is searched for between the scales
+    where Gauss-Bonnet area of the first period first crosses pi.
+
+    :return: Tuple (exists, best_scale). best_scale is np.nan if the trajectoid does not exist.
+    '''
+    sweeped_scales, gb_areas = gb_areas_for_all_scales(input_path_single_section, minscale=minscale,
+                                                       maxscale=maxscale, nframes=nframes, verbose=False)
+    area_exceeds_pi = np.abs(gb_areas) > np.pi
+    if not np.any(area_exceeds_pi):
+        return False, np.nan
+    index_where_area_crosses_pi = np.argmax(area_exceeds_pi)
+    range_for_searching_the_roots = (sweeped_scales[max(index_where_area_crosses_pi - 1, 0)],
+                                     sweeped_scales[index_where_area_crosses_pi])
+    periodic_path = PeriodicPath(input_path_single_section, 2, offset=(input_path_single_section[-1, 0], 0))
+    best_scale = minimize_mismatch_by_scaling(periodic_path, scale_range=range_for_searching_the_roots)
+    if best_scale is False:
+        return False, np.nan
+    return True, best_scale
+
+
+def existence_for_seed(task):
+    '''
+    One task of run_existence_ensemble(): makes the path for this seed from its own random stream and tests the
+    existence of the trajectoid for it.
+
+    :param task: Tuple (path_generator, generator_kwargs, entropy, seed, existence_kwargs)
+    :return: Dictionary with seed, exists, best_scale, sigma (path length over 2*pi*r at best scale), length
+             and elapsed time in seconds
+    '''
+    path_generator, generator_kwargs, entropy, seed, existence_kwargs = task
+    t0 = time.time()
+    rng = np.random.default_rng([entropy, seed])
+    input_path_single_section = path_generator(rng=rng, **generator_kwargs)
+    exists, best_scale = existence_of_two_period_trajectoid(input_path_single_section, **existence_kwargs)
+    length = length_of_the_path(input_path_single_section)
+    # the sphere has unit radius and the path is scaled by best_scale
+    return {'seed': seed, 'exists': exists, 'best_scale': best_scale, 'sigma': length * best_scale / (2 * np.pi),
+            'length': length, 'elapsed': time.time() - t0}
+
+
+def load_ensemble_results(output_folder):
+    '''Collects all the checkpointed parts written by run_existence_ensemble() into columns sorted by seed.'''
+    parts = sorted(name for name in os.listdir(output_folder) if name.startswith('part_') and name.endswith('.npz'))
+    columns = dict()
+    for part_name in parts:
+        with np.load(os.path.join(output_folder, part_name)) as part:
+            for column_name in part.files:
+                columns.setdefault(column_name, []).append(part[column_name])
+    columns = {column_name: np.concatenate(arrays) for column_name, arrays in columns.items()}
+    if columns:
+        order = np.argsort(columns['seed'], kind='stable')
+        columns = {column_name: column[order] for column_name, column in columns.items()}
+    return columns
+
+
+def ensemble_statistics(results):
+    '''Aggregate statistics of the columns returned by run_existence_ensemble()'''
+    number_of_paths = int(results['seed'].shape[0])
+    exists = results['exists'].astype(bool)
+    existence_fraction = float(np.mean(exists)) if number_of_paths else np.nan
+    statistics = {'number_of_paths': number_of_paths,
+                  'number_of_existing': int(np.count_nonzero(exists)),
+                  'existence_fraction': existence_fraction,
+                  'existence_fraction_standard_error':
+                      float(np.sqrt(existence_fraction * (1 - existence_fraction) / max(number_of_paths, 1)))}
+    for column_name in ['best_scale', 'sigma']:
+        values = results[column_name][exists]
+        for statistic_name, function in [('mean', np.mean), ('std', np.std), ('median', np.median),
+                                         ('min', np.min), ('max', np.max)]:
+            statistics[f'{column_name}_{statistic_name}'] = float(function(values)) if values.size else None
+    return statistics
+
+
+def run_existence_ensemble(path_generator, seeds, output_folder, generator_kwargs=None, entropy=0,
+                           minscale=0.01, maxscale=2, nframes=100, processes=None, checkpoint_every=16):
+    '''
+    Monte Carlo statistics of existence of two-period trajectoids over an ensemble of random paths.
+
+    Every seed gets its own independent stream np.random.default_rng([entropy, seed]), so results do not depend on
+    the number of processes or on the order of execution. Results are written to output_folder in parts
+    (part_*.npz, one array per column) every checkpoint_every finished seeds. If the run is interrupted, calling
+    it again with the same arguments skips the seeds already present in these parts.
+    At the end all the parts are gathered into existence_results.npz and the aggregate statistics are saved to
+    existence_statistics.json.
+
+    :param path_generator: Function making one period of the path, accepting the keyword argument rng
+                           (np.random.Generator), e.g. make_random_path. It must be defined at the top level of
+                           a module so that it can be sent to the worker processes.
+    :param seeds: Iterable of integer seeds
+    :param generator_kwargs: Dictionary of other keyword arguments of path_generator
+    :param entropy: Integer. Base entropy shared by all the seeds of the ensemble.
+    :param processes: Integer or None. Number of worker processes, by default the number of CPUs.
+    :return: Tuple of dictionary of result columns (see existence_for_seed()) and dictionary of statistics
+    '''
+    if generator_kwargs is None:
+        generator_kwargs = dict()
+    os.makedirs(output_folder, exist_ok=True)
+    finished_seeds = set(load_ensemble_results(output_folder).get('seed', np.array([], dtype=int)).tolist())
+    existence_kwargs = {'minscale': minscale, 'maxscale': maxscale, 'nframes': nframes}
+    tasks = [(path_generator, generator_kwargs, entropy, seed, existence_kwargs)
+             for seed in seeds if seed not in finished_seeds]
+    logging.info(f'Ensemble: {len(finished_seeds)} seeds already done, {len(tasks)} to go.')
+
+    def save_part(rows):
+        part_index = len([name for name in os.listdir(output_folder) if name.startswith('part_')])
+        part_filename = os.path.join(output_folder, f'part_{part_index:06d}.npz')
+        # write under a temporary name first, so that an interrupted write never looks like a finished part
+        with open(part_filename + '.tmp', 'wb') as part_file:
+            np.savez(part_file, **{column_name: np.array([row[column_name] for row in rows])
+                                   for column_name in rows[0].keys()})
+        os.replace(part_filename + '.tmp', part_filename)
+
+    if tasks:
+        with multiprocessing.Pool(processes) as pool:
+            rows = []
+            for row in tqdm(pool.imap_unordered(existence_for_seed, tasks), total=len(tasks),
+                            desc='Testing existence for the ensemble of paths'):
+                rows.append(row)
+                if len(rows) >= checkpoint_every:
+                    save_part(rows)
+                    rows = []
+            if rows:
+                save_part(rows)
+
+    results = load_ensemble_results(output_folder)
+    np.savez(os.path.join(output_folder, 'existence_results.npz'), **results)
+    statistics = ensemble_statistics(results)
+    with open(os.path.join(output_folder, 'existence_statistics.json'), 'w') as statistics_file:
+        json.dump(statistics, statistics_file, indent=4)
+    logging.info(f'Trajectoid exists for {statistics["number_of_existing"]} out of '
+                 f'{statistics["number_of_paths"]} paths')
+    return results, statistics
+
+
 def length_of_the_path(input_path_0):
     return np.sum(np.sqrt((np.diff(input_path_0[:, 0]) ** 2 + np.diff(input_path_0[:, 1]) ** 2)))
 
@@ -1393,21 +2904,238 @@ def upsample_path(input_path, by_factor=10, kind='linear'):
     return np.stack((new_xs, new_ys)).T
 
 
+def simplify_polyline(points, tolerance):
+    '''
+    Douglas-Peucker simplification of the polyline, with all the chords split in one vectorized pass per level.
+    Distance from a polyline to a chord is largest at one of its vertices, so the simplified polyline is within
+    tolerance from the original one.
+
+    :param points: Array of shape (N, 2)
+    :return: Sorted integer array of indices of the kept points, including the first and the last one
+    '''
+    kept = np.array([0, points.shape[0] - 1])
+    vertex_indices = np.arange(points.shape[0])
+    while True:
+        # chord containing each vertex; kept vertices are at zero distance from their chords
+        chord_ids = np.minimum(np.searchsorted(kept, vertex_indices, side='right') - 1, kept.shape[0] - 2)
+        chord_starts = points[kept[chord_ids]]
+        chords = points[kept[chord_ids + 1]] - chord_starts
+        relative = points - chord_starts
+        squared_lengths = np.sum(chords ** 2, axis=1)
+        fractions = np.clip(np.sum(relative * chords, axis=1) / np.where(squared_lengths > 0, squared_lengths, 1),
+                            0, 1)
+        distances = np.linalg.norm(relative - fractions[:, None] * chords, axis=1)
+        # farthest vertex of each chord
+        order = np.lexsort((-distances, chord_ids))
+        _, first_of_each_chord = np.unique(chord_ids[order], return_index=True)
+        farthest = order[first_of_each_chord]
+        farthest = farthest[distances[farthest] > tolerance]
+        if farthest.shape[0] == 0:
+            return kept
+        kept = np.sort(np.concatenate((kept, farthest)))
+
+
+@instrumentation.instrumented('geometry')
+def resample_path(input_path, tolerance=1e-3, kind='linear', max_step=None, min_step=1e-6, oversampling=16):
+    '''
+    Resamples the path by arc length, placing the points according to local curvature instead of uniformly by index
+    (as upsample_path() does). A chord of length h deviates from a curve of curvature k by about k * h^2 / 8, so
+    the step is sqrt(8 * tolerance / k), clipped between min_step and max_step.
+
+    :param input_path: Array of shape (N, 2)
+    :param tolerance: Float. Maximum distance between the resampled polyline and the interpolated curve.
+    :param kind: String, 'linear', 'quadratic' or 'cubic'. Kind of the spline through the points, parameterized by
+                 the cumulative length along the path. The 'linear' path keeps only the points where it turns,
+                 since rolling along a straight piece is the same for any sampling of it, and of them only as many
+                 as needed to stay within tolerance from the input polyline (see simplify_polyline()).
+    :param max_step: Float or None. Maximum distance between consecutive points.
+    :param oversampling: Integer. Curvature is evaluated at this many points per input point.
+    :return: Array of shape (M, 2)
+    '''
+    steps = np.linalg.norm(np.diff(input_path, axis=0), axis=1)
+    points = input_path[np.insert(steps > 0, 0, True)]
+    steps = steps[steps > 0]
+    if kind == 'linear':
+        directions = np.diff(points, axis=0) / steps[:, None]
+        turns = np.abs(directions[:-1, 0] * directions[1:, 1] - directions[:-1, 1] * directions[1:, 0]) > 1e-12
+        turns |= np.sum(directions[:-1] * directions[1:], axis=1) < 0
+        points = points[np.concatenate(([True], turns, [True]))]
+        points = points[simplify_polyline(points, tolerance)]
+        if max_step is None:
+            return points
+        segments = np.diff(points, axis=0)
+        pieces = np.ceil(np.linalg.norm(segments, axis=1) / max_step).astype(int)
+        fractions = np.arange(np.sum(pieces)) - np.repeat(np.cumsum(pieces) - pieces, pieces)
+        fractions = fractions / np.repeat(pieces, pieces)
+        new_points = np.repeat(points[:-1], pieces, axis=0) + fractions[:, None] * np.repeat(segments, pieces, axis=0)
+        return np.vstack((new_points, points[-1:]))
+
+    order = {'quadratic': 2, 'cubic': 3}[kind]
+    length_along_the_path = np.insert(np.cumsum(steps), 0, 0)
+    spline = interpolate.make_interp_spline(length_along_the_path, points, k=order)
+    fine_parameters = np.linspace(0, length_along_the_path[-1], oversampling * points.shape[0])
+    velocities = spline(fine_parameters, 1)
+    accelerations = spline(fine_parameters, 2)
+    speeds = np.linalg.norm(velocities, axis=1)
+    curvatures = np.abs(velocities[:, 0] * accelerations[:, 1] - velocities[:, 1] * accelerations[:, 0]) / \
+                 np.maximum(speeds, 1e-30) ** 3
+    step_sizes = np.sqrt(8 * tolerance / np.maximum(curvatures, 1e-30))
+    step_sizes = np.clip(step_sizes, min_step, np.inf if max_step is None else max_step)
+    # number of steps per unit parameter, integrated along the path
+    densities = speeds / step_sizes
+    cumulative_steps = np.insert(np.cumsum((densities[1:] + densities[:-1]) / 2 * np.diff(fine_parameters)), 0, 0)
+    number_of_steps = max(1, int(np.ceil(cumulative_steps[-1])))
+    new_parameters = np.interp(np.linspace(0, cumulative_steps[-1], number_of_steps + 1),
+                               cumulative_steps, fine_parameters)
+    # sharp turns narrower than the grid of curvature are caught by bisecting the chords that deviate too much
+    for iteration in range(30):
+        new_points = spline(new_parameters)
+        chords = np.diff(new_points, axis=0)
+        squared_chord_lengths = np.maximum(np.sum(chords ** 2, axis=1), 1e-30)
+        deviations = np.zeros(chords.shape[0])
+        for fraction in [0.25, 0.5, 0.75]:
+            offsets = spline(new_parameters[:-1] + fraction * np.diff(new_parameters)) - new_points[:-1]
+            projections = np.clip(np.sum(offsets * chords, axis=1) / squared_chord_lengths, 0, 1)
+            deviations = np.maximum(deviations, np.linalg.norm(offsets - projections[:, None] * chords, axis=1))
+        middle_parameters = (new_parameters[1:] + new_parameters[:-1]) / 2
+        too_far = (deviations > tolerance) & (np.diff(new_parameters) > min_step)
+        if not np.any(too_far):
+            break
+        new_parameters = np.sort(np.concatenate((new_parameters, middle_parameters[too_far])))
+    return spline(new_parameters)
+
+
+@instrumentation.instrumented('geometry')
+def decimate_path(input_path, tolerance=1e-3):
+    '''
+    Douglas-Peucker-style simplification of the path, with the error measured by rolling instead of in the plane.
+    A piece of the path between two kept points is replaced by a straight chord if the rotation of the sphere rolled
+    along the chord differs from rotation rolled along the piece by a small enough angle. Otherwise the piece is split
+    at the point of its spherical trace farthest from the great circle through the ends of the trace.
+
+    Distance between rotations is bi-invariant, so by triangle inequality the sum of errors of all the chords bounds
+    the change of orientation of the sphere at every kept point, including the net rotation of the whole path.
+    The absolute mismatch angle (see mismatch_angle_for_path()) therefore also changes by no more than this bound.
+    The allowed error of each chord is proportional to its length along the path, so the bound never exceeds tolerance.
+
+    :param input_path: Array of shape (N, 2)
+    :param tolerance: Float. Maximum allowed change of the net rotation, radians.
+    :return: Tuple of the decimated path and the certified bound (radians) on the change of rotation.
+    '''
+    rotations = rotations_to_origin(input_path)[:, :3, :3]
+    length_along_the_path = np.insert(np.cumsum(np.linalg.norm(np.diff(input_path, axis=0), axis=1)), 0, 0)
+    total_length = length_along_the_path[-1]
+    contact_point = np.array([0, 0, -1])
+    keep = np.zeros(input_path.shape[0], dtype=bool)
+    keep[[0, -1]] = True
+    bound = 0
+    pieces = [(0, input_path.shape[0] - 1)]
+    while pieces:
+        i, j = pieces.pop()
+        if j - i < 2:
+            continue
+        piece_rotation = rotations[i].T @ rotations[j]
+        chord_rotation = rotations_for_steps((input_path[i] - input_path[j])[None, :])[0]
+        difference = piece_rotation.T @ chord_rotation
+        axial_vector = np.array([difference[2, 1] - difference[1, 2],
+                                 difference[0, 2] - difference[2, 0],
+                                 difference[1, 0] - difference[0, 1]]) / 2
+        error = np.arctan2(np.linalg.norm(axial_vector), (np.trace(difference) - 1) / 2)
+        if error <= tolerance * (length_along_the_path[j] - length_along_the_path[i]) / total_length:
+            bound += error
+            continue
+        # trace of the piece on the sphere, with its first point at the contact point
+        trace = (rotations[i].T @ rotations[i + 1:j + 1]) @ contact_point
+        normal = np.cross(contact_point, trace[-1])
+        if np.linalg.norm(normal) > 1e-12:
+            distances_from_arc = np.abs(trace[:-1] @ (normal / np.linalg.norm(normal)))
+        else:
+            distances_from_arc = np.linalg.norm(trace[:-1] - contact_point, axis=1)
+        k = i + 1 + np.argmax(distances_from_arc)
+        keep[k] = True
+        pieces.extend([(i, k), (k, j)])
+    logging.debug('Decimated path from %d to %d points, rotation changes by at most %.2e rad',
+                  input_path.shape[0], np.count_nonzero(keep), bound)
+    return input_path[keep], bound
+
+
+def decimate_polyline_for_display(points, pixel_size, scalars=None, scalar_resolution=None):
+    '''
+    Indices of the points of the polyline (of any dimension) that are enough to draw it at the given pixel size:
+    the polyline through the kept points deviates from the original one by at most half a pixel (Ramer-Douglas-
+    Peucker simplification). If scalars for coloring along the polyline are given, the scalars are also kept
+    within scalar_resolution along every kept segment (by default, one level of a 256-level colormap).
+
+    :param pixel_size: Size of one pixel of the output in units of the points (see axes_pixel_size())
+    :return: Sorted array of indices, always including the first and the last point
+    '''
+    points = np.asarray(points, dtype=float)
+    number_of_points = points.shape[0]
+    if number_of_points <= 2:
+        return np.arange(number_of_points)
+    tolerance = pixel_size / 2
+    if scalars is not None:
+        scalars = np.asarray(scalars, dtype=float)
+        if scalar_resolution is None:
+            scalar_resolution = (np.max(scalars) - np.min(scalars)) / 256
+    keep = np.zeros(shape=number_of_points, dtype=bool)
+    keep[[0, -1]] = True
+    ranges_to_check = [(0, number_of_points - 1)]
+    while ranges_to_check:
+        start, end = ranges_to_check.pop()
+        if end - start < 2:
+            continue
+        relative_points = points[start + 1:end] - points[start]
+        chord = points[end] - points[start]
+        chord_length_squared = np.dot(chord, chord)
+        # distance to the chord as a segment, so that loops and backtracking are not dropped
+        if chord_length_squared > 0:
+            ts = np.clip(relative_points @ chord / chord_length_squared, 0, 1)
+            distances = np.linalg.norm(relative_points - ts[:, None] * chord, axis=1)
+        else:
+            distances = np.linalg.norm(relative_points, axis=1)
+        farthest = np.argmax(distances)
+        if distances[farthest] > tolerance:
+            split_index = start + 1 + farthest
+        elif scalars is not None and np.ptp(scalars[start:end + 1]) > scalar_resolution:
+            split_index = (start + end) // 2
+        else:
+            continue
+        keep[split_index] = True
+        ranges_to_check.append((start, split_index))
+        ranges_to_check.append((split_index, end))
+    return np.flatnonzero(keep)
+
+
+def axes_pixel_size(ax, points, dpi=300):
+    '''Size of one pixel in data units when the points (of shape (N, 2)) fill the axes ax of a figure saved
+    with the given dpi.'''
+    bbox = ax.get_window_extent()
+    pixels = max(bbox.width, bbox.height) * dpi / ax.figure.dpi
+    points = np.asarray(points)
+    return max(np.ptp(points[:, 0]), np.ptp(points[:, 1])) / pixels
+
+
+@instrumentation.instrumented('plotting')
 def plot_flat_path_with_color(input_path, half_of_input_path, axs, linewidth=1, alpha=1,
-                              plot_single_period=False):
-    '''plotting with color along the line'''
+                              plot_single_period=False, pixel_size=None, dpi=300):
+    '''plotting with color along the line. The line is decimated to the pixel size (by default, the pixel size of
+    axs saved with dpi) by decimate_polyline_for_display().'''
     length_from_start_to_here = cumsum_half_length_along_the_path(input_path)
+    if pixel_size is None:
+        pixel_size = axes_pixel_size(axs, input_path, dpi=dpi)
 
     if not plot_single_period:
-        x = input_path[:, 0]
-        y = input_path[:, 1]
+        kept_indices = decimate_polyline_for_display(input_path, pixel_size, scalars=length_from_start_to_here)
+        x = input_path[kept_indices, 0]
+        y = input_path[kept_indices, 1]
         points = np.array([x, y]).T.reshape(-1, 1, 2)
         segments = np.concatenate([points[:-1], points[1:]], axis=1)
 
         # Coloring the curve
         norm = plt.Normalize(length_from_start_to_here.min(), length_from_start_to_here.max())
-        lc = LineCollection(segments, cmap='viridis', norm=norm)
-        lc.set_array(length_from_start_to_here)
+        lc = mcollections.LineCollection(segments, cmap='viridis', norm=norm)
+        lc.set_array(length_from_start_to_here[kept_indices])
         lc.set_linewidth(linewidth)
         lc.set_alpha(alpha)
         line = axs.add_collection(lc)
@@ -1419,15 +3147,17 @@ def plot_flat_path_with_color(input_path, half_of_input_path, axs, linewidth=1,
         plt.axis('equal')
     else:
         half_index = half_of_input_path.shape[0]
-        x = input_path[:half_index, 0]
-        y = input_path[:half_index, 1]
+        kept_indices = decimate_polyline_for_display(input_path[:half_index], pixel_size,
+                                                     scalars=length_from_start_to_here[:half_index])
+        x = input_path[kept_indices, 0]
+        y = input_path[kept_indices, 1]
         points = np.array([x, y]).T.reshape(-1, 1, 2)
         segments = np.concatenate([points[:-1], points[1:]], axis=1)
 
         # Coloring the curve
         norm = plt.Normalize(length_from_start_to_here.min(), length_from_start_to_here.max())
-        lc = LineCollection(segments, cmap='viridis', norm=norm)
-        lc.set_array(length_from_start_to_here[:half_index])
+        lc = mcollections.LineCollection(segments, cmap='viridis', norm=norm)
+        lc.set_array(length_from_start_to_here[kept_indices])
         lc.set_linewidth(linewidth)
         lc.set_alpha(alpha)
         line = axs.add_collection(lc)
@@ -1439,37 +3169,50 @@ def plot_flat_path_with_color(input_path, half_of_input_path, axs, linewidth=1,
         plt.axis('equal')
 
 
+@instrumentation.instrumented('plotting')
 def plot_spherical_trace_with_color_along_the_trace(input_path, input_path_half, scale, plotting_upsample_factor=1,
-                                                    sphere_opacity=.8, plot_endpoints=False, endpoint_radius=0.1):
-    length_from_start_to_here = cumsum_half_length_along_the_path(input_path)
-    sphere_trace = trace_on_sphere(upsample_path(scale * input_path,
-                                                 by_factor=plotting_upsample_factor), kx=1, ky=1)
+                                                    sphere_opacity=.8, plot_endpoints=False, endpoint_radius=0.1,
+                                                    pixel_size=None):
+    '''
+    Plots the trace of the path on the rolling sphere, colored by the length along the path. The trace is decimated
+    by decimate_polyline_for_display() to pixel_size, which by default is the size of one pixel of the figure
+    when the sphere fills it.
+    '''
+    upsampled_path = upsample_path(scale * input_path, by_factor=plotting_upsample_factor)
+    length_from_start_to_here = cumsum_half_length_along_the_path(upsampled_path)
+    sphere_trace = trace_on_sphere(upsampled_path, kx=1, ky=1)
     logging.debug('Mlab plot begins...')
     core_radius = 1
     tube_radius = 0.01
     last_index = sphere_trace.shape[0] // 2
+    if pixel_size is None:
+        figure_pixels = 1024 if USED_3D_PLOTTING_PACKAGE == 'mayavi' else 700
+        pixel_size = 2.2 * core_radius / figure_pixels
+    kept_indices = decimate_polyline_for_display(sphere_trace, pixel_size, scalars=length_from_start_to_here)
+    plotted_trace = sphere_trace[kept_indices]
+    plotted_lengths = length_from_start_to_here[kept_indices]
     if USED_3D_PLOTTING_PACKAGE == 'mayavi':
         mfig = mlab.figure(size=(1024, 1024), \
                            bgcolor=(1, 1, 1), fgcolor=(0.5, 0.5, 0.5))
         plot_sphere(r0=core_radius - tube_radius, line_radius=tube_radius / 4, sphere_opacity=sphere_opacity)
-        mlab.plot3d(sphere_trace[:, 0],
-                    sphere_trace[:, 1],
-                    sphere_trace[:, 2],
-                    length_from_start_to_here, colormap='viridis',
+        mlab.plot3d(plotted_trace[:, 0],
+                    plotted_trace[:, 1],
+                    plotted_trace[:, 2],
+                    plotted_lengths, colormap='viridis',
                     tube_radius=tube_radius)
         for point_here in [sphere_trace[-1], sphere_trace[0]]:
             mlab.points3d(point_here[0], point_here[1], point_here[2], scale_factor=endpoint_radius, color=(0, 0, 0))
         return mfig
     elif USED_3D_PLOTTING_PACKAGE == 'plotly':
         fig = go.Figure(data=go.Scatter3d(
-            x=sphere_trace[:, 0], y=sphere_trace[:, 1], z=sphere_trace[:, 2],
+            x=plotted_trace[:, 0], y=plotted_trace[:, 1], z=plotted_trace[:, 2],
             marker=dict(
                 size=0,
-                color=length_from_start_to_here,
+                color=plotted_lengths,
                 colorscale='Viridis',
             ),
             line=dict(
-                color=length_from_start_to_here,
+                color=plotted_lengths,
                 colorscale='Viridis',
                 width=5
             )
@@ -16,6 +16,7 @@ import logging
 import plotly.express as px
 import plotly.graph_objects as go
 import os
+import itertools
 
 logging.basicConfig(level=logging.INFO)
 last_path = np.array([0, 0])
@@ -56,7 +57,7 @@ def intersects(A, B, C, D):
 
 def sort_path(arr2D):
     columnIndex = 0
-    return arr2D[arr2D[:, columnIndex].argsort()]
+    return arr2D[arr2D[:, columnIndex].argsort(kind='stable')]
 
 
 def split_by_mask(signal, input_mask):
@@ -143,34 +144,94 @@ def spherical_trace_is_self_intersecting(sphere_trace):
     return intersection_detected
 
 
-def get_trajectory_from_raster_image(filename, do_plotting=True, resample_to=200):
-    image = io.imread(filename)[:, :, 0].T
-    image = np.fliplr(image)
-    # trajectory_points = np.zeros(shape=(image.shape[0], 2))
-    xs = []
-    ys = []
-    for i in range(image.shape[0]):
-        # if all pixels are white then don't add point here
-        if np.all(image[i, :] == 255):
-            continue
-        xs.append(i / image.shape[0] * 2 * np.pi)  # assume that x dimension of path is 2*pi
-        # ys.append(np.argmin(image[i, :]) / image.shape[0] * 2 * np.pi)
-        ys.append(np.mean(np.argwhere(image[i, :] != 255)) / image.shape[0] * 2 * np.pi)
-    # trajectory_points[:, 1] -= trajectory_points[0, 1]  # make path relative to first point
-    # trajectory_points = trajectory_points[::5, :]  # decimation by a factor 5
-    # print('Decimated to {0} elements'.format(trajectory_points.shape[0]))
-    # xs = trajectory_points[:, 0]
-    # ys = trajectory_points[:, 1]
-    xs = np.array(xs)
-    ys = np.array(ys)
+def load_raster_image(filename):
+    '''Image as an array. Arrays (including np.memmap) are used as they are, and .npy files are memory-mapped,
+    so that very large scans are never loaded into memory as a whole.'''
+    if isinstance(filename, np.ndarray):
+        return filename
+    if filename.endswith('.npy'):
+        return np.load(filename, mmap_mode='r')
+    return io.imread(filename)
+
+
+def extract_raster_path(image, axis=1, method='argmin', white_level=255, tile_size=4096):
+    '''
+    Finds the dark line drawn on the image: for every line of pixels (rows for axis=1, columns for axis=0) finds the
+    subpixel position of the line along this axis. The drawing must therefore be a function of the line index.
+    The image is processed in tiles of tile_size lines, all lines of a tile at once.
+
+    :param image: Array of shape (H, W) or (H, W, channels), for example a memory map. Only the first channel is used.
+    :param method: String. "argmin" takes the darkest pixel and refines its position by a parabola through it and
+                   its two neighbours. "centroid" takes the centroid of darkness (white_level minus intensity).
+                   "mean" takes the unweighted mean position of the pixels darker than white_level.
+    :param white_level: Lines without pixels darker than this are skipped.
+    :return: Tuple of indices of the lines that contain the drawing and the positions of the drawing in them
+    '''
+    number_of_lines = image.shape[1 - axis]
+    line_indices = []
+    positions = []
+    for tile_start in range(0, number_of_lines, tile_size):
+        if axis == 1:
+            tile = np.asarray(image[tile_start:tile_start + tile_size])
+        else:
+            tile = np.swapaxes(np.asarray(image[:, tile_start:tile_start + tile_size]), 0, 1)
+        if tile.ndim == 3:
+            tile = tile[:, :, 0]
+        tile = tile.astype(np.float32)
+        has_drawing = np.min(tile, axis=1) < white_level
+        if method == 'argmin':
+            darkest = np.argmin(tile, axis=1)
+            rows = np.arange(tile.shape[0])
+            left = tile[rows, np.maximum(darkest - 1, 0)]
+            center = tile[rows, darkest]
+            right = tile[rows, np.minimum(darkest + 1, tile.shape[1] - 1)]
+            curvatures = left - 2 * center + right
+            shifts = np.where(curvatures > 0, 0.5 * (left - right) / np.where(curvatures > 0, curvatures, 1), 0)
+            tile_positions = darkest + np.clip(shifts, -0.5, 0.5)
+        elif method == 'centroid':
+            darkness = np.clip(white_level - tile, 0, None)
+            tile_positions = darkness @ np.arange(tile.shape[1], dtype=np.float32) / \
+                             np.maximum(np.sum(darkness, axis=1), 1e-12)
+        elif method == 'mean':
+            is_dark = (tile < white_level).astype(np.float32)
+            tile_positions = is_dark @ np.arange(tile.shape[1], dtype=np.float32) / \
+                             np.maximum(np.sum(is_dark, axis=1), 1)
+        else:
+            raise ValueError(f'Unknown method: {method}')
+        line_indices.append(tile_start + np.flatnonzero(has_drawing))
+        positions.append(tile_positions[has_drawing])
+    return np.concatenate(line_indices), np.concatenate(positions).astype(float)
+
+
+def resample_by_arc_length(input_path, npoints):
+    '''Resamples the path to npoints spaced uniformly along its length'''
+    length_along_the_path = np.insert(np.cumsum(np.linalg.norm(np.diff(input_path, axis=0), axis=1)), 0, 0)
+    new_lengths = np.linspace(0, length_along_the_path[-1], npoints)
+    return np.stack([np.interp(new_lengths, length_along_the_path, input_path[:, k])
+                     for k in range(input_path.shape[1])]).T
+
+
+def get_trajectory_from_raster_image(filename, do_plotting=True, resample_to=200, tile_size=4096):
+    '''
+    Path drawn as a dark line on the image, one point per column of pixels at the mean position of the non-white
+    pixels in it (see extract_raster_path()). Columns without the drawing are skipped. The path is resampled uniformly
+    along its length and its ends are brought to y=0.
+
+    :param filename: Image file, .npy file (which is memory-mapped) or array
+    :param resample_to: Integer or None. Number of points of the path; if None, there is no resampling.
+    '''
+    image = load_raster_image(filename)
+    column_indices, positions = extract_raster_path(image, axis=0, method='mean', tile_size=tile_size)
+    # x dimension of path is 2*pi, y axis of the image points down
+    xs = column_indices / image.shape[1] * 2 * np.pi
+    ys = (image.shape[0] - 1 - positions) / image.shape[1] * 2 * np.pi
     xs = xs - xs[0]
+    trajectory_points = np.stack((xs, ys)).T
 
-    # resample to 200 points
     if resample_to is not None:
-        xs_new = np.linspace(xs[0], xs[-1], resample_to)
-        ys = interpolate.interp1d(xs, ys, fill_value='extrapolate')(xs_new)
-        xs = xs_new
-
+        trajectory_points = resample_by_arc_length(trajectory_points, resample_to)
+    xs = trajectory_points[:, 0]
+    ys = trajectory_points[:, 1]
     ys = ys - ys[0]
     ys = ys - xs * (ys[-1] - ys[0]) / (xs[-1] - xs[0])
     trajectory_points = np.stack((xs, ys)).T
@@ -185,8 +246,56 @@ def get_trajectory_from_raster_image(filename, do_plotting=True, resample_to=200
     return trajectory_points
 
 
-def get_trajectory_from_csv(filename):
-    data = np.genfromtxt(filename, delimiter=',')
+def _is_number_line(line, delimiter):
+    fields = line.split(delimiter)
+    try:
+        float(fields[0])
+    except (ValueError, IndexError):
+        return False
+    return True
+
+
+def _iter_text_column_chunks(filename, chunk_size, delimiter=',', usecols=None):
+    '''Columns of the text file as arrays of at most chunk_size rows. Lines at the top of the file that do not start
+    with a number (header with column names, blank lines) are skipped.'''
+    with open(filename, 'r') as f:
+        lines = itertools.dropwhile(lambda line: not _is_number_line(line, delimiter), f)
+        while True:
+            chunk_lines = list(itertools.islice(lines, chunk_size))
+            if not chunk_lines:
+                return
+            chunk = np.loadtxt(chunk_lines, delimiter=delimiter, usecols=usecols, ndmin=2)
+            if chunk.shape[0] > 0:
+                yield chunk
+
+
+def get_trajectory_from_csv(filename, start_from_zero=False, end_with_zero=False, chunk_size=65536):
+    '''
+    Reads columns x and y of the CSV file by chunks of chunk_size lines; a header row is skipped. The file is read
+    twice: first for the number of points and the end points, then the normalized chunks are written into the
+    output array, so that only the output and one chunk are in memory. If start_from_zero, the path is shifted
+    to start at the origin; if end_with_zero, the linear trend is subtracted from y so that the path ends at
+    the same y where it starts.
+    '''
+    npoints = 0
+    first_point = None
+    for chunk in _iter_text_column_chunks(filename, chunk_size, usecols=(0, 1)):
+        if first_point is None:
+            first_point = chunk[0]
+        last_point = chunk[-1]
+        npoints += chunk.shape[0]
+    if first_point is None:
+        raise ValueError(f'No points in {filename}')
+    data = np.empty(shape=(npoints, 2))
+    chunk_start = 0
+    for chunk in _iter_text_column_chunks(filename, chunk_size, usecols=(0, 1)):
+        if end_with_zero:
+            chunk[:, 1] -= (chunk[:, 0] - first_point[0]) * (last_point[1] - first_point[1]) / \
+                           (last_point[0] - first_point[0])
+        if start_from_zero:
+            chunk -= first_point
+        data[chunk_start:chunk_start + chunk.shape[0]] = chunk
+        chunk_start += chunk.shape[0]
     return data
 
 
@@ -257,6 +366,43 @@ def rotation_to_origin(index_in_trajectory, data, use_cache=True, recursive=True
     return net_rotation_matrix
 
 
+def rotations_to_origin(data):
+    '''Batched version of rotation_to_origin(): returns an array of shape (N, 4, 4) whose i-th element is equal to
+    rotation_to_origin(i, data). Single-step rotations are built at once by Rodrigues formula and then
+    accumulated by a parallel prefix product (log2(N) batched matrix multiplications), without any caching.'''
+    steps = data[:-1] - data[1:]
+    thetas = np.linalg.norm(steps, axis=1)
+    # axis of rotation for each step is [dy, -dx, 0], normalized. Zero-length steps give identity.
+    safe_thetas = np.where(thetas > 0, thetas, 1)
+    kx = steps[:, 1] / safe_thetas
+    ky = -1 * steps[:, 0] / safe_thetas
+    # rotation is by angle (-theta) around the axis, see rotation_from_point_to_point()
+    sines = np.sin(-1 * thetas)
+    one_minus_cosines = 1 - np.cos(thetas)
+    rotations = np.zeros(shape=(data.shape[0], 3, 3))
+    rotations[:, [0, 1, 2], [0, 1, 2]] = 1
+    rotations[1:, 0, 0] -= one_minus_cosines * ky ** 2
+    rotations[1:, 1, 1] -= one_minus_cosines * kx ** 2
+    rotations[1:, 2, 2] -= one_minus_cosines
+    rotations[1:, 0, 1] = one_minus_cosines * kx * ky
+    rotations[1:, 1, 0] = one_minus_cosines * kx * ky
+    rotations[1:, 0, 2] = sines * ky
+    rotations[1:, 2, 0] = -1 * sines * ky
+    rotations[1:, 1, 2] = -1 * sines * kx
+    rotations[1:, 2, 1] = sines * kx
+
+    # inclusive prefix product R_1 @ R_2 @ ... @ R_i (Hillis-Steele scan)
+    offset = 1
+    while offset < rotations.shape[0]:
+        rotations[offset:] = rotations[:-offset] @ rotations[offset:]
+        offset *= 2
+
+    net_rotation_matrices = np.zeros(shape=(data.shape[0], 4, 4))
+    net_rotation_matrices[:, :3, :3] = rotations
+    net_rotation_matrices[:, 3, 3] = 1
+    return net_rotation_matrices
+
+
 def plot_mismatch_map_for_scale_tweaking(data0, N=30, M=30, kx_range=(0.1, 2), ky_range=(0.1, 2), vmin=0, vmax=np.pi,
                                          signed_angle=False):
     # sweeping parameter space for optimal match of the starting and ending orientation
@@ -285,35 +431,225 @@ def plot_mismatch_map_for_scale_tweaking(data0, N=30, M=30, kx_range=(0.1, 2), k
     plt.show()
 
 
+def make_base_box(core_radius=1, cut_size=10):
+    '''Cutting box of the first path point: a cube lying entirely below the plane z = -core_radius
+    and touching it with its top face.'''
+    return trimesh.creation.box(extents=[cut_size * core_radius, cut_size * core_radius, cut_size * core_radius],
+                                transform=trimesh.transformations.translation_matrix(
+                                    [0, 0, -core_radius - 1 * cut_size * core_radius / 2]))
+
+
+def merge_cutting_boxes(base_box, transforms):
+    '''Makes a single mesh containing all the cutting boxes. Box i is the base_box transformed by transforms[i].
+    Vertices of all boxes are transformed in one batched operation.'''
+    vertices = np.einsum('nij,vj->nvi', transforms[:, :3, :3], base_box.vertices) + transforms[:, None, :3, 3]
+    faces = base_box.faces[None, :, :] + (np.arange(transforms.shape[0]) * base_box.vertices.shape[0])[:, None, None]
+    return trimesh.Trimesh(vertices=vertices.reshape(-1, 3), faces=faces.reshape(-1, 3), process=False)
+
+
+def make_openscad_code(transforms, core_radius=1, cut_size=10, outer_radius=1.25, cavity_radius=None, masterscale=1,
+                       halving=None, halving_cube_size=20, geosphere=None, geosphere_subdivisions=4):
+    '''
+    Makes a self-contained OpenSCAD program for the trajectoid: a single cutting cube is defined once and then
+    placed by an inline multmatrix() for every cutting box. Geosphere is embedded as a polyhedron, so no files
+    are imported during rendering.
+
+    :param transforms: Array of shape (N, 4, 4), transforms of the cutting boxes (see compute_shape())
+    :param outer_radius: Float. Radius of the outer geosphere, in the same units as core_radius
+    :param cavity_radius: Float or None. Radius of the inner spherical cavity. If None, there is no cavity.
+    :param masterscale: Float. The whole shape is finally scaled by this factor (e.g. core radius in millimeters).
+    :param halving: None, "left" or "right". If not None, one half of the shape is cut away by a cube,
+                    leaving the left (y < 0) or right (y > 0) half.
+    :param halving_cube_size: Float. Size of the cube used for halving. Must be larger than 2 * outer_radius.
+    :param geosphere: trimesh.Trimesh or None. Convex mesh of the unit sphere, for example
+                      trimesh.load('unit_geosphere.stl'). If None, an icosphere is used.
+    :return: String with OpenSCAD code
+    '''
+    if geosphere is None:
+        geosphere = trimesh.creation.icosphere(subdivisions=geosphere_subdivisions)
+
+    def format_vector(vector):
+        return '[' + ', '.join(f'{x:.10g}' for x in vector) + ']'
+
+    lines = [f'masterscale = {masterscale:.10g};',
+             '',
+             'module cutter_cube() {',
+             f'    translate([0, 0, {-core_radius - cut_size * core_radius / 2:.10g}]) '
+             f'cube(size = {cut_size * core_radius:.10g}, center = true);',
+             '}',
+             '',
+             'module geosphere(radius) {',
+             '    scale([radius, radius, radius]) polyhedron(',
+             '        points = [' + ', '.join(format_vector(v) for v in geosphere.vertices) + '],',
+             # OpenSCAD wants faces ordered clockwise when looking from outside
+             '        faces = [' + ', '.join(format_vector(f[::-1]) for f in geosphere.faces) + ']);',
+             '}',
+             '',
+             'module cube_for_halving() {',
+             f'    translate([{-halving_cube_size / 2:.10g}, 0, {-halving_cube_size / 2:.10g}]) '
+             f'cube(size = [{halving_cube_size:.10g}, {halving_cube_size:.10g}, {halving_cube_size:.10g}], '
+             f'center = false);',
+             '}',
+             '',
+             'scale([masterscale, masterscale, masterscale]) difference() {',
+             f'    geosphere(radius = {outer_radius:.10g});']
+    if cavity_radius is not None:
+        lines.append(f'    geosphere(radius = {cavity_radius:.10g});')
+    if halving == 'left':
+        lines.append('    cube_for_halving();')
+    elif halving == 'right':
+        lines.append(f'    translate([0, {-halving_cube_size:.10g}, 0]) cube_for_halving();')
+    elif halving is not None:
+        raise ValueError(f'Unknown halving: {halving}')
+    for transform in transforms:
+        lines.append('    multmatrix(m = [' + ', '.join(format_vector(row) for row in transform[:3]) + ']) '
+                     'cutter_cube();')
+    lines.append('}')
+    return '\n'.join(lines) + '\n'
+
+
 def compute_shape(data0, kx, ky, folder_for_path, folder_for_meshes='cut_meshes', core_radius=1,
-                  cut_size=10):
+                  cut_size=10, export_mode='separate_files', prune_tolerance=None, outer_radius=1.25,
+                  cavity_radius=None, masterscale=1, halving=None):
+    '''
+    Computes the positions and orientations of the boxes for cutting and saves them.
+
+    :param export_mode: String. "separate_files" saves each box to its own file test_{i}.stl,
+                        "transforms_npy" saves the stacked Nx4x4 array of box transforms into
+                        folder_for_meshes/cutting_transforms.npy, "merged_stl" saves all the boxes as a single
+                        binary STL file folder_for_meshes/cutting_boxes.stl, "openscad" saves a self-contained
+                        OpenSCAD program folder_for_meshes/trajectoid.scad (see make_openscad_code(), which also
+                        explains the parameters outer_radius, cavity_radius, masterscale and halving)
+    :param prune_tolerance: Float or None. If not None, boxes that change the final solid (sphere of radius
+                            outer_radius minus the boxes) by less than this distance are not exported.
+                            See prune_cutting_transforms().
+    :return: Array of shape (N, 4, 4) with transforms of the base box (see make_base_box()) for every exported box.
+    '''
     data = np.copy(data0)
     data[:, 0] = data[:, 0] * kx
     data[:, 1] = data[:, 1] * ky
-    # This code computes the positions and orientations of the boxes_for_cutting, and saves each box to a file.
-    # These boxes are later loaded to 3dsmax and subtracted from a sphere
-    rotation_of_entire_traj = trimesh.transformations.rotation_from_matrix(rotation_to_origin(data.shape[0] - 1, data))
-    # print(rotation_of_entire_traj)
-    angle = rotation_of_entire_traj[0]
-    # print('Angle: {0}'.format(angle))
     os.makedirs(os.path.join(folder_for_path,'path_data'),exist_ok=True)
     np.save(folder_for_path + '/path_data', data)
-    base_box = trimesh.creation.box(extents=[cut_size * core_radius, cut_size * core_radius, cut_size * core_radius],
-                                    transform=trimesh.transformations.translation_matrix(
-                                        [0, 0, -core_radius - 1 * cut_size * core_radius / 2]))
-    boxes_for_cutting = []
-    for i, point in enumerate(data):
-        # make a copy of the base box
-        box_for_cutting = base_box.copy()
-        # roll the sphere (without slipping) on the xy plane along with the box "glued" to it to the (0,0) point of origin
-        # Not optimized here. Would become vastly faster if, for example, you cache the rotation matrices.
-        box_for_cutting.apply_transform(rotation_to_origin(i, data))
-        boxes_for_cutting.append(box_for_cutting.copy())
-    os.makedirs(folder_for_meshes,exist_ok=True)
-    for i, box in enumerate(boxes_for_cutting):
-        # print('Saving box for cutting: {0}'.format(i))
-        box.export('{0}/test_{1}.stl'.format(folder_for_meshes, i))
 
+    # roll the sphere (without slipping) on the xy plane along with the box "glued" to it to the (0,0) point of origin.
+    # Rotations for all the points are computed at once.
+    transforms = rotations_to_origin(data)
+    angle = trimesh.transformations.rotation_from_matrix(transforms[-1])[0]
+    logging.debug(f'Mismatch angle: {angle}')
+    if prune_tolerance is not None:
+        kept_indices, max_protrusion = prune_cutting_transforms(transforms, prune_tolerance, core_radius=core_radius,
+                                                                outer_radius=outer_radius)
+        transforms = transforms[kept_indices]
+
+    base_box = make_base_box(core_radius=core_radius, cut_size=cut_size)
+    os.makedirs(folder_for_meshes,exist_ok=True)
+    if export_mode == 'separate_files':
+        for i, transform in enumerate(transforms):
+            box_for_cutting = base_box.copy()
+            box_for_cutting.apply_transform(transform)
+            box_for_cutting.export('{0}/test_{1}.stl'.format(folder_for_meshes, i))
+    elif export_mode == 'transforms_npy':
+        np.save(folder_for_meshes + '/cutting_transforms.npy', transforms)
+    elif export_mode == 'merged_stl':
+        merge_cutting_boxes(base_box, transforms).export(folder_for_meshes + '/cutting_boxes.stl')
+    elif export_mode == 'openscad':
+        with open(folder_for_meshes + '/trajectoid.scad', 'w') as scad_file:
+            scad_file.write(make_openscad_code(transforms, core_radius=core_radius, cut_size=cut_size,
+                                               outer_radius=outer_radius, cavity_radius=cavity_radius,
+                                               masterscale=masterscale, halving=halving))
+    else:
+        raise ValueError(f'Unknown export mode: {export_mode}')
+    return transforms
+
+
+def cutting_halfspaces(transforms, core_radius=1):
+    '''Each cutting box lies entirely below the plane z = -core_radius, so within the outer sphere subtracting the
+    box is the same as keeping only the half-space above that plane. After rolling, the kept half-space is u.x <= r,
+    where u = -transform[:3, 2] is the (unit) direction from the center to the respective point of the spherical trace.
+
+    :return: Array of shape (N, 4) with the half-spaces in the format of scipy.spatial.HalfspaceIntersection, i.e.
+             rows [u_x, u_y, u_z, -r] of inequalities u.x - r <= 0
+    '''
+    halfspaces = np.empty(shape=(transforms.shape[0], 4))
+    halfspaces[:, :3] = -1 * transforms[:, :3, 2]
+    halfspaces[:, 3] = -1 * core_radius
+    return halfspaces
+
+
+def support_of_two_cuts(directions, normal_a, normal_b, core_radius=1, outer_radius=1.25):
+    '''Support function h(u) = max u.x of the convex set {u_a.x <= r, u_b.x <= r, |x| <= R} (outer sphere cut by
+    two kept cutting planes), evaluated for all the unit vectors in array "directions" of shape (M, 3) at once.
+    The maximum lies either on the sphere surface inside both half-spaces, or on the circle where sphere meets one
+    of the planes, or at one of the two points where sphere meets both planes.'''
+    def feasible(points):
+        return (points @ normal_a <= core_radius + 1e-12) & (points @ normal_b <= core_radius + 1e-12)
+
+    circle_radius = np.sqrt(outer_radius ** 2 - core_radius ** 2)
+    support = np.full(directions.shape[0], -np.inf)
+
+    candidates = outer_radius * directions
+    support = np.where(feasible(candidates), outer_radius, support)
+
+    for normal in [normal_a, normal_b]:
+        in_plane = directions - np.outer(directions @ normal, normal)
+        in_plane_norms = np.linalg.norm(in_plane, axis=1)
+        in_plane = in_plane / np.where(in_plane_norms > 0, in_plane_norms, 1)[:, None]
+        candidates = core_radius * normal + circle_radius * in_plane
+        values = np.einsum('ij,ij->i', directions, candidates)
+        support = np.where(feasible(candidates), np.maximum(support, values), support)
+
+    # points where the sphere meets both planes
+    line_direction = np.cross(normal_a, normal_b)
+    sine_squared = np.dot(line_direction, line_direction)
+    if sine_squared > 1e-24:
+        cosine = np.dot(normal_a, normal_b)
+        point_on_line = core_radius / (1 + cosine) * (normal_a + normal_b)
+        half_chord_squared = outer_radius ** 2 - np.dot(point_on_line, point_on_line)
+        if half_chord_squared >= 0:
+            half_chord = np.sqrt(half_chord_squared / sine_squared) * line_direction
+            for candidate in [point_on_line + half_chord, point_on_line - half_chord]:
+                support = np.maximum(support, directions @ candidate)
+    return support
+
+
+def prune_cutting_transforms(transforms, tolerance, core_radius=1, outer_radius=1.25):
+    '''
+    Finds the cutting boxes that can be dropped without changing the final solid by more than a given tolerance.
+    Walks along the path and greedily skips as many boxes as possible between two kept boxes a and b. Skipped box i
+    is allowed if the sphere cut only by the planes of a and b does not protrude beyond the plane of box i by more
+    than the tolerance (support function test, see support_of_two_cuts()). The other kept boxes only shrink the
+    solid further, so this bound is conservative.
+
+    :param transforms: Array of shape (N, 4, 4), transforms of the cutting boxes (see compute_shape())
+    :param tolerance: Float. Maximum allowed protrusion of the final solid beyond the plane of any dropped box,
+                      in the same units as core_radius
+    :return: Tuple: integer array of indices of the kept boxes (first and last box are always kept) and the maximum
+             protrusion beyond the planes of the dropped boxes.
+    '''
+    normals = cutting_halfspaces(transforms, core_radius=core_radius)[:, :3]
+    number_of_boxes = normals.shape[0]
+
+    def protrusion(a, b):
+        return np.max(support_of_two_cuts(normals[a + 1:b], normals[a], normals[b],
+                                          core_radius=core_radius, outer_radius=outer_radius)) - core_radius
+
+    kept_indices = [0]
+    max_protrusion = 0
+    a = 0
+    while a < number_of_boxes - 1:
+        b = a + 1
+        protrusion_here = 0
+        while b + 1 < number_of_boxes:
+            candidate_protrusion = protrusion(a, b + 1)
+            if candidate_protrusion > tolerance:
+                break
+            protrusion_here = candidate_protrusion
+            b += 1
+        kept_indices.append(b)
+        max_protrusion = max(max_protrusion, protrusion_here)
+        a = b
+    logging.info(f'Pruning kept {len(kept_indices)} of {number_of_boxes} cutting boxes.')
+    return np.array(kept_indices), max_protrusion
 
 def trace_on_sphere(data0, kx, ky, core_radius=1, do_plot=False):
     data = np.copy(data0)
@@ -380,9 +716,11 @@ def path_from_trace(sphere_trace, core_radius=1):
     return position_vectors
 
 
-def plot_three_path_periods(input_path, savetofile=False, plot_midpoints=False):
+def plot_three_path_periods(input_path, savetofile=False, plot_midpoints=False, pixel_size=None):
     figtraj = plt.figure(10, figsize=(10, 5))
     dataxlen = np.max(input_path[:, 0])
+    if pixel_size is None:
+        pixel_size = axes_pixel_size(plt.gca(), np.vstack((input_path, input_path + np.array([3 * dataxlen, 0]))))
 
     def plot_periods(data, linestyle, linewidth):
         plt.plot(data[:, 0], data[:, 1], color='black', alpha=1, linestyle=linestyle, linewidth=linewidth)
@@ -393,7 +731,7 @@ def plot_three_path_periods(input_path, savetofile=False, plot_midpoints=False):
                  linewidth=linewidth)
 
     # plot_periods(data, '--', linewidth=0.5)
-    plot_periods(input_path, '-', linewidth=1)
+    plot_periods(input_path[decimate_polyline_for_display(input_path, pixel_size)], '-', linewidth=1)
     # plot_periods(projection_centers, '-', linewidth=1)
 
     for shift in dataxlen * np.arange(3):
@@ -514,42 +852,51 @@ def minimize_mismatch_by_scaling(input_path_0, scale_range=(0.8, 1.2)):
     return best_scale
 
 
-def double_the_path(input_path_0, do_plot=False, do_sort=True):
-    # input_path_0 = input_path
-    input_path_1 = np.copy(input_path_0)
-    # input_path_1[:,0] = 2*input_path_1[-1,0]-input_path_1[:,0]
-    input_path_1[:, 0] = input_path_1[-1, 0] + input_path_1[:, 0]
-    # input_path_1[:,1] = -1*input_path_1[:,1]
+def _copies_are_sorted_by_x(period, m):
+    '''True if m copies of the period, the k-th of them shifted by k * period[-1, 0] along x and without its first
+    point, follow each other in the order of x, so that sorting the multiplied path would not reorder the points.'''
+    shifts = np.arange(m) * period[-1, 0]
+    return period.shape[0] > 1 and np.all(np.diff(period[:, 0]) >= 0) and \
+        np.all(period[-1, 0] + shifts[:-1] <= period[1, 0] + shifts[1:])
+
+
+def multiply_the_path(input_path_0, m, do_plot=False, do_sort=True):
+    '''
+    Path made of m copies of input_path_0, the k-th of them shifted by k * input_path_0[-1, 0] along x, sorted by x.
+    Of each shifted copy, the point with the smallest x is dropped. The result is sorted in any case; do_sort is
+    kept for compatibility. If the period is sorted by x, the copies are concatenated without sorting.
+    '''
+    shifts = np.arange(m) * input_path_0[-1, 0]
+    if _copies_are_sorted_by_x(input_path_0, m):
+        shifted_copies = input_path_0[None, 1:] + np.stack((shifts, np.zeros_like(shifts))).T[:, None, :]
+        return np.vstack((input_path_0[:1], shifted_copies.reshape(-1, 2)))
+    pieces = [input_path_0]
+    for i in range(m - 1):
+        input_path_to_append = np.copy(input_path_0)
+        input_path_to_append[:, 0] = (i + 1) * input_path_0[-1, 0] + input_path_0[:, 0]
+        pieces.append(sort_path(input_path_to_append)[1:, ])
+    return sort_path(np.concatenate(pieces, axis=0))
 
-    # input_path_1 = np.concatenate((input_path_0, np.flipud))
+
+def double_the_path(input_path_0, do_plot=False, do_sort=True):
+    '''
+    Path made of input_path_0 followed by its copy shifted by input_path_0[-1, 0] along x, sorted by x. Of the shifted
+    copy, the point with the smallest x is dropped (see multiply_the_path()).
+    '''
     if do_plot:
         plt.plot(input_path_0[:, 0], input_path_0[:, 1], '-', color='C2')  # , label='Asymmetric')
-        plt.plot(input_path_1[:, 0], input_path_1[:, 1], '-', color='C0')
+        plt.plot(input_path_0[-1, 0] + input_path_0[:, 0], input_path_0[:, 1], '-', color='C0')
         plt.axis('equal')
         # plt.legend(loc='upper left')
         plt.show()
 
-    input_path_0 = np.concatenate((input_path_0, sort_path(input_path_1)[1:, ]), axis=0)
-    if do_sort:
-        input_path_0 = sort_path(input_path_0)
+    doubled_path = multiply_the_path(input_path_0, 2, do_sort=do_sort)
     if do_plot:
-        plt.plot(input_path_0[:, 0], input_path_0[:, 1], '-o', alpha=0.5)
+        plt.plot(doubled_path[:, 0], doubled_path[:, 1], '-o', alpha=0.5)
         plt.axis('equal')
         plt.show()
 
-    return sort_path(input_path_0)
-
-
-def multiply_the_path(input_path_0, m, do_plot=False, do_sort=True):
-    input_path_to_append = np.copy(input_path_0)
-    multiplied_path = np.copy(input_path_0)
-    for i in range(m - 1):
-        input_path_to_append[:, 0] = (i + 1) * input_path_0[-1, 0] + input_path_0[:, 0]
-        # input_path_to_append[:,1] = -1*input_path_to_append[:,1]
-        multiplied_path = np.concatenate((multiplied_path, sort_path(input_path_to_append)[1:, ]), axis=0)
-    if do_sort:
-        multiplied_path = sort_path(multiplied_path)
-    return sort_path(multiplied_path)
+    return doubled_path
 
 
 ## This old implementation is wrong by a integer number of 2*pi
@@ -815,21 +1162,82 @@ def upsample_path(input_path, by_factor=10, kind='linear'):
     return np.stack((new_xs, new_ys)).T
 
 
+def decimate_polyline_for_display(points, pixel_size, scalars=None, scalar_resolution=None):
+    '''
+    Indices of the points of the polyline (of any dimension) that are enough to draw it at the given pixel size:
+    the polyline through the kept points deviates from the original one by at most half a pixel (Ramer-Douglas-
+    Peucker simplification). If scalars for coloring along the polyline are given, the scalars are also kept
+    within scalar_resolution along every kept segment (by default, one level of a 256-level colormap).
+
+    :param pixel_size: Size of one pixel of the output in units of the points (see axes_pixel_size())
+    :return: Sorted array of indices, always including the first and the last point
+    '''
+    points = np.asarray(points, dtype=float)
+    number_of_points = points.shape[0]
+    if number_of_points <= 2:
+        return np.arange(number_of_points)
+    tolerance = pixel_size / 2
+    if scalars is not None:
+        scalars = np.asarray(scalars, dtype=float)
+        if scalar_resolution is None:
+            scalar_resolution = (np.max(scalars) - np.min(scalars)) / 256
+    keep = np.zeros(shape=number_of_points, dtype=bool)
+    keep[[0, -1]] = True
+    ranges_to_check = [(0, number_of_points - 1)]
+    while ranges_to_check:
+        start, end = ranges_to_check.pop()
+        if end - start < 2:
+            continue
+        relative_points = points[start + 1:end] - points[start]
+        chord = points[end] - points[start]
+        chord_length_squared = np.dot(chord, chord)
+        # distance to the chord as a segment, so that loops and backtracking are not dropped
+        if chord_length_squared > 0:
+            ts = np.clip(relative_points @ chord / chord_length_squared, 0, 1)
+            distances = np.linalg.norm(relative_points - ts[:, None] * chord, axis=1)
+        else:
+            distances = np.linalg.norm(relative_points, axis=1)
+        farthest = np.argmax(distances)
+        if distances[farthest] > tolerance:
+            split_index = start + 1 + farthest
+        elif scalars is not None and np.ptp(scalars[start:end + 1]) > scalar_resolution:
+            split_index = (start + end) // 2
+        else:
+            continue
+        keep[split_index] = True
+        ranges_to_check.append((start, split_index))
+        ranges_to_check.append((split_index, end))
+    return np.flatnonzero(keep)
+
+
+def axes_pixel_size(ax, points, dpi=300):
+    '''Size of one pixel in data units when the points (of shape (N, 2)) fill the axes ax of a figure saved
+    with the given dpi.'''
+    bbox = ax.get_window_extent()
+    pixels = max(bbox.width, bbox.height) * dpi / ax.figure.dpi
+    points = np.asarray(points)
+    return max(np.ptp(points[:, 0]), np.ptp(points[:, 1])) / pixels
+
+
 def plot_flat_path_with_color(input_path, half_of_input_path, axs, linewidth=1, alpha=1,
-                              plot_single_period=False):
-    '''plotting with color along the line'''
+                              plot_single_period=False, pixel_size=None, dpi=300):
+    '''plotting with color along the line. The line is decimated to the pixel size (by default, the pixel size of
+    axs saved with dpi) by decimate_polyline_for_display().'''
     length_from_start_to_here = cumsum_half_length_along_the_path(input_path)
+    if pixel_size is None:
+        pixel_size = axes_pixel_size(axs, input_path, dpi=dpi)
 
     if not plot_single_period:
-        x = input_path[:, 0]
-        y = input_path[:, 1]
+        kept_indices = decimate_polyline_for_display(input_path, pixel_size, scalars=length_from_start_to_here)
+        x = input_path[kept_indices, 0]
+        y = input_path[kept_indices, 1]
         points = np.array([x, y]).T.reshape(-1, 1, 2)
         segments = np.concatenate([points[:-1], points[1:]], axis=1)
 
         # Coloring the curve
         norm = plt.Normalize(length_from_start_to_here.min(), length_from_start_to_here.max())
         lc = LineCollection(segments, cmap='viridis', norm=norm)
-        lc.set_array(length_from_start_to_here)
+        lc.set_array(length_from_start_to_here[kept_indices])
         lc.set_linewidth(linewidth)
         lc.set_alpha(alpha)
         line = axs.add_collection(lc)
@@ -841,15 +1249,17 @@ def plot_flat_path_with_color(input_path, half_of_input_path, axs, linewidth=1,
         plt.axis('equal')
     else:
         half_index = half_of_input_path.shape[0]
-        x = input_path[:half_index, 0]
-        y = input_path[:half_index, 1]
+        kept_indices = decimate_polyline_for_display(input_path[:half_index], pixel_size,
+                                                     scalars=length_from_start_to_here[:half_index])
+        x = input_path[kept_indices, 0]
+        y = input_path[kept_indices, 1]
         points = np.array([x, y]).T.reshape(-1, 1, 2)
         segments = np.concatenate([points[:-1], points[1:]], axis=1)
 
         # Coloring the curve
         norm = plt.Normalize(length_from_start_to_here.min(), length_from_start_to_here.max())
         lc = LineCollection(segments, cmap='viridis', norm=norm)
-        lc.set_array(length_from_start_to_here[:half_index])
+        lc.set_array(length_from_start_to_here[kept_indices])
         lc.set_linewidth(linewidth)
         lc.set_alpha(alpha)
         line = axs.add_collection(lc)
@@ -862,23 +1272,34 @@ def plot_flat_path_with_color(input_path, half_of_input_path, axs, linewidth=1,
 
 
 def plot_spherical_trace_with_color_along_the_trace(input_path, input_path_half, scale, plotting_upsample_factor=1,
-                                                    sphere_opacity=.8, plot_endpoints=False, endpoint_radius=0.1):
-    length_from_start_to_here = cumsum_half_length_along_the_path(input_path)
-    sphere_trace = trace_on_sphere(upsample_path(scale * input_path,
-                                                 by_factor=plotting_upsample_factor), kx=1, ky=1)
+                                                    sphere_opacity=.8, plot_endpoints=False, endpoint_radius=0.1,
+                                                    pixel_size=None):
+    '''
+    Plots the trace of the path on the rolling sphere, colored by the length along the path. The trace is decimated
+    by decimate_polyline_for_display() to pixel_size, which by default is the size of one pixel of the figure
+    when the sphere fills it.
+    '''
+    upsampled_path = upsample_path(scale * input_path, by_factor=plotting_upsample_factor)
+    length_from_start_to_here = cumsum_half_length_along_the_path(upsampled_path)
+    sphere_trace = trace_on_sphere(upsampled_path, kx=1, ky=1)
     logging.debug('Mlab plot begins...')
     core_radius = 1
     tube_radius = 0.01
     last_index = sphere_trace.shape[0] // 2
+    if pixel_size is None:
+        pixel_size = 2.2 * core_radius / 700
+    kept_indices = decimate_polyline_for_display(sphere_trace, pixel_size, scalars=length_from_start_to_here)
+    plotted_trace = sphere_trace[kept_indices]
+    plotted_lengths = length_from_start_to_here[kept_indices]
     fig = go.Figure(data=go.Scatter3d(
-        x=sphere_trace[:, 0], y=sphere_trace[:, 1], z=sphere_trace[:, 2],
+        x=plotted_trace[:, 0], y=plotted_trace[:, 1], z=plotted_trace[:, 2],
         marker=dict(
             size=0,
-            color=length_from_start_to_here,
+            color=plotted_lengths,
             colorscale='Viridis',
         ),
         line=dict(
-            color=length_from_start_to_here,
+            color=plotted_lengths,
             colorscale='Viridis',
             width=5
         )
@@ -1,4 +1,7 @@
 from compute_trajectoid import *
+import logging
+
+logging.basicConfig(level=logging.INFO)
 import matplotlib.pyplot as plt
 import numpy as np
 
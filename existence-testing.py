@@ -10,32 +10,22 @@ from compute_trajectoid import *
 from scipy.interpolate import interp1d
 # import plotly.express as px
 from matplotlib.gridspec import GridSpec
+from functools import partial
 import time
 
 def double_the_path_nosort(input_path_0, do_plot=False):
-    # input_path_0 = input_path
-    input_path_1 = np.copy(input_path_0)
-    # input_path_1[:,0] = 2*input_path_1[-1,0]-input_path_1[:,0]
-    input_path_1[:, 0] = input_path_1[-1, 0] + input_path_1[:, 0]
-    # input_path_1[:,1] = -1*input_path_1[:,1]
-
-    # input_path_1 = np.concatenate((input_path_0, np.flipud))
+    doubled_path = np.asarray(PeriodicPath(input_path_0, 2, offset=(input_path_0[-1, 0], 0)))
     if do_plot:
         plt.plot(input_path_0[:, 0], input_path_0[:, 1], '-', color='C2')#, label='Asymmetric')
-        plt.plot(input_path_1[:, 0], input_path_1[:, 1], '-', color='C0')
+        plt.plot(input_path_0[:, 0] + input_path_0[-1, 0], input_path_0[:, 1], '-', color='C0')
         plt.axis('equal')
         # plt.legend(loc='upper left')
         plt.show()
-
-    input_path_0 = np.concatenate((input_path_0, input_path_1[1:, ]), axis=0)
-    # if do_sort:
-    #     input_path_0 = sort_path(input_path_0)
-    if do_plot:
-        plt.plot(input_path_0[:, 0], input_path_0[:, 1], '-o', alpha=0.5)
+        plt.plot(doubled_path[:, 0], doubled_path[:, 1], '-o', alpha=0.5)
         plt.axis('equal')
         plt.show()
 
-    return input_path_0
+    return doubled_path
 
 def make_path_nonuniform(xlen, r, Npath = 400):
     # factor = 0.2
@@ -95,14 +85,18 @@ def mismatches_for_all_scales(input_path, minscale=0.01, maxscale=2, nframes = 1
     else:
         sweeped_scales = force_sweeped_scales
     for frame_id, scale in enumerate(tqdm(sweeped_scales, desc='Computing mismatch for all scales')):
-        logging.debug(f'Computing mismatch for scale {scale}')
+        logging.debug('Computing mismatch for scale %s', scale)
         input_path_single_section = input_path * scale
         mismatch_angles.append(mismatch_angle_for_path(input_path_single_section, recursive=False, use_cache=False))
     return sweeped_scales, np.array(mismatch_angles)
 
-def make_brownian_path(Npath = 150, seed=0, travel_length=0.1, end_with_zero=True):
-    np.random.seed(seed)
-    angles = np.random.random_sample(Npath)*2*np.pi
+def make_brownian_path(Npath = 150, seed=0, travel_length=0.1, end_with_zero=True, rng=None):
+    # If rng (np.random.Generator) is given, it is used instead of the global random state seeded by seed
+    if rng is None:
+        np.random.seed(seed)
+        angles = np.random.random_sample(Npath)*2*np.pi
+    else:
+        angles = rng.random(Npath)*2*np.pi
     xs = np.cumsum(np.cos(angles)*travel_length)
     xs = xs - xs[0]
     ys = np.cumsum(np.sin(angles)*travel_length)
@@ -187,9 +181,16 @@ def add_interval(startpoint, angle, length, Ns=30):
     return np.stack((xs, ys)).T
 
 
-def make_zigzag(a, Ns=15):
+def segments_from_intervals(angles, lengths):
+    '''Exact primitive-based counterpart of a path made by consecutive add_interval() calls.'''
+    return np.array([line_segment(angle, length) for angle, length in zip(angles, lengths)])
+
+
+def make_zigzag(a, Ns=15, return_segments=False):
     angles = [-np.pi * 3 / 8, np.pi * 3 / 8]  # , -np.pi/4, np.pi/4, -np.pi/4, np.pi/4]
     lengths = [a, np.pi / 2]  # , np.pi/2, a, np.pi/2, np.pi/2]
+    if return_segments:
+        return segments_from_intervals(angles, lengths)
     input_path = np.array([[0, 0]])
     tips = [[0, 0]]
     for i, angle in enumerate(angles):
@@ -217,7 +218,7 @@ def make_zigzag2(a):
 
 def make_zigzag_tapered(zigzag_edge_length_without_taper=np.pi / 2,
                         zigzag_corner_angle=np.pi / 4,
-                        taper_ratio=0.3, Ns=3):
+                        taper_ratio=0.3, Ns=3, return_segments=False):
     distance_from_taper_start_to_default_corner = taper_ratio * zigzag_edge_length_without_taper / 2
     taper_length = 2 * distance_from_taper_start_to_default_corner * np.sin(zigzag_corner_angle / 2)
     input_path = np.array([[0, 0]])
@@ -231,6 +232,8 @@ def make_zigzag_tapered(zigzag_edge_length_without_taper=np.pi / 2,
                taper_length,
                zigzag_edge_length_without_taper - 2 * distance_from_taper_start_to_default_corner,
                taper_length / 2]
+    if return_segments:
+        return segments_from_intervals(angles, lengths)
     tips = [[0, 0]]
     for i, angle in enumerate(angles):
         startpoint = input_path[-1, :]
@@ -243,7 +246,7 @@ def make_zigzag_tapered(zigzag_edge_length_without_taper=np.pi / 2,
 
 def make_zigzag_kinked(zigzag_edge_length_without_kink=np.pi / 2,
                         zigzag_corner_angle=np.pi / 4,
-                        kink_angle_1=0.1, kink_angle_2=0.4, Ns=3):
+                        kink_angle_1=0.1, kink_angle_2=0.4, Ns=3, return_segments=False):
     input_path = np.array([[0, 0]])
     gamma = np.pi - kink_angle_1 - kink_angle_2
     length_of_segment_1 = zigzag_edge_length_without_kink / np.sin(gamma) * np.sin(kink_angle_2)
@@ -253,6 +256,8 @@ def make_zigzag_kinked(zigzag_edge_length_without_kink=np.pi / 2,
               np.pi / 2 - zigzag_corner_angle / 2 + kink_angle_2,
               np.pi / 2 - zigzag_corner_angle / 2 - kink_angle_1]
     lengths = [length_of_segment_1, length_of_segment_2, length_of_segment_2, length_of_segment_1]
+    if return_segments:
+        return segments_from_intervals(angles, lengths)
     tips = [[0, 0]]
     for i, angle in enumerate(angles):
         startpoint = input_path[-1, :]
@@ -287,7 +292,7 @@ def make_sharp_antisymm(zigzag_edge_length_without_kink=np.pi / 2,
 
 def make_zigzag_kinked_asymm(zigzag_edge_length_without_kink=np.pi / 2,
                         zigzag_corner_angle=np.pi / 4,
-                        kink_angle_1=0.2, kink_angle_2=0.8, Ns=3, asymmetry=0.6):
+                        kink_angle_1=0.2, kink_angle_2=0.8, Ns=3, asymmetry=0.6, return_segments=False):
     kink_angle_1_b = kink_angle_1 * (1 + asymmetry)
     kink_angle_2_b = kink_angle_2 * (1 + asymmetry)
 
@@ -305,6 +310,8 @@ def make_zigzag_kinked_asymm(zigzag_edge_length_without_kink=np.pi / 2,
               np.pi / 2 - zigzag_corner_angle / 2 + kink_angle_2_b,
               np.pi / 2 - zigzag_corner_angle / 2 - kink_angle_1_b]
     lengths = [length_of_segment_1, length_of_segment_2, length_of_segment_2_b, length_of_segment_1_b]
+    if return_segments:
+        return segments_from_intervals(angles, lengths)
     tips = [[0, 0]]
     for i, angle in enumerate(angles):
         startpoint = input_path[-1, :]
@@ -323,9 +330,19 @@ def add_arc(center, start_angle, end_angle, radius, npoints):
 def make_zigzag_with_smoothed_corner(zigzag_edge_length_without_smoothing=np.pi / 2,
                         zigzag_corner_angle=np.pi / 4,
                         radius_of_curvature=0.02,
-                                     Ns=3, halfarc_segments_number=15):
+                                     Ns=3, halfarc_segments_number=15, return_segments=False):
     '''Makes an zigzag whose corners are smoothed by a given radius of curvature.
-    It consists of two straight lines and three arcs.'''
+    It consists of two straight lines and three arcs. If return_segments is True, these are returned as exact
+    primitives (see line_segment() and arc_segment() in compute_trajectoid.py) instead of points.'''
+    if return_segments:
+        arc_angle_span = np.pi/2 - zigzag_corner_angle/2
+        length_of_straight_segment = zigzag_edge_length_without_smoothing - \
+                                     2 * radius_of_curvature * np.tan(arc_angle_span)
+        return np.array([arc_segment(np.pi/2, np.pi/2 - arc_angle_span, radius_of_curvature),
+                         line_segment(-1 * (np.pi / 2 - zigzag_corner_angle / 2), length_of_straight_segment),
+                         arc_segment(-np.pi/2 - arc_angle_span, -np.pi/2 + arc_angle_span, radius_of_curvature),
+                         line_segment(np.pi / 2 - zigzag_corner_angle / 2, length_of_straight_segment),
+                         arc_segment(np.pi/2 + arc_angle_span, np.pi/2, radius_of_curvature)])
 
     # add first flat arc segment
     arc_angle_span = np.pi/2 - zigzag_corner_angle/2
@@ -444,15 +461,29 @@ def plot_gb_areas(ax, sweeped_scales, gb_areas, mark_one_scale, scale_to_mark, l
     ax.set_xlabel('Path\'s scale $\sigma = L/(2 \pi r)$')
 
 
-def select_path_by_path_type(path_parameter, path_type):
+def select_path_by_path_type(path_parameter, path_type, resampling_tolerance=None):
+    '''
+    Single period of the path of the given type. Brownian, smooth brownian and spiral paths are upsampled by index,
+    as for the published examples (indices_to_plot of animate_scale_sweep() refer to these points). If
+    resampling_tolerance is given, they are resampled by resample_path() within this tolerance instead, with far
+    fewer points.
+    '''
     if path_type == 'brownian':
         input_path_single_section = make_brownian_path(seed=0, Npath=150, travel_length=0.1)
-        input_path_single_section = upsample_path(input_path_single_section, by_factor=5)
+        if resampling_tolerance is None:
+            input_path_single_section = upsample_path(input_path_single_section, by_factor=5)
+        else:
+            input_path_single_section = resample_path(input_path_single_section, tolerance=resampling_tolerance,
+                                                      kind='linear')
     elif path_type == 'spiral':
         input_path_single_section = make_archimedes_spiral(turns=5,
                                                            rate_parameter=0.1,
                                                            npoints=150, noise_amplitude=0.2)
-        input_path_single_section = upsample_path(input_path_single_section, by_factor=5)
+        if resampling_tolerance is None:
+            input_path_single_section = upsample_path(input_path_single_section, by_factor=5)
+        else:
+            input_path_single_section = resample_path(input_path_single_section, tolerance=resampling_tolerance,
+                                                      kind='linear')
     elif path_type == 'narrow':
         # # this one worked with best_scale = 79.35082181975892,
         # input_path_single_section = make_narrow(npoints=150)
@@ -462,7 +493,11 @@ def select_path_by_path_type(path_parameter, path_type):
         input_path_single_section = make_sine(npoints=800)
     elif path_type == 'brownian-smooth':
         input_path_single_section = make_brownian_path(seed=0, Npath=150, travel_length=0.1)
-        input_path_single_section = upsample_path(input_path_single_section, by_factor=20, kind='cubic')
+        if resampling_tolerance is None:
+            input_path_single_section = upsample_path(input_path_single_section, by_factor=20, kind='cubic')
+        else:
+            input_path_single_section = resample_path(input_path_single_section, tolerance=resampling_tolerance,
+                                                      kind='cubic')
     elif path_type == 'zigzag':
         input_path_single_section, tips = make_zigzag(np.pi / 2)
     elif path_type == 'zigzag_2':
@@ -530,6 +565,8 @@ def test_trajectoid_existence(path_type='brownian', path_for_figs='examples/brow
     # input_path_single_section = make_random_path(seed=1, amplitude=3, make_ends_horizontal='both', end_with_zero=True)
     input_path_single_section = select_path_by_path_type(path_parameter, path_type)
     input_path_0 = double_the_path_nosort(input_path_single_section, do_plot=False)
+    # same path as input_path_0, but rolled one period at a time
+    periodic_path = PeriodicPath(input_path_single_section, 2, offset=(input_path_single_section[-1, 0], 0))
 
     length_of_path = length_of_the_path(input_path_single_section)
     xfactor = length_of_path / (2 * np.pi)
@@ -567,7 +604,7 @@ def test_trajectoid_existence(path_type='brownian', path_for_figs='examples/brow
 
     sweeped_scales, gb_areas = gb_areas_for_all_scales(input_path_single_section, minscale=minscale, maxscale=maxscale,
                                                        nframes=nframes, adaptive_sampling=True)
-    sweeped_scales, mismatch_angles = mismatches_for_all_scales(input_path_0, minscale=minscale, maxscale=maxscale,
+    sweeped_scales, mismatch_angles = mismatches_for_all_scales(periodic_path, minscale=minscale, maxscale=maxscale,
                                                                 nframes=nframes, force_sweeped_scales=sweeped_scales)
     np.save(path_for_figs + '/sweeped_scales.npy', sweeped_scales)
     # np.save(path_for_figs + '/sweeped_scales_gb.npy', sweeped_scales_gb)
@@ -579,7 +616,7 @@ def test_trajectoid_existence(path_type='brownian', path_for_figs='examples/brow
             range_for_searching_the_roots = [sweeped_scales[index_where_area_crosses_pi-1],
                                              sweeped_scales[index_where_area_crosses_pi]]
             logging.debug(f'Auto range for roots: {range_for_searching_the_roots}')
-        best_scale = minimize_mismatch_by_scaling(input_path_0, scale_range=range_for_searching_the_roots)
+        best_scale = minimize_mismatch_by_scaling(periodic_path, scale_range=range_for_searching_the_roots)
         logging.info(f'Best scale: {best_scale}')
 
         forced_best_scale = best_scale
@@ -662,7 +699,7 @@ def test_trajectoid_existence(path_type='brownian', path_for_figs='examples/brow
 def animate_scale_sweep(path_type='brownian', path_for_frames='examples/brownian_path_1/figures/frames_scalesweep',
                         npoints=300, minscale=0.01, maxscale=26, circle_center=[0, 0],
                         circlealpha=1, plot_solution=True, range_for_searching_the_roots='auto', path_parameter=0.1,
-                        nframes=10, indices_to_plot = [3, 7], spherical_trace_upsample_factor=100):
+                        nframes=10, indices_to_plot = [3, 7], spherical_trace_upsample_factor=100, processes=1):
     """
     Tests existence of two-period trajectoid for a given path. It will also plot the mismatch angle and the
     Gauss-Bonnet area enclosed by the first period and great arc connecting its ends. Mismatch angles and areas will be
@@ -687,17 +724,21 @@ def animate_scale_sweep(path_type='brownian', path_for_frames='examples/brownian
                             points on the flat plot and on the spherical trace
     :param spherical_trace_upsample_factor: Integer. The path will be upsampled by this factor before plotting its trace
                                             on the sphere.
+    :param processes: Integer or None. Number of processes rendering contiguous ranges of frames in parallel
+                      (None for all CPU cores). See render_scale_sweep_frames().
     """
     # input_path_single_section = make_random_path(seed=1, amplitude=3, make_ends_horizontal='both', end_with_zero=True)
     input_path_single_section = select_path_by_path_type(path_parameter, path_type)
     input_path_0 = double_the_path_nosort(input_path_single_section, do_plot=False)
+    # same path as input_path_0, but rolled one period at a time
+    periodic_path = PeriodicPath(input_path_single_section, 2, offset=(input_path_single_section[-1, 0], 0))
     length_of_path = length_of_the_path(input_path_single_section)
     logging.info(f'Path length over 2 pi: {length_of_path / (np.pi * 2)}')
     xfactor = length_of_path / (2 * np.pi)
 
     sweeped_scales, gb_areas = gb_areas_for_all_scales(input_path_single_section, minscale=minscale, maxscale=maxscale,
                                                        nframes=npoints, adaptive_sampling=True)
-    sweeped_scales, mismatch_angles = mismatches_for_all_scales(input_path_0, minscale=minscale, maxscale=maxscale,
+    sweeped_scales, mismatch_angles = mismatches_for_all_scales(periodic_path, minscale=minscale, maxscale=maxscale,
                                                                 nframes=npoints,
                                                                 force_sweeped_scales=sweeped_scales)
 
@@ -707,87 +748,105 @@ def animate_scale_sweep(path_type='brownian', path_for_frames='examples/brownian
             range_for_searching_the_roots = [sweeped_scales[index_where_area_crosses_pi-1],
                                              sweeped_scales[index_where_area_crosses_pi]]
             print(f'Auto range for roots: {range_for_searching_the_roots}')
-        best_scale = minimize_mismatch_by_scaling(input_path_0, scale_range=range_for_searching_the_roots)
+        best_scale = minimize_mismatch_by_scaling(periodic_path, scale_range=range_for_searching_the_roots)
         print(f'Best scale: {best_scale}')
         maxscale = best_scale
 
     list_of_scales_to_plot = np.linspace(0.01, maxscale, nframes)
-    t0 = time.time()
-    mlab.options.offscreen = True
-    for frame_id, scale_to_plot in enumerate(tqdm(list_of_scales_to_plot, desc='Animation frame')):
-        # print(f'Animation frame {frame_id}, scale {scale_to_plot:.3f}, ETA: {(time.time()-t0)/(frame_id + 1)*(nframes - frame_id)/60:.1f} min')
-        path_for_united_fig = path_for_frames + f'/{frame_id:06d}.png'
-        fig = plt.figure(figsize=(8,8))
-        fig.suptitle(f'Scale $L/(2 \pi r)$: {scale_to_plot * xfactor:.3f}')
-        gs1 = GridSpec(3, 2, left=0.15, right=0.95, wspace=0.05, height_ratios=[2, 1, 1])
-        ax_path = fig.add_subplot(gs1[0, 0])
-        ax_trace = fig.add_subplot(gs1[0, 1])
-        ax_angle = fig.add_subplot(gs1[1, :])
-        ax_area = fig.add_subplot(gs1[2, :])
-
-        # Plot flat path with color along the path
-        plot_flat_path_with_color(input_path_0, input_path_single_section, ax_path)
-        # plot certain points
-        certain_point_colors = ['blue', 'lime']
-                           # int(round(input_path_single_section.shape[0] * 0.25)),
-                           # int(round(input_path_single_section.shape[0] * 0.75))]
-        ax_path.scatter(input_path_single_section[indices_to_plot, 0], input_path_single_section[indices_to_plot, 1],
-                        color=certain_point_colors, s=30)
-        # plot circle showing relative diameter of the sphere
-        circle_rad = 1 / scale_to_plot
+    render_frame_range = partial(render_scale_sweep_frames, scales=list_of_scales_to_plot,
+                                 path_for_frames=path_for_frames, input_path_0=input_path_0,
+                                 input_path_single_section=input_path_single_section,
+                                 sweeped_scales=sweeped_scales, mismatch_angles=mismatch_angles, gb_areas=gb_areas,
+                                 length_of_path=length_of_path, maxscale=maxscale, circle_center=circle_center,
+                                 circlealpha=circlealpha, plot_solution=plot_solution,
+                                 indices_to_plot=indices_to_plot,
+                                 spherical_trace_upsample_factor=spherical_trace_upsample_factor)
+    render_frames_in_parallel(render_frame_range, range(nframes), processes=processes)
+
+
+def render_scale_sweep_frames(frame_ids, scales, path_for_frames, input_path_0, input_path_single_section,
+                              sweeped_scales, mismatch_angles, gb_areas, length_of_path, maxscale, circle_center,
+                              circlealpha, plot_solution, indices_to_plot, spherical_trace_upsample_factor):
+    """
+    Renders frames frame_ids of animate_scale_sweep(). The figure and the 3D scene are built once, with all the static
+    curves, and every frame only updates the title, the circle, the markers and the trace on the sphere.
+    Traces for all the frames are computed at once by traces_on_sphere_for_scales().
+    """
+    xfactor = length_of_path / (2 * np.pi)
+    scales_here = scales[frame_ids]
+    upsampled_path_0 = upsample_path(input_path_0, by_factor=spherical_trace_upsample_factor)
+    sphere_traces = traces_on_sphere_for_scales(upsampled_path_0, scales_here)
+    # traces of the original points, for marking certain points and the ends of the path
+    sphere_traces_of_nodes = traces_on_sphere_for_scales(input_path_0, scales_here)
+    net_rotations = net_rotations_for_scalings(input_path_0, scales_here, scales_here)
+    marked_mismatch_angles = np.arccos(np.clip((np.trace(net_rotations, axis1=1, axis2=2) - 1) / 2, -1, 1))
+    marked_gb_areas = interp1d(sweeped_scales, gb_areas)(scales_here)
+
+    fig = plt.figure(figsize=(8,8))
+    title = fig.suptitle('')
+    gs1 = GridSpec(3, 2, left=0.15, right=0.95, wspace=0.05, height_ratios=[2, 1, 1])
+    ax_path = fig.add_subplot(gs1[0, 0])
+    ax_trace = fig.add_subplot(gs1[0, 1])
+    ax_angle = fig.add_subplot(gs1[1, :])
+    ax_area = fig.add_subplot(gs1[2, :])
+
+    # Plot flat path with color along the path
+    plot_flat_path_with_color(input_path_0, input_path_single_section, ax_path)
+    # plot certain points
+    certain_point_colors = ['blue', 'lime']
+    ax_path.scatter(input_path_single_section[indices_to_plot, 0], input_path_single_section[indices_to_plot, 1],
+                    color=certain_point_colors, s=30)
+    # circle showing relative diameter of the sphere
+    circle1 = plt.Circle((circle_center[0], circle_center[1]),
+                         1 / scales_here[0], fill=False, linewidth=2, edgecolor='C1', alpha=circlealpha)
+    if plot_solution:
+        ax_path.add_patch(circle1)
+    ax_path.set_aspect('equal', adjustable='datalim')
+    ax_path.set_axis_off()
+    path_lower_corner = np.min(input_path_0, axis=0)
+    path_upper_corner = np.max(input_path_0, axis=0)
+
+    plot_mismatches_vs_scale(ax_angle, input_path_0, sweeped_scales, mismatch_angles, mark_one_scale=False,
+                             scale_to_mark=None, length_of_path=length_of_path)
+    plot_gb_areas(ax_area, sweeped_scales, gb_areas, mark_one_scale=False, scale_to_mark=None,
+                  length_of_path=length_of_path)
+    angle_marker = ax_angle.scatter([0], [0], s=20, color='red', visible=plot_solution)
+    area_marker = ax_area.scatter([0], [0], s=20, color='red', visible=plot_solution)
+    for ax in [ax_angle, ax_area]:
+        ax.set_aspect('auto')
+        ax.set_xlim(-1 * xfactor, maxscale * xfactor)
+
+    colors_of_trace_points = [(0, 0, 1), (0, 1, 0)]
+    scene = SphereTraceScene(sphere_traces[0], cumsum_half_length_along_the_path(upsampled_path_0),
+                             marker_colors=colors_of_trace_points + [(0, 0, 0), (0, 0, 0)], marker_radius=0.1,
+                             sphere_opacity=0.6)
+    trace_image = ax_trace.imshow(scene.screenshot())
+    ax_trace.set_axis_off()
+
+    for k, frame_id in enumerate(tqdm(frame_ids, desc='Animation frame')):
+        scale_to_plot = scales_here[k]
+        title.set_text(f'Scale $L/(2 \\pi r)$: {scale_to_plot * xfactor:.3f}')
         if plot_solution:
-            circle1 = plt.Circle((circle_center[0], circle_center[1]),
-                                 circle_rad, fill=False, linewidth=2, edgecolor='C1', alpha=circlealpha)
-            ax_path.add_patch(circle1)
-        ## Add colorbar for figures in the paper
-        # cbar = fig.colorbar(line, ax=axs)
-        # cbar.set_label('Distance along the period')
-        ax_path.set_aspect('equal', adjustable='datalim')
-        ax_path.set_axis_off()
-
-        plot_mismatches_vs_scale(ax_angle, input_path_0, sweeped_scales, mismatch_angles,
-                                 mark_one_scale=plot_solution,
-                                 scale_to_mark=scale_to_plot,
-                                 length_of_path=length_of_path)
-        plot_gb_areas(ax_area, sweeped_scales, gb_areas, mark_one_scale=plot_solution,
-                      scale_to_mark=scale_to_plot,
-                      length_of_path=length_of_path)
-        for ax in [ax_angle, ax_area]:
-            ax.set_aspect('auto')
-            ax.set_xlim(-1 * xfactor, maxscale * xfactor)
-
-        # Plot the 3D and show it in the matplotlib subplot
-        mfig = plot_spherical_trace_with_color_along_the_trace(
-            upsample_path(input_path_0, by_factor=spherical_trace_upsample_factor),
-            upsample_path(input_path_single_section, by_factor=spherical_trace_upsample_factor), scale_to_plot,
-            sphere_opacity=0.6)
-        # plot certain points
-        point_radius = 0.1
-        sphere_trace_single_section = trace_on_sphere(scale_to_plot * input_path_single_section, kx=1, ky=1)
-        colors_of_trace_points = [(0, 0, 1), (0, 1, 0)]
-        for i, index_to_plot in enumerate(indices_to_plot):
-            point_here = sphere_trace_single_section[index_to_plot]
-            mlab.points3d(point_here[0], point_here[1], point_here[2], scale_factor=point_radius, color=colors_of_trace_points[i])
-        sphere_trace_full = trace_on_sphere(scale_to_plot * input_path_0, kx=1, ky=1)
-        for point_here in [sphere_trace_full[-1], sphere_trace_full[0]]:
-            mlab.points3d(point_here[0], point_here[1], point_here[2], scale_factor=point_radius, color=(0, 0, 0))
-
-        # img = mlab.screenshot()
-        f = mlab.gcf()
-        f.scene._lift()
-        cam = mfig.scene.camera
-        cam.zoom(1.7)
-        img = mlab.screenshot(figure=mfig, mode='rgba', antialiased=True)
-        mlab.show()
-        mlab.close(all=True)
-        ax_trace.imshow(img)
-        ax_trace.set_axis_off()
-
-        fig.savefig(path_for_united_fig, dpi=300)
-        # plt.show()
-        plt.close(fig)
+            circle1.set_radius(1 / scale_to_plot)
+            # relim() ignores collections in older matplotlib, so the limits are set from the bounding box of the
+            # path and the circle, with the default margins
+            lower_corner = np.minimum(path_lower_corner, np.array(circle_center) - 1 / scale_to_plot)
+            upper_corner = np.maximum(path_upper_corner, np.array(circle_center) + 1 / scale_to_plot)
+            margins = 0.05 * (upper_corner - lower_corner)
+            ax_path.set_xlim(lower_corner[0] - margins[0], upper_corner[0] + margins[0])
+            ax_path.set_ylim(lower_corner[1] - margins[1], upper_corner[1] + margins[1])
+        angle_marker.set_offsets([[scale_to_plot * xfactor, 180 / np.pi * marked_mismatch_angles[k]]])
+        area_marker.set_offsets([[scale_to_plot * xfactor, marked_gb_areas[k]]])
+        nodes = sphere_traces_of_nodes[k]
+        scene.update(sphere_traces[k], [nodes[index] for index in indices_to_plot] + [nodes[-1], nodes[0]])
+        trace_image.set_data(scene.screenshot())
+        fig.savefig(path_for_frames + f'/{frame_id:06d}.png', dpi=300)
+    scene.close()
+    plt.close(fig)
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
     # UNCOMMENT NEEDED PARTS BELOW TO TEST TWO-PERIOD TRAJECTOID EXISTENCE FOR VARIOUS PATHS
 
     # test_trajectoid_existence(path_type='brownian', path_for_figs='examples/brownian_path_1/figures',
@@ -1,4 +1,7 @@
 from compute_trajectoid import *
+import logging
+
+logging.basicConfig(level=logging.INFO)
 
 data0 = get_trajectory_from_raster_image('examples/ibs-v5/ibs_v5-01.png')
 # compute_shape(data0, kx=1.0678, ky=0.8009,
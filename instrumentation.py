@@ -0,0 +1,163 @@
+'''
+Opt-in instrumentation of the design pipeline: wall time and number of calls of every instrumented function,
+grouped by stage (rolling, areas, root finding, bridges, mesh export, verification, plotting), and event counters
+(evaluations of spherical traces, hits and misses of the rotation cache, etc.), attributed both to the whole run and
+to the innermost instrumented function running at the moment.
+
+Usage:
+    from instrumentation import profiling
+    with profiling() as report:
+        compute_shape(...)
+    print(report.summary())
+    report.save_json('profile.json')
+
+Outside of a profiling() context, an instrumented function costs one extra call and one check of a global
+variable, and count() returns right away. Only the calling process is profiled: work done in multiprocessing
+pools is accounted as the time of the instrumented function that waits for the pool.
+'''
+import functools
+import json
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+# report of the profiling() context that is currently active, if any
+_active_report = None
+
+
+class ProfilingReport:
+    '''Timings and counters collected within one profiling() context.'''
+
+    def __init__(self):
+        # (stage, function name) -> number of calls, total time, self time (excluding nested instrumented calls)
+        self.calls = defaultdict(int)
+        self.total_time = defaultdict(float)
+        self.self_time = defaultdict(float)
+        self.counters_by_function = defaultdict(lambda: defaultdict(int))
+        self.counters = defaultdict(int)
+        self.wall_time = None
+        self._started_at = time.perf_counter()
+        # stack of [key, start time, time spent in nested instrumented calls]
+        self._stack = []
+
+    def _enter(self, key):
+        self._stack.append([key, time.perf_counter(), 0.0])
+
+    def _exit(self):
+        key, started_at, nested_time = self._stack.pop()
+        elapsed = time.perf_counter() - started_at
+        self.calls[key] += 1
+        # recursive calls of the same function are counted once in the total time
+        if not any(frame[0] == key for frame in self._stack):
+            self.total_time[key] += elapsed
+        self.self_time[key] += elapsed - nested_time
+        if self._stack:
+            self._stack[-1][2] += elapsed
+
+    def count(self, name, increment=1):
+        self.counters[name] += increment
+        if self._stack:
+            self.counters_by_function[self._stack[-1][0]][name] += increment
+
+    def rates(self):
+        '''Derived ratios of the counters, e.g. the hit rate of the rotation cache'''
+        rates = dict()
+        hits = self.counters.get('rotation_cache_hits', 0)
+        misses = self.counters.get('rotation_cache_misses', 0)
+        if hits + misses:
+            rates['rotation_cache_hit_rate'] = hits / (hits + misses)
+        return rates
+
+    def stage_times(self):
+        '''Self time and number of calls summed over the functions of every stage. Self times of all stages add up
+        to the time spent in instrumented functions, without double counting of nested calls.'''
+        stages = defaultdict(lambda: {'calls': 0, 'self_time': 0.0})
+        for (stage, function_name), calls in self.calls.items():
+            stages[stage]['calls'] += calls
+            stages[stage]['self_time'] += self.self_time[(stage, function_name)]
+        return dict(stages)
+
+    def to_dict(self):
+        functions = [{'stage': stage,
+                      'function': function_name,
+                      'calls': calls,
+                      'total_time': self.total_time[(stage, function_name)],
+                      'self_time': self.self_time[(stage, function_name)],
+                      'counters': dict(self.counters_by_function.get((stage, function_name), {}))}
+                     for (stage, function_name), calls in self.calls.items()]
+        functions.sort(key=lambda x: x['self_time'], reverse=True)
+        return {'wall_time': self.wall_time,
+                'stages': self.stage_times(),
+                'functions': functions,
+                'counters': dict(self.counters),
+                'rates': self.rates()}
+
+    def save_json(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.to_dict(), f, indent=1)
+
+    def summary(self):
+        '''Text table of the stages, functions and counters, slowest first'''
+        report = self.to_dict()
+        wall_time = report['wall_time'] if report['wall_time'] is not None else time.perf_counter() - self._started_at
+        lines = [f'Wall time: {wall_time:.3f} s', '', f'{"Stage":<20} {"Calls":>10} {"Self time, s":>14} {"%":>6}']
+        for stage, stage_time in sorted(report['stages'].items(), key=lambda x: x[1]['self_time'], reverse=True):
+            lines.append(f'{stage:<20} {stage_time["calls"]:>10} {stage_time["self_time"]:>14.4f} '
+                         f'{100 * stage_time["self_time"] / wall_time:>6.1f}')
+        lines += ['', f'{"Function":<45} {"Calls":>10} {"Total, s":>10} {"Self, s":>10}']
+        for function in report['functions']:
+            name = f'{function["stage"]}/{function["function"]}'
+            lines.append(f'{name:<45} {function["calls"]:>10} {function["total_time"]:>10.4f} '
+                         f'{function["self_time"]:>10.4f}')
+        if report['counters']:
+            lines += ['', 'Counters:']
+            lines += [f'  {name}: {value}' for name, value in sorted(report['counters'].items())]
+        for name, value in report['rates'].items():
+            lines.append(f'  {name}: {value:.3f}')
+        return '\n'.join(lines)
+
+
+@contextmanager
+def profiling():
+    '''Collects timings and counters of the instrumented functions called within the context into the yielded
+    ProfilingReport. Contexts can be nested; the inner one collects into its own report.'''
+    global _active_report
+    previous_report = _active_report
+    report = ProfilingReport()
+    _active_report = report
+    try:
+        yield report
+    finally:
+        report.wall_time = time.perf_counter() - report._started_at
+        _active_report = previous_report
+
+
+def is_profiling():
+    return _active_report is not None
+
+
+def instrumented(stage):
+    '''Decorator recording wall time and number of calls of the function as a part of the stage, when profiling.'''
+    def decorator(function):
+        key = (stage, function.__name__)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            report = _active_report
+            if report is None:
+                return function(*args, **kwargs)
+            report._enter(key)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                report._exit()
+
+        return wrapper
+
+    return decorator
+
+
+def count(name, increment=1):
+    '''Increments the counter of events (e.g. 'trace_evaluations') when profiling.'''
+    if _active_report is not None:
+        _active_report.count(name, increment)
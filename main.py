@@ -20,6 +20,14 @@ manual_scale_max = 0.7 #@param {type:"number"}
 #@markdown If you choose to generate random path, this number will be used as seed for the random number generator. Change it to get different paths.
 random_seed = 0 #@param {type:"number"}
 
+#@markdown Cutting boxes that change the shape by less than this distance, in units of the radius of the core sphere (`core_radius`), are skipped. This makes the rendering of the shape faster. Set to zero to keep all the boxes.
+pruning_tolerance = 0.001 #@param {type:"number"}
+
+#@markdown Minimum and maximum diameters of the trajectoid in millimeters. Use the same values as in the cell that makes the printable shape: the outer sphere of radius max/min (in units of `core_radius`) decides which boxes can be pruned.
+min_diameter_of_trajectoid = '40' #@param {type:"string"}
+max_diameter_of_trajectoid = '50' #@param {type:"string"}
+outer_geosphere_R = float(max_diameter_of_trajectoid)/float(min_diameter_of_trajectoid)
+
 def plot_gb_areas(ax, sweeped_scales, gb_areas, mark_one_scale, scale_to_mark, length_of_path, x_limit_of_curve=None):
     ii = np.searchsorted(sweeped_scales, scale_to_mark)
     gb_areas = np.insert(gb_areas, ii, np.pi * np.sign(interpolate.interp1d(sweeped_scales, gb_areas)(scale_to_mark)))
@@ -60,14 +68,7 @@ elif source_of_path == 'drawing':
     plt.title('Path obtained from your drawing')
     plt.show()
 # elif source_of_path == 'csv file':
-#     input_path_single_section = np.genfromtxt(csv_filename, delimiter=',')
-#     xs = input_path_single_section[:, 0]
-#     ys = input_path_single_section[:, 1]
-#     xs = xs - xs[0]
-#     ys = ys - ys[0]
-#     ys = ys - xs * (ys[-1] - ys[0]) / (xs[-1] - xs[0])
-#     input_path_single_section[:, 0] = xs
-#     input_path_single_section[:, 1] = ys
+#     input_path_single_section = get_trajectory_from_csv(csv_filename, start_from_zero=True, end_with_zero=True)
 #     plt.plot(input_path_single_section[:, 0], input_path_single_section[:, 1],
 #              color='black')
 #     plt.axis('equal')
@@ -116,11 +117,12 @@ plot_three_path_periods(input_path, plot_midpoints=True, savetofile=os.path.join
 plt.gca().set_title('Several periods of the target path')
 
 ## Make cut meshes for trajectoid
-compute_shape(input_path, kx=1, ky=1,
-              folder_for_path=os.path.join(target_folder,'folder_for_path'),
-              folder_for_meshes=os.path.join(target_folder,'cut_meshes'),
-              core_radius=1, cut_size = 10)
+cutting_transforms = compute_shape(input_path, kx=1, ky=1,
+                                   folder_for_path=os.path.join(target_folder,'folder_for_path'),
+                                   folder_for_meshes=os.path.join(target_folder,'cut_meshes'),
+                                   core_radius=1, cut_size = 10, prune_tolerance=pruning_tolerance,
+                                   outer_radius=outer_geosphere_R, export_mode='transforms_npy')
 
-number_of_boxes = input_path.shape[0]
+number_of_boxes = cutting_transforms.shape[0]
 print(number_of_boxes)
 print("Execution finished.")
\ No newline at end of file
@@ -1,4 +1,7 @@
 import viewscad
+import numpy as np
+import trimesh
+from compute_trajectoid_in_colab import make_openscad_code
 r = viewscad.Renderer(openscad_exec="openscad")
 #@title ## ↓↓↓ Press this button after setting the parameters below. Be patient: execution can take several minutes.
 
@@ -12,44 +15,24 @@ min_diameter_of_trajectoid = '40' #@param {type:"string"}
 
 #@markdown Maximum diameter of trajectoid in millimeters (corresponds to value of 2R in the research article):
 max_diameter_of_trajectoid = '50' #@param {type:"string"}
-number_of_boxes=298
 cavity_r = float(diameter_of_inner_cavity)/float(min_diameter_of_trajectoid)
 outer_geosphere_R = float(max_diameter_of_trajectoid)/float(min_diameter_of_trajectoid)
 # print(f'r: {cavity_r}, R: {outer_geosphere_R}')
 
-trajectoid_oscad = """masterscale=$masc;
-
-module cutter_cube(i) {
-    import(str("C:/Users/Willian Murayama/github/trajectoids/test/cut_meshes/test_",i,".stl"));
-}
-
-module geosphere(radius) {
-    scale([radius, radius, radius]) import("C:/Users/Willian Murayama/github/trajectoids/unit_geosphere.stl");
-}
-
-module cube_for_halving() {
-    translate([-10,0,-10]) cube(size = [20, 20, 20], center = false);
-}
-
-scale([masterscale, masterscale, masterscale]) difference() {
-    geosphere(radius=$outergeorad);
-    geosphere(radius=$innergeorad);
-    cube_for_halving();
-    for (i =[0:$numberofboxes]) cutter_cube(i);
-    // cutter_cube(0);
-    // cutter_cube(189);
-}
-""".replace('$numberofboxes', str(number_of_boxes))\
-.replace('$innergeorad', str(cavity_r))\
-.replace('$outergeorad', str(outer_geosphere_R))\
-.replace('$masc', str(float(min_diameter_of_trajectoid)/2))
+# transforms of cutting boxes saved by main.py
+cutting_transforms = np.load('test/cut_meshes/cutting_transforms.npy')
+geosphere = trimesh.load('unit_geosphere.stl')
+
+def trajectoid_oscad(halving):
+    return make_openscad_code(cutting_transforms, core_radius=1, cut_size=10,
+                              outer_radius=outer_geosphere_R, cavity_radius=cavity_r,
+                              masterscale=float(min_diameter_of_trajectoid)/2,
+                              halving=halving, geosphere=geosphere)
 
 print('Calculating the left half of the shape...')
-r.render(trajectoid_oscad, outfile='trajectoid_half_left.stl')
+r.render(trajectoid_oscad(halving='left'), outfile='trajectoid_half_left.stl')
 
 print('Calculating the right half of the shape...')
-r.render(trajectoid_oscad.replace('translate([-10,0,-10])',
-                                  'translate([-10,-20,-10])'),
-         outfile='trajectoid_half_right.stl')
+r.render(trajectoid_oscad(halving='right'), outfile='trajectoid_half_right.stl')
 
 print("Execution finished.")
\ No newline at end of file
@@ -2,6 +2,9 @@ import matplotlib.pyplot as plt
 import numpy as np
 
 from compute_trajectoid import *
+import logging
+
+logging.basicConfig(level=logging.INFO)
 
 def make_path_nonuniform(xlen, r, Npath = 400):
     # factor = 0.2
@@ -18,7 +21,16 @@ def make_path_nonuniform(xlen, r, Npath = 400):
     input_path = np.stack((xs, ys)).T
     return input_path
 
-def make_path(xlen, r, Npath = 400, do_double=True):
+def make_path(xlen, r, Npath = 400, do_double=True, return_segments=False):
+    if return_segments:
+        # the same path as exact line and arc primitives
+        segments = np.array([line_segment(0, xlen/2 - r),
+                             arc_segment(np.pi, 0, r),
+                             line_segment(0, xlen/2 - r)])
+        if do_double:
+            segments = np.concatenate((segments, segments), axis=0)
+        return segments
+
     # first linear section
     step_size = xlen/Npath
     overall_xs = np.linspace(0, xlen/2 - r, int(round(xlen/2 - r)/step_size))
@@ -45,31 +57,31 @@ def make_path(xlen, r, Npath = 400, do_double=True):
 
     return input_path
 
-def plot_mismatch_map_for_penannular(N=60, M=60, kx_range=(0.1, 5*np.pi), kr_range=(0.01, 1.5*np.pi)):
+def rotations_for_penannular(kxs, rs):
+    # net rotations of the doubled penannular paths of total lengths kxs and radii rs; NaN where kx < 2r
+    rotations = np.full(shape=(len(kxs), 3, 3), fill_value=np.nan)
+    for k, (kx, r) in enumerate(zip(kxs, rs)):
+        if kx >= 2*r:
+            rotations[k] = rotation_for_segments(make_path(xlen=kx, r=r, return_segments=True))[:3, :3]
+    return rotations
+
+
+def plot_mismatch_map_for_penannular(N=60, M=60, kx_range=(0.1, 5*np.pi), kr_range=(0.01, 1.5*np.pi),
+                                     refine_levels=0):
     # sweeping parameter space for optimal match of the starting and ending orientation
-    angles = np.zeros(shape=(N, M))
-    xs = np.zeros_like(angles)
-    ys = np.zeros_like(angles)
-    for i, kx in enumerate(np.linspace(kx_range[0], kx_range[1], N)):
-        print(i)
-        for j, r in enumerate(np.linspace(kr_range[0], kr_range[1], M)):
-            xs[i, j] = kx
-            ys[i, j] = r
-            if kx<2*r:
-                angles[i, j] = np.nan
-            else:
-                data = make_path(xlen=kx, r=r)
-                rotation_of_entire_traj = trimesh.transformations.rotation_from_matrix(rotation_to_origin(data.shape[0]-1, data))
-                angle = rotation_of_entire_traj[0]
-                angles[i, j] = angle
-
-    print('Min angle = {0}'.format(np.min(np.abs(angles))))
+    xs, ys, angles, contours = compute_mismatch_map(rotations_for_penannular, kx_range=kx_range, ky_range=kr_range,
+                                                    N=N, M=M, refine_levels=refine_levels)
+
+    print('Min angle = {0}'.format(np.nanmin(np.abs(angles))))
     f3 = plt.figure(3)
     plt.pcolormesh(xs, ys, np.abs(angles), cmap='viridis')
     plt.colorbar()
+    for contour in contours:
+        plt.plot(contour[:, 0], contour[:, 1], color='red')
     plt.ylabel('radius')
     plt.xlabel('total length')
     plt.show()
+    return contours
 
 path = make_path(2*np.pi, 0.5)
 plt.scatter(path[:, 0], path[:, 1], alpha=0.5, color='C0')
@@ -95,7 +107,7 @@ input_path = make_path(xlen=3.81, r=1.23, Npath=150)
 input_path_single_section = make_path(xlen=3.81, r=1.23, Npath=150, do_double=False)
 _ = double_the_path(input_path_single_section, do_plot=True)
 
-best_scale = minimize_mismatch_by_scaling(input_path, scale_range=(0.9, 1.1))
+best_scale = minimize_mismatch_by_scaling(double_the_path(input_path_single_section, lazy=True), scale_range=(0.9, 1.1))
 input_path = input_path * best_scale
 input_path_single_section = input_path_single_section * best_scale
 
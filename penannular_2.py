@@ -2,6 +2,9 @@ import matplotlib.pyplot as plt
 import numpy as np
 
 from compute_trajectoid import *
+import logging
+
+logging.basicConfig(level=logging.INFO)
 
 def make_path_nonuniform(xlen, r, Npath = 400):
     # factor = 0.2
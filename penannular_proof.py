@@ -3,6 +3,9 @@ import numpy as np
 import mayavi
 
 from compute_trajectoid import *
+import logging
+
+logging.basicConfig(level=logging.INFO)
 
 def make_path_nonuniform(xlen, r, Npath = 400):
     # factor = 0.2
@@ -211,29 +214,40 @@ def make_animation_of_scaling_sweep(tube_radius = 0.01,
     plot_sphere(r0=core_radius - tube_radius, line_radius=tube_radius / sphere_lines_are_thinner_by)
     align_view(mfig)
     nframes = 100
+    scales = np.linspace(0.1*best_scale, best_scale, nframes)
+    # traces for all the frames at once; every frame then only updates the data of the same scene objects
+    unscaled_single_section = make_path(xlen=3.81, r=1.23, Npath=150, do_double=False)
+    sphere_traces = traces_on_sphere_for_scales(unscaled_single_section, scales)
+    net_rotation_matrix = trimesh.transformations.identity_matrix()
     mismatch_angles = []
-    for frame_id, scale in enumerate(np.linspace(0.1*best_scale, best_scale, nframes)):
+    for net_rotation in net_rotations_for_scalings(unscaled_single_section, scales, scales):
+        net_rotation_matrix[:3, :3] = net_rotation
+        mismatch_angles.append(trimesh.transformations.rotation_from_matrix(net_rotation_matrix)[0])
+    objects = None
+    for frame_id, scale in enumerate(scales):
         print(f'Frame: {frame_id}, scale: {scale}')
-        input_path_single_section = make_path(xlen=3.81, r=1.23, Npath=150, do_double=False) * scale
-        sphere_trace_single_section = trace_on_sphere(input_path_single_section, kx=1, ky=1)
-        mismatch_angles.append(mismatch_angle_for_path(input_path_single_section))
-        object1 = mlab.plot3d(sphere_trace_single_section[:, 0],
-                        sphere_trace_single_section[:, 1],
-                        sphere_trace_single_section[:, 2], color=(0, 1, 0),
-                        tube_radius=tube_radius)
+        sphere_trace_single_section = sphere_traces[frame_id]
         arc_here = bridge_two_points_by_arc(sphere_trace_single_section[0, :], sphere_trace_single_section[-1, :], npoints=30)
-        object2 = mlab.plot3d(arc_here[:, 0],
-                        arc_here[:, 1],
-                        arc_here[:, 2], color=(1, 0, 0),
-                        tube_radius=tube_radius)
-        points_list = []
-        for point_here in [sphere_trace_single_section[0, :], sphere_trace_single_section[-1, :]]:
-            points_list.append(mlab.points3d(point_here[0], point_here[1], point_here[2], scale_factor=0.05, color=(0, 0, 0)))
+        end_points = [sphere_trace_single_section[0, :], sphere_trace_single_section[-1, :]]
+        if objects is None:
+            object1 = mlab.plot3d(sphere_trace_single_section[:, 0],
+                            sphere_trace_single_section[:, 1],
+                            sphere_trace_single_section[:, 2], color=(0, 1, 0),
+                            tube_radius=tube_radius)
+            object2 = mlab.plot3d(arc_here[:, 0],
+                            arc_here[:, 1],
+                            arc_here[:, 2], color=(1, 0, 0),
+                            tube_radius=tube_radius)
+            points_list = []
+            for point_here in end_points:
+                points_list.append(mlab.points3d(point_here[0], point_here[1], point_here[2], scale_factor=0.05, color=(0, 0, 0)))
+            objects = [object1, object2]
+        else:
+            for x, line_here in zip(objects, [sphere_trace_single_section, arc_here]):
+                x.mlab_source.set(x=line_here[:, 0], y=line_here[:, 1], z=line_here[:, 2])
+            for x, point_here in zip(points_list, end_points):
+                x.mlab_source.set(x=[point_here[0]], y=[point_here[1]], z=[point_here[2]])
         mlab.savefig(frames_folder + '{0:08d}.png'.format(frame_id))
-        for x in [object1, object2]:
-            x.remove()
-        for x in points_list:
-            x.remove()
     return np.array(mismatch_angles)
 
 def mismatches_for_all_scales():
@@ -3,6 +3,9 @@ import numpy as np
 import mayavi
 
 from compute_trajectoid import *
+import logging
+
+logging.basicConfig(level=logging.INFO)
 
 def make_path_nonuniform(xlen, r, Npath = 400):
     # factor = 0.2
@@ -1,13 +1,17 @@
 import numpy as np
 
 from compute_trajectoid import *
+import logging
+
+logging.basicConfig(level=logging.INFO)
 #
 target_folder='examples/random_doubled_1'
 
 # input_path_single_section = make_random_path(seed=1, amplitude=3, make_ends_horizontal='both', end_with_zero=True)
 input_path_single_section = make_random_path(seed=0, make_ends_horizontal=False, start_from_zero=True, end_with_zero=True, amplitude=3)
 
-input_path_0 = double_the_path(input_path_single_section, do_plot=True)
+# the period is sorted by x, so the doubled path is a PeriodicPath and each period is rolled only once
+input_path_0 = double_the_path(input_path_single_section, do_plot=True, lazy=True)
 
 do_plot = True
 npoints = 30
@@ -17,7 +21,7 @@ print(f'Best scale: {best_scale}')
 # Minimized mismatch angle = -2.6439127092433114e-05
 # Best scale: 0.6387022944333781
 
-input_path = best_scale * input_path_0
+input_path = best_scale * np.asarray(input_path_0)
 sphere_trace = trace_on_sphere(input_path, kx=1, ky=1)
 sphere_trace_single_section = trace_on_sphere(input_path_single_section * best_scale, kx=1, ky=1)
 if do_plot:
@@ -6,9 +6,12 @@ from skimage.morphology import convex_hull_image, remove_small_objects
 from scipy.ndimage.measurements import center_of_mass
 from skimage.measure import label
 from scipy import interpolate
-from scipy.optimize import curve_fit
-from compute_trajectoid import rotate_2d
+from scipy.optimize import least_squares
+from compute_trajectoid import load_path, resample_by_arc_length, offsets_to_polyline, polyline_segment_tree
 import os
+import multiprocessing
+import threading
+import queue
 from tqdm import tqdm
 
 
@@ -27,31 +30,476 @@ def number_of_files(target_dir):
 
 def convert_to_signal(raw_frame, two_colors=False):
     if not two_colors:
-        return raw_frame[:, :, 2].astype(np.float) - raw_frame[:, :, 1].astype(np.float) + raw_frame[:, :, 0].astype(
-            np.float)
+        return raw_frame[:, :, 2].astype(float) - raw_frame[:, :, 1].astype(float) + raw_frame[:, :, 0].astype(float)
     else:
-        return raw_frame[:, :, 1].astype(np.float) + 1.5 * raw_frame[:, :, 0].astype(np.float)
+        return raw_frame[:, :, 1].astype(float) + 1.5 * raw_frame[:, :, 0].astype(float)
         # return -raw_frame[:, :, 2].astype(np.float) + raw_frame[:, :, 1].astype(np.float) + raw_frame[:, :, 0].astype(
         # np.float)
 
 
-def get_median_frame(min_frame, target_folder, nframes, step=10, two_colors=False):
-    list_of_frames = []
-    for frame_id in range(0, nframes, step):
-        print(f'Loading frame {frame_id} for background.')
-        if frame_id < min_frame:
-            continue
-        frame_file = target_folder + '/frames/frame{0:03d}.jpg'.format(frame_id)
-        raw_frame = io.imread(frame_file)
-        list_of_frames.append(convert_to_signal(raw_frame, two_colors=two_colors))
-    return np.median(np.array(list_of_frames), axis=0)
+def frame_filename(target_folder, frame_id):
+    return target_folder + '/frames/frame{0:03d}.jpg'.format(frame_id)
+
+
+def signal_range(two_colors=False):
+    '''Smallest and largest possible values of convert_to_signal() for 8-bit frames'''
+    if not two_colors:
+        return -255, 2 * 255
+    else:
+        return 0, 2.5 * 255
+
+
+def _level_of_rank(counts, ranks):
+    '''For histograms counts of shape (L, P), the lowest level at which the cumulative count of every column reaches
+    its rank (1-based). The cumulative counts are accumulated level by level to keep memory at O(P).'''
+    cumulative_counts = np.zeros(shape=counts.shape[1], dtype=np.int64)
+    levels = np.full(shape=counts.shape[1], fill_value=-1, dtype=np.int32)
+    for level in range(counts.shape[0]):
+        cumulative_counts += counts[level]
+        levels[(levels < 0) & (cumulative_counts >= ranks)] = level
+    return levels
+
+
+def get_median_frame(min_frame, target_folder, nframes, step=10, two_colors=False, exact=True,
+                     max_stacked_frames=16):
+    '''
+    Median of the signals (see convert_to_signal()) of frames min_frame...nframes-1 taken with the given step.
+
+    If exact, all the frames are kept in memory as float64 and the exact median is computed. Otherwise,
+    the signal is quantized to 256 levels over signal_range(), which is accurate to about one level (3 for
+    one-color signal and 2.5 for two-color signal), well below the usual detection threshold. The result is
+    equal to np.median of the quantized signals: for an even number of frames, it is the mean of the two middle
+    levels. Up to max_stacked_frames frames are stacked as uint8 levels (one byte per pixel per frame).
+    More frames are streamed twice through per-pixel histograms, first of 16 coarse levels and then of the 16
+    fine levels within the coarse level of the median, so memory stays at about 16 to 32 bytes per pixel
+    whatever the number of frames.
+
+    The background is needed before the detection of the first frame, so it is computed in its own read of
+    every step-th frame rather than in the tracking pass.
+    '''
+    frame_ids = [frame_id for frame_id in range(0, nframes, step) if frame_id >= min_frame]
+    if not frame_ids:
+        raise ValueError(f'No frames for the background: min_frame={min_frame}, nframes={nframes}, step={step}')
+
+    def signals():
+        for frame_id in frame_ids:
+            print(f'Loading frame {frame_id} for background.')
+            yield convert_to_signal(io.imread(frame_filename(target_folder, frame_id)), two_colors=two_colors)
+
+    if exact:
+        return np.median(np.array(list(signals())), axis=0)
+
+    signal_min, signal_max = signal_range(two_colors)
+    level_width = (signal_max - signal_min) / 255
+
+    def quantized_signals():
+        for signal in signals():
+            yield np.rint((signal - signal_min) / level_width).astype(np.uint8)
+
+    if len(frame_ids) <= max_stacked_frames:
+        median_levels = np.median(np.array(list(quantized_signals())), axis=0)
+        return signal_min + median_levels * level_width
+
+    # 1-based ranks of the lower and upper middle values; they coincide for an odd number of frames
+    low_rank = (len(frame_ids) + 1) // 2
+    high_rank = len(frame_ids) // 2 + 1
+    count_dtype = np.min_scalar_type(len(frame_ids))
+
+    # first pass: histograms of the coarse levels (upper 4 bits of the level)
+    coarse_counts = None
+    for levels in quantized_signals():
+        frame_shape = levels.shape
+        coarse_levels = (levels >> 4).ravel()
+        if coarse_counts is None:
+            coarse_counts = np.zeros(shape=(16, coarse_levels.shape[0]), dtype=count_dtype)
+            pixel_indices = np.arange(coarse_levels.shape[0])
+        # every pixel gets exactly one count, so the fancy-indexed increment has no repeated indices
+        coarse_counts[coarse_levels, pixel_indices] += 1
+    low_coarse_level = _level_of_rank(coarse_counts, low_rank).astype(np.uint8)
+    high_coarse_level = _level_of_rank(coarse_counts, high_rank).astype(np.uint8)
+    counts_below_low_coarse_level = np.zeros(shape=pixel_indices.shape[0], dtype=np.int64)
+    for level in range(16):
+        counts_below_low_coarse_level += np.where(low_coarse_level > level, coarse_counts[level], 0)
+    del coarse_counts
+
+    # second pass: histograms of the fine levels within the coarse level of the lower middle value, and
+    # the smallest level within the coarse level of the upper middle value in case it is a different one
+    fine_counts = np.zeros(shape=(16, pixel_indices.shape[0]), dtype=count_dtype)
+    smallest_high_levels = np.full(shape=pixel_indices.shape[0], fill_value=255, dtype=np.uint8)
+    for levels in quantized_signals():
+        levels = levels.ravel()
+        coarse_levels = levels >> 4
+        in_low = coarse_levels == low_coarse_level
+        fine_counts[levels[in_low] & 15, pixel_indices[in_low]] += 1
+        in_high = coarse_levels == high_coarse_level
+        smallest_high_levels[in_high] = np.minimum(smallest_high_levels[in_high], levels[in_high])
+    low_levels = low_coarse_level * 16 + _level_of_rank(fine_counts, low_rank - counts_below_low_coarse_level)
+    high_levels = np.where(high_coarse_level == low_coarse_level,
+                           low_coarse_level * 16 + _level_of_rank(fine_counts,
+                                                                  high_rank - counts_below_low_coarse_level),
+                           smallest_high_levels)
+    median_levels = (low_levels + high_levels.astype(np.int32)) / 2
+    return (signal_min + median_levels * level_width).reshape(frame_shape)
+
+
+def get_largest_connected_component(segmentation):
+    labels = label(segmentation)
+    assert (labels.max() != 0)  # assume at least 1 CC
+    largestCC = labels == np.argmax(np.bincount(labels.flat)[1:]) + 1
+    return largestCC
+
+
+def detect_center_of_mass(raw_frame, background_frame, threshold=25, two_colors=False, do_debug_plots=False):
+    '''Center of mass (row, column) of the convex hull of the largest blob that differs from the background
+    by more than threshold.'''
+    channel_diff = convert_to_signal(raw_frame, two_colors=two_colors) - background_frame
+    # if two_colors:
+    #     channel_diff = np.abs(channel_diff)
+    if do_debug_plots:
+        plt.imshow(channel_diff)
+        plt.show()
+    frame = channel_diff > threshold
+    if do_debug_plots:
+        plt.imshow(frame)
+        plt.show()
+    largest = get_largest_connected_component(frame)
+    largest_connected_component = np.zeros_like(frame)
+    largest_connected_component[largest] = 1
+    # frame = remove_small_objects(frame, min_size=15500)
+    frame = largest_connected_component
+    chull = convex_hull_image(frame)
+    if do_debug_plots:
+        plt.imshow(chull)
+        plt.show()
+    return center_of_mass(chull)
+
+
+def center_of_mass_from_moments(mask):
+    '''Center of mass (row, column) of the boolean mask from its raw image moments m00, m10 and m01, which are
+    computed from the projections of the mask onto its rows and columns'''
+    row_counts = np.count_nonzero(mask, axis=1)
+    col_counts = np.count_nonzero(mask, axis=0)
+    m00 = np.sum(row_counts)
+    m10 = row_counts @ np.arange(mask.shape[0])
+    m01 = col_counts @ np.arange(mask.shape[1])
+    return m10 / m00, m01 / m00
+
+
+def detect_center_of_mass_in_roi(raw_frame, background_frame, predicted_position, roi_half_size=100, threshold=25,
+                                 two_colors=False):
+    '''
+    Same as detect_center_of_mass(), but only within the square window of roi_half_size around the predicted
+    (row, column) position, and the convex hull is only computed within the bounding box of the largest blob.
+    The cost is therefore proportional to the size of the object, not to the size of the frame.
+
+    :return: Center of mass (row, column) in frame coordinates, or None if the object is lost: there is no blob
+             in the window, or the blob touches the edge of the window (so it is probably cut by it).
+    '''
+    row_from = max(int(predicted_position[0]) - roi_half_size, 0)
+    row_to = min(int(predicted_position[0]) + roi_half_size + 1, raw_frame.shape[0])
+    col_from = max(int(predicted_position[1]) - roi_half_size, 0)
+    col_to = min(int(predicted_position[1]) + roi_half_size + 1, raw_frame.shape[1])
+    if row_from >= row_to or col_from >= col_to:
+        return None
+    channel_diff = convert_to_signal(raw_frame[row_from:row_to, col_from:col_to], two_colors=two_colors) - \
+                   background_frame[row_from:row_to, col_from:col_to]
+    labels = label(channel_diff > threshold)
+    if labels.max() == 0:
+        return None
+    largest = labels == np.argmax(np.bincount(labels.flat)[1:]) + 1
+    rows = np.flatnonzero(np.any(largest, axis=1))
+    cols = np.flatnonzero(np.any(largest, axis=0))
+    # edges of the window that are not edges of the frame
+    touches_edge = (rows[0] == 0 and row_from > 0) or \
+                   (rows[-1] == largest.shape[0] - 1 and row_to < raw_frame.shape[0]) or \
+                   (cols[0] == 0 and col_from > 0) or \
+                   (cols[-1] == largest.shape[1] - 1 and col_to < raw_frame.shape[1])
+    if touches_edge:
+        return None
+    chull = convex_hull_image(largest[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1])
+    cmass = center_of_mass_from_moments(chull)
+    return row_from + rows[0] + cmass[0], col_from + cols[0] + cmass[1]
+
+
+class ConstantVelocityPredictor:
+    '''Predicts the next position by extrapolating the last two positions'''
+
+    def __init__(self):
+        self.positions = []
+
+    def predict(self):
+        if not self.positions:
+            return None
+        if len(self.positions) == 1:
+            return self.positions[-1]
+        return 2 * self.positions[-1] - self.positions[-2]
+
+    def update(self, position):
+        self.positions = self.positions[-1:] + [np.array(position, dtype=float)]
+
+    def reset(self):
+        self.positions = []
+
+
+class KalmanPredictor:
+    '''
+    Kalman filter with constant-velocity model: state is (row, column, row velocity, column velocity),
+    one frame per step. Noise variances are in pixels squared.
+    '''
+
+    def __init__(self, process_noise=1.0, measurement_noise=1.0):
+        self.transition = np.eye(4)
+        self.transition[0, 2] = 1
+        self.transition[1, 3] = 1
+        self.observation = np.eye(2, 4)
+        self.process_covariance = process_noise * np.eye(4)
+        self.measurement_covariance = measurement_noise * np.eye(2)
+        self.reset()
+
+    def predict(self):
+        if self.state is None:
+            return None
+        return (self.transition @ self.state)[:2]
+
+    def update(self, position):
+        position = np.array(position, dtype=float)
+        if self.state is None:
+            self.state = np.array([position[0], position[1], 0, 0])
+            self.covariance = np.diag([self.measurement_covariance[0, 0], self.measurement_covariance[1, 1],
+                                       1e4, 1e4])
+            return
+        predicted_state = self.transition @ self.state
+        predicted_covariance = self.transition @ self.covariance @ self.transition.T + self.process_covariance
+        innovation_covariance = self.observation @ predicted_covariance @ self.observation.T + \
+                                self.measurement_covariance
+        gain = predicted_covariance @ self.observation.T @ np.linalg.inv(innovation_covariance)
+        self.state = predicted_state + gain @ (position - self.observation @ predicted_state)
+        self.covariance = (np.eye(4) - gain @ self.observation) @ predicted_covariance
+
+    def reset(self):
+        self.state = None
+        self.covariance = None
+
+
+def make_predictor(roi_mode):
+    if roi_mode == 'constant_velocity':
+        return ConstantVelocityPredictor()
+    elif roi_mode == 'kalman':
+        return KalmanPredictor()
+    else:
+        raise ValueError(f'Unknown ROI mode: {roi_mode}')
+
+
+# background frame of the worker processes, set once per process by _init_detection_worker()
+_worker_background_frame = None
+
+
+def _init_detection_worker(background_frame):
+    global _worker_background_frame
+    _worker_background_frame = background_frame
+
+
+def _detect_centers_of_mass_in_batch(task):
+    target_folder, frame_ids, threshold, two_colors, roi_mode, roi_half_size = task
+    if roi_mode is None:
+        return [detect_center_of_mass(io.imread(frame_filename(target_folder, frame_id)), _worker_background_frame,
+                                      threshold=threshold, two_colors=two_colors)
+                for frame_id in frame_ids]
+    # within the batch, frames are tracked one after another; the first frame of the batch is searched in full
+    predictor = make_predictor(roi_mode)
+    cmasses = []
+    for frame_id in frame_ids:
+        raw_frame = io.imread(frame_filename(target_folder, frame_id))
+        cmass = None
+        predicted_position = predictor.predict()
+        if predicted_position is not None:
+            cmass = detect_center_of_mass_in_roi(raw_frame, _worker_background_frame, predicted_position,
+                                                 roi_half_size=roi_half_size, threshold=threshold,
+                                                 two_colors=two_colors)
+            if cmass is None:
+                predictor.reset()
+        if cmass is None:
+            cmass = detect_center_of_mass(raw_frame, _worker_background_frame, threshold=threshold,
+                                          two_colors=two_colors)
+        predictor.update(cmass)
+        cmasses.append(cmass)
+    return cmasses
+
+
+def detect_centers_of_mass(target_folder, frame_ids, background_frame, threshold=25, two_colors=False,
+                           processes=None, batch_size=32, roi_mode=None, roi_half_size=100):
+    '''
+    Detection stage of the tracking: every frame is decoded once and its center of mass is found by
+    detect_center_of_mass(). Batches of batch_size frames are processed in a pool of worker processes
+    (all CPU cores if processes is None; serially in this process if processes == 1).
+
+    If roi_mode is 'constant_velocity' or 'kalman', the position of the object in each frame is predicted from
+    the previous frames of the batch by ConstantVelocityPredictor or KalmanPredictor, and only the window
+    of roi_half_size around it is searched (see detect_center_of_mass_in_roi()). When the object is lost
+    in the window, the full frame is searched and the predictor starts over.
+
+    :return: Arrays of x and y coordinates of the centers of mass, in the order of frame_ids
+    '''
+    frame_ids = list(frame_ids)
+    tasks = [(target_folder, frame_ids[batch_start:batch_start + batch_size], threshold, two_colors, roi_mode,
+              roi_half_size)
+             for batch_start in range(0, len(frame_ids), batch_size)]
+    if processes == 1:
+        _init_detection_worker(background_frame)
+        batches = [_detect_centers_of_mass_in_batch(task) for task in tqdm(tasks)]
+    else:
+        with multiprocessing.Pool(processes=processes, initializer=_init_detection_worker,
+                                  initargs=(background_frame,)) as pool:
+            # imap keeps the order of batches
+            batches = list(tqdm(pool.imap(_detect_centers_of_mass_in_batch, tasks), total=len(tasks)))
+    cmasses = np.array([cmass for batch in batches for cmass in batch]).reshape(-1, 2)
+    return cmasses[:, 1], cmasses[:, 0]
+
+
+def thick_segment_mask(shape, point_a, point_b, width):
+    '''
+    Pixels within width/2 from the segment between points (x, y) point_a and point_b, as a tuple of the
+    bounding box slices and a boolean mask within this box. The ends of the segment are round, so that
+    consecutive segments join smoothly. A segment with equal ends is a disk.
+    '''
+    radius = width / 2
+    point_a = np.array(point_a, dtype=float)
+    point_b = np.array(point_b, dtype=float)
+    row_from = max(int(np.floor(min(point_a[1], point_b[1]) - radius)), 0)
+    row_to = min(int(np.ceil(max(point_a[1], point_b[1]) + radius)) + 1, shape[0])
+    col_from = max(int(np.floor(min(point_a[0], point_b[0]) - radius)), 0)
+    col_to = min(int(np.ceil(max(point_a[0], point_b[0]) + radius)) + 1, shape[1])
+    box = (slice(row_from, max(row_to, row_from)), slice(col_from, max(col_to, col_from)))
+    ys, xs = np.mgrid[box]
+    segment = point_b - point_a
+    segment_length_squared = np.dot(segment, segment)
+    if segment_length_squared > 0:
+        ts = np.clip(((xs - point_a[0]) * segment[0] + (ys - point_a[1]) * segment[1]) / segment_length_squared,
+                     0, 1)
+    else:
+        ts = np.zeros_like(xs, dtype=float)
+    distances_squared = (xs - point_a[0] - ts * segment[0]) ** 2 + (ys - point_a[1] - ts * segment[1]) ** 2
+    return box, distances_squared <= radius ** 2
+
+
+class TrajectoryOverlay:
+    '''
+    Draws the trajectory and the current center of mass directly over the frames. The trajectory is kept as
+    a mask to which every new segment is added once (add_point()), so earlier segments are never redrawn,
+    and render() only blends the pixels of the mask and of the marker. Default sizes match the
+    matplotlib figures previously used for the annotated frames (linewidth 2 and marker size 100 in
+    an 8-inch wide figure).
+    '''
+
+    def __init__(self, frame_shape, line_color=(255, 255, 255), line_alpha=0.4, line_width=None,
+                 marker_color=(50, 205, 50), marker_alpha=0.5, marker_diameter=None):
+        self.frame_shape = frame_shape[:2]
+        pixels_per_point = frame_shape[1] / (8 * 72)
+        self.line_width = 2 * pixels_per_point if line_width is None else line_width
+        self.marker_diameter = 10 * pixels_per_point if marker_diameter is None else marker_diameter
+        self.line_color = np.array(line_color, dtype=float)
+        self.line_alpha = line_alpha
+        self.marker_color = np.array(marker_color, dtype=float)
+        self.marker_alpha = marker_alpha
+        self.trajectory_mask = np.zeros(shape=self.frame_shape, dtype=bool)
+        self.trajectory_rows = np.zeros(shape=0, dtype=np.intp)
+        self.trajectory_cols = np.zeros(shape=0, dtype=np.intp)
+        self.last_point = None
+
+    def add_point(self, x, y):
+        if self.last_point is not None:
+            box, mask = thick_segment_mask(self.frame_shape, self.last_point, (x, y), self.line_width)
+            new_pixels = mask & np.logical_not(self.trajectory_mask[box])
+            self.trajectory_mask[box] |= mask
+            rows, cols = np.nonzero(new_pixels)
+            self.trajectory_rows = np.concatenate((self.trajectory_rows, rows + box[0].start))
+            self.trajectory_cols = np.concatenate((self.trajectory_cols, cols + box[1].start))
+        self.last_point = (x, y)
+
+    def render(self, raw_frame):
+        '''Copy of the RGB frame with the trajectory so far and the marker at the last point'''
+        annotated_frame = np.array(raw_frame[:, :, :3])
+        pixels = (self.trajectory_rows, self.trajectory_cols)
+        annotated_frame[pixels] = annotated_frame[pixels] * (1 - self.line_alpha) + self.line_color * self.line_alpha
+        if self.last_point is not None:
+            box, mask = thick_segment_mask(self.frame_shape, self.last_point, self.last_point, self.marker_diameter)
+            marker_pixels = annotated_frame[box][mask]
+            annotated_frame[box][mask] = marker_pixels * (1 - self.marker_alpha) + \
+                                         self.marker_color * self.marker_alpha
+        return annotated_frame
+
+
+class BackgroundFrameWriter:
+    '''
+    Saves images in a background thread, so that encoding of the files overlaps with the rendering
+    of the next frames. Use as context manager; an error in the writer thread is raised on exit.
+    '''
+
+    def __init__(self, max_queued_frames=16):
+        self.queue = queue.Queue(maxsize=max_queued_frames)
+        self.error = None
+        self.thread = threading.Thread(target=self._write_frames, daemon=True)
+
+    def _write_frames(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error is None:
+                try:
+                    io.imsave(*item)
+                except Exception as error:
+                    self.error = error
+
+    def write(self, filename, image):
+        if self.error is not None:
+            raise self.error
+        self.queue.put((filename, image))
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None and exc_type is None:
+            raise self.error
+
+
+def save_annotated_frames(target_folder, frame_ids, cmass_xs, cmass_ys, two_colors=False):
+    '''Saves every frame with the trajectory up to it and the current center of mass drawn over it into the
+    processed_frames subfolder (see TrajectoryOverlay).'''
+    makedir_if_needed(target_folder + '/processed_frames')
+    overlay = None
+    with BackgroundFrameWriter() as writer:
+        for k, frame_id in enumerate(tqdm(frame_ids)):
+            raw_frame = io.imread(frame_filename(target_folder, frame_id))
+            if overlay is None:
+                if not two_colors:
+                    overlay = TrajectoryOverlay(raw_frame.shape)
+                else:
+                    overlay = TrajectoryOverlay(raw_frame.shape, marker_color=(255, 255, 255))
+            overlay.add_point(cmass_xs[k], cmass_ys[k])
+            writer.write(target_folder + '/processed_frames/frames{0:03d}.png'.format(frame_id),
+                         overlay.render(raw_frame))
 
 
 def trace_trajectory_from_video_frames(target_folder, threshold=25, min_frame=0, nframes=False, do_debug_plots=False,
-                                       two_colors=False, bkg_nframes=False, bkg_minframe=False, bkg_step=10):
+                                       two_colors=False, bkg_nframes=False, bkg_minframe=False, bkg_step=10,
+                                       processes=None, batch_size=32, do_annotated_frames=True, roi_mode=None,
+                                       roi_half_size=100, exact_background=True):
+    '''
+    Tracks the center of mass of the rolling object on frames min_frame...nframes-1 of target_folder/frames
+    and saves its coordinates into trajectory_x.txt and trajectory_y.txt. Detection runs in parallel
+    (see detect_centers_of_mass(), also for the region-of-interest mode set by roi_mode and roi_half_size);
+    saving of annotated frames is an optional stage after it.
+    Debug plots are only possible with serial detection, so do_debug_plots makes it serial.
+    If not exact_background, the background is the quantized median of fixed memory (see get_median_frame()),
+    which can differ from the exact median by one quantization level.
+    '''
     if not nframes:
         nframes = number_of_files(target_folder + '/frames/')
-    makedir_if_needed(target_folder + '/processed_frames')
 
     if not bkg_nframes:
         bkg_nframes = nframes
@@ -60,82 +508,32 @@ def trace_trajectory_from_video_frames(target_folder, threshold=25, min_frame=0,
 
     # get background
     background_frame = get_median_frame(bkg_minframe, target_folder, nframes=bkg_nframes, two_colors=two_colors,
-                                        step=bkg_step)
+                                        step=bkg_step, exact=exact_background)
     if do_debug_plots:
         plt.imshow(background_frame)
         plt.show()
 
-    cmass_xs = []
-    cmass_ys = []
-    for frame_id in tqdm(range(nframes)):
-        if frame_id < min_frame:
-            continue
-        frame_file = target_folder + '/frames/frame{0:03d}.jpg'.format(frame_id)
-        raw_frame = io.imread(frame_file)
-        fig, ax = plt.subplots(figsize=(8, 8 * raw_frame.shape[0] / raw_frame.shape[1]))
-        if frame_id >= min_frame:
-            channel_diff = convert_to_signal(raw_frame, two_colors=two_colors) - background_frame
-            # if two_colors:
-            #     channel_diff = np.abs(channel_diff)
-            if do_debug_plots:
-                plt.imshow(channel_diff)
-                plt.show()
-            frame = channel_diff > threshold
-            if do_debug_plots:
-                plt.imshow(frame)
-                plt.show()
-
-            def getLargestCC(segmentation):
-                labels = label(segmentation)
-                assert (labels.max() != 0)  # assume at least 1 CC
-                largestCC = labels == np.argmax(np.bincount(labels.flat)[1:]) + 1
-                return largestCC
-
-            largest = getLargestCC(frame)
-            largest_connected_component = np.zeros_like(frame)
-            largest_connected_component[largest] = 1
-            # plt.imshow(largest_connected_component)
-            # frame = remove_small_objects(frame, min_size=15500)
-            # plt.imshow(frame)
-            frame = largest_connected_component
-
-            chull = convex_hull_image(frame)
-            if do_debug_plots:
-                plt.imshow(chull)
-                plt.show()
-            plt.imshow(raw_frame)
-            cmass = center_of_mass(chull)
-            cmass_xs.append(cmass[1])
-            cmass_ys.append(cmass[0])
-            ### fancy_coloring_of_trajectory
-            if len(cmass_xs) > 1:
-                for i in range(len(cmass_xs) - 1):
-                    plt.plot([cmass_xs[i], cmass_xs[i + 1]], [cmass_ys[i], cmass_ys[i + 1]], color='white', linewidth=2,
-                             alpha=0.4)
-            # plt.plot(cmass_xs, cmass_ys, color='greenyellow', linewidth=2, alpha=0.6)
-            if not two_colors:
-                plt.scatter(cmass[1], cmass[0], s=100, c='limegreen', alpha=0.5)
-            else:
-                plt.scatter(cmass[1], cmass[0], s=100, c='white', alpha=0.5)
-
-        else:
-            plt.imshow(raw_frame)
-        ax.set_axis_off()
-        plt.subplots_adjust(top=1, bottom=0, right=1, left=0, hspace=0, wspace=0)
-        plt.margins(0, 0)
-        ax.xaxis.set_major_locator(plt.NullLocator())
-        ax.yaxis.set_major_locator(plt.NullLocator())
-        # plt.show()
-        fig.savefig(target_folder + '/processed_frames/frames{0:03d}.png'.format(frame_id), dpi=200)
-        plt.close(fig)
-
+    frame_ids = range(min_frame, nframes)
+    if do_debug_plots:
+        cmasses = np.array([detect_center_of_mass(io.imread(frame_filename(target_folder, frame_id)),
+                                                  background_frame, threshold=threshold, two_colors=two_colors,
+                                                  do_debug_plots=True)
+                            for frame_id in frame_ids]).reshape(-1, 2)
+        cmass_xs, cmass_ys = cmasses[:, 1], cmasses[:, 0]
+    else:
+        cmass_xs, cmass_ys = detect_centers_of_mass(target_folder, frame_ids, background_frame, threshold=threshold,
+                                                    two_colors=two_colors, processes=processes,
+                                                    batch_size=batch_size, roi_mode=roi_mode,
+                                                    roi_half_size=roi_half_size)
     np.savetxt(target_folder + '/trajectory_x.txt', cmass_xs)
     np.savetxt(target_folder + '/trajectory_y.txt', cmass_ys)
 
+    if do_annotated_frames:
+        save_annotated_frames(target_folder, frame_ids, cmass_xs, cmass_ys, two_colors=two_colors)
+
 
 def plot_experimental_trajectory(target_folder):
-    xs = np.loadtxt(target_folder + '/trajectory_x.txt')
-    ys = np.loadtxt(target_folder + '/trajectory_y.txt')
+    xs, ys = load_path((target_folder + '/trajectory_x.txt', target_folder + '/trajectory_y.txt')).T
     f1 = plt.figure(1, figsize=(10, 3))
     plt.plot(xs, -1 * ys, alpha=1)
     plt.axis('equal')
@@ -143,68 +541,129 @@ def plot_experimental_trajectory(target_folder):
     plt.show()
 
 
+def umeyama_similarity(source, target):
+    '''
+    Closed-form least-squares similarity transform (Umeyama, 1991) mapping point sets source to target, batched:
+    target ~ scale * source @ rotation.T + shift.
+
+    :param source: Array of shape (B, N, 2) or (N, 2)
+    :param target: Array of the same shape, points corresponding to the source points
+    :return: Tuple of scales (B,), rotations (B, 2, 2), shifts (B, 2) and RMS residuals (B,)
+    '''
+    source = np.asarray(source, dtype=float).reshape(-1, *np.shape(source)[-2:])
+    target = np.asarray(target, dtype=float).reshape(source.shape)
+    source_mean = np.mean(source, axis=1, keepdims=True)
+    target_mean = np.mean(target, axis=1, keepdims=True)
+    source_centered = source - source_mean
+    target_centered = target - target_mean
+    source_variance = np.mean(np.sum(source_centered ** 2, axis=2), axis=1)
+    covariance = np.einsum('bni,bnj->bij', target_centered, source_centered) / source.shape[1]
+    # in 2D the optimal rotation follows from the antisymmetric and symmetric parts of the covariance
+    angles = np.arctan2(covariance[:, 1, 0] - covariance[:, 0, 1], covariance[:, 0, 0] + covariance[:, 1, 1])
+    cosines = np.cos(angles)
+    sines = np.sin(angles)
+    rotations = np.stack((np.stack((cosines, -sines), axis=1), np.stack((sines, cosines), axis=1)), axis=1)
+    traces = (covariance[:, 0, 0] + covariance[:, 1, 1]) * cosines + \
+             (covariance[:, 1, 0] - covariance[:, 0, 1]) * sines
+    scales = traces / np.where(source_variance > 0, source_variance, 1)
+    shifts = target_mean[:, 0, :] - scales[:, None] * np.einsum('bij,bj->bi', rotations, source_mean[:, 0, :])
+    residuals = target - (scales[:, None, None] * np.einsum('bij,bnj->bni', rotations, source) + shifts[:, None, :])
+    return scales, rotations, shifts, np.sqrt(np.mean(np.sum(residuals ** 2, axis=2), axis=1))
+
+
+def fit_similarity_to_path(experimental_path, design_path, npoints=128, number_of_offsets=64, number_of_lengths=24,
+                           min_length_fraction=0.05, initial_transform=None, design_oversampling=8):
+    '''
+    Finds the similarity transform (scale, rotation angle, shift) that brings the experimental path onto
+    the design path: design ~ scale * R(angle) @ experimental + shift. The experimental path may cover
+    any part of the design path (for example, a cropped recording over several periods).
+
+    First, the experimental path and a grid of sub-arcs of the design path (number_of_offsets starts times
+    number_of_lengths lengths from min_length_fraction of the whole length) are resampled to npoints
+    by arc length, and the closed-form similarity of every pair is found at once by umeyama_similarity().
+    The best one (or initial_transform, if given as tuple of scale, angle, shift) is then refined by least
+    squares of the distances from the experimental points to the densely resampled design path.
+
+    :return: Tuple of scale, angle, shift (array of two) and RMS distance from the transformed experimental
+             points to the design path, in units of the design path
+    '''
+    experimental_path = np.asarray(experimental_path, dtype=float)
+    design_path = np.asarray(design_path, dtype=float)
+    dense_design_path = resample_by_arc_length(design_path, design_oversampling * design_path.shape[0])
+    tree = polyline_segment_tree(dense_design_path)
+
+    if initial_transform is None:
+        design_lengths = np.insert(np.cumsum(np.linalg.norm(np.diff(design_path, axis=0), axis=1)), 0, 0)
+        total_length = design_lengths[-1]
+        starts = []
+        sub_arc_lengths = []
+        for length in total_length * np.geomspace(min_length_fraction, 1, number_of_lengths):
+            for start in np.linspace(0, total_length - length, number_of_offsets):
+                starts.append(start)
+                sub_arc_lengths.append(length)
+        lengths_along_sub_arcs = np.array(starts)[:, None] + \
+                                 np.array(sub_arc_lengths)[:, None] * np.linspace(0, 1, npoints)[None, :]
+        sub_arcs = np.stack((np.interp(lengths_along_sub_arcs, design_lengths, design_path[:, 0]),
+                             np.interp(lengths_along_sub_arcs, design_lengths, design_path[:, 1])), axis=2)
+        resampled_experimental_path = resample_by_arc_length(experimental_path, npoints)
+        scales, rotations, shifts, rms = umeyama_similarity(
+            np.broadcast_to(resampled_experimental_path, sub_arcs.shape), sub_arcs)
+        # residuals are compared in units of the experimental path, otherwise the shortest sub-arcs would win
+        best = np.argmin(np.where(scales > 0, rms / np.where(scales > 0, scales, 1), np.inf))
+        initial_transform = (scales[best], np.arctan2(rotations[best, 1, 0], rotations[best, 0, 0]), shifts[best])
+
+    def residuals(parameters):
+        scale, angle, shift_x, shift_y = parameters
+        transformed = scale * rotate_points(experimental_path, angle) + np.array([shift_x, shift_y])
+        return offsets_to_polyline(transformed, dense_design_path, tree=tree).ravel()
+
+    scale, angle, shift = initial_transform
+    result = least_squares(residuals, x0=(scale, angle, shift[0], shift[1]), x_scale='jac')
+    scale, angle, shift_x, shift_y = result.x
+    rms = np.sqrt(2 * np.mean(result.fun ** 2))
+    return scale, angle, np.array([shift_x, shift_y]), rms
+
+
+def rotate_points(points, angle):
+    '''Rotates points of shape (N, 2) counterclockwise by angle around the origin (vectorized rotate_2d())'''
+    cosine = np.cos(angle)
+    sine = np.sin(angle)
+    return points @ np.array([[cosine, sine], [-sine, cosine]])
+
+
 def match_scale_and_angle(target_folder='examples/random_doubled_3', video_folder='examples/random_doubled_3/video2',
-                          cropfrom=100, cropto=-50, x0=6.5,  # - 1.1
-                          y0=0.1,  # + 1
-                          initial_scale=1.1e-2,
-                          initial_angle=0,
-                          do_plot=True
-                          ):
-    input_path = np.load(target_folder + '/folder_for_path/path_data.npy')
-    # make interpolator for the true path
+                          cropfrom=100, cropto=-50, x0=None, y0=None, initial_scale=None, initial_angle=0,
+                          do_plot=True, number_of_periods=4):
+    '''
+    Matches the experimental trajectory from video_folder to number_of_periods periods of the designed path
+    from target_folder by fit_similarity_to_path(). The initial guess is found automatically, unless
+    x0, y0 and initial_scale are all given; then the experimental point (x, y) is initially mapped to
+    (x0 + x * initial_scale, y0 + y * initial_scale) rotated clockwise by initial_angle, as before.
+
+    :return: Design path repeated number_of_periods times and the experimental trajectory in its coordinates
+    '''
+    input_path = load_path(target_folder + '/folder_for_path/path_data.npy')
     dataxlen = np.max(input_path[:, 0])
-    true_path = np.vstack((input_path[:-1, :] + np.array([dataxlen * i, 0]) for i in range(4)))
-    if do_plot:
-        plt.plot(true_path[:, 0], true_path[:, 1], '-', alpha=0.4)
-    # plt.show()
-    true_path_interp = interpolate.interp1d(true_path[:, 0], true_path[:, 1])
+    true_path = np.vstack([input_path[:-1, :] + np.array([dataxlen * i, 0]) for i in range(number_of_periods)])
 
     # experimental trajectory
-    xs = np.loadtxt(video_folder + '/trajectory_x.txt')[cropfrom:cropto]
-    ys = -1 * np.loadtxt(video_folder + '/trajectory_y.txt')[cropfrom:cropto]
+    xs, ys = load_path((video_folder + '/trajectory_x.txt', video_folder + '/trajectory_y.txt'))[cropfrom:cropto].T
+    ys = -1 * ys
     ys = ys - ys[0]
     xs = xs - xs[0]
+    experimental_path = np.stack((xs, ys)).T
 
-    if do_plot:
-        plt.scatter(x0 + xs * initial_scale, y0 + ys * initial_scale, alpha=0.5, color='C1')
-        plt.axis('equal')
-        plt.show()
-
-    # match scale, rotation and shift
-    def func(x, scale, angle, x0, y0):
-        data_rotated = np.copy(true_path)
-        for i in range(data_rotated.shape[0]):
-            data_rotated[i, :] = rotate_2d(data_rotated[i, :], angle)
-        true_path_interp = interpolate.interp1d(data_rotated[:, 0], data_rotated[:, 1], fill_value='extrapolate')
-        y_here = (true_path_interp(x * scale + x0) - y0) / scale
-        return y_here
-
-    if do_plot:
-        plt.scatter(xs, ys, alpha=0.5, color='C1')
-        plt.plot(xs, func(xs, initial_scale, 0, x0, y0), color='C0')
-        plt.axis('equal')
-        plt.show()
-
-    popt, pcov = curve_fit(func, xs, ys, p0=(initial_scale, initial_angle, x0, y0),
-                           bounds=[[0, -np.pi / 4, -np.inf, -np.inf], [np.inf, np.pi / 4, np.inf, np.inf]])
-    print(popt)
-    if do_plot:
-        plt.plot(xs, ys, alpha=0.5, color='C0')
-        plt.plot(xs, func(xs, *popt), 'g--',
-                 label=f'{popt}', alpha=0.5)
-        plt.legend()
-        plt.axis('equal')
-        plt.show()
+    if x0 is not None and y0 is not None and initial_scale is not None:
+        initial_transform = (initial_scale, -initial_angle, rotate_points(np.array([[x0, y0]]), -initial_angle)[0])
+    else:
+        initial_transform = None
+    scale, angle, shift, rms = fit_similarity_to_path(experimental_path, true_path,
+                                                      initial_transform=initial_transform)
+    print(f'Scale is: {scale}, angle is: {angle}, shift is: {shift}, RMS distance to the path: {rms}')
+    traj_vectors = scale * rotate_points(experimental_path, angle) + shift
 
-    scale, angle, x0, y0 = popt
-    print(f'Scale is: {scale}')
     if do_plot:
         plt.plot(true_path[:, 0], true_path[:, 1], '-', color='black', alpha=0.5)
-    traj_vectors = np.vstack((x0 + xs * scale, y0 + ys * scale)).T
-    for i in range(traj_vectors.shape[0]):
-        traj_vectors[i, :] = rotate_2d(traj_vectors[i, :], -angle)
-    # plt.plot(, y0 + ys * scale, alpha=0.5, color='C1')
-    if do_plot:
         plt.plot(traj_vectors[:, 0], traj_vectors[:, 1], color='C0', alpha=0.5)
         plt.axis('equal')
         plt.show()
@@ -0,0 +1,137 @@
+import numpy as np
+from numba import jit
+from scipy.spatial import cKDTree
+from compute_trajectoid import resample_by_arc_length, offsets_to_polyline, polyline_segment_tree
+
+
+class DesignPathIndex:
+    '''
+    Designed path resampled densely by arc length (oversampling times more points than the path has) with
+    a KD-tree over the resampled points, built once and reused for comparing any number of experimental
+    trajectories to this path (see compare_trajectories()).
+    '''
+
+    def __init__(self, design_path, oversampling=8):
+        design_path = np.asarray(design_path, dtype=float)
+        self.oversampling = oversampling
+        self.dense_path = resample_by_arc_length(design_path, oversampling * design_path.shape[0])
+        # distance between consecutive points of the dense path, all equal
+        self.spacing = np.sum(np.linalg.norm(np.diff(self.dense_path, axis=0), axis=1)) / (self.dense_path.shape[0] - 1)
+        self.tree = cKDTree(self.dense_path)
+        self.segment_tree = polyline_segment_tree(self.dense_path)
+
+    def offsets(self, points):
+        return offsets_to_polyline(np.asarray(points, dtype=float), self.dense_path, tree=self.segment_tree)
+
+    def deviations(self, points):
+        '''Distances from the points to the closest points of the designed path'''
+        return np.linalg.norm(self.offsets(points), axis=1)
+
+    def densified(self, points):
+        '''Trajectory resampled by arc length at the spacing of the dense designed path, or at the original points
+        if they are denser.'''
+        points = np.asarray(points, dtype=float)
+        length = np.sum(np.linalg.norm(np.diff(points, axis=0), axis=1))
+        npoints = int(np.ceil(length / self.spacing)) + 1
+        if npoints <= points.shape[0]:
+            return points
+        return resample_by_arc_length(points, npoints)
+
+    def covered_part(self, points, step=1):
+        '''Part of the dense designed path between the points closest to the first and the last of the points,
+        so that a cropped experimental trajectory is compared to the part of the design it covers.
+        Every step-th point is taken.'''
+        _, (first, last) = self.tree.query(np.asarray(points, dtype=float)[[0, -1]])
+        if first <= last:
+            return self.dense_path[first:last + 1:step]
+        else:
+            return self.dense_path[last:first + 1][::-step]
+
+
+@jit(nopython=True, cache=True)
+def _discrete_frechet_distance(path_1, path_2):
+    # dynamic programming over the coupling table, keeping only two rows of it
+    previous_row = np.empty(path_2.shape[0])
+    current_row = np.empty(path_2.shape[0])
+    for i in range(path_1.shape[0]):
+        for j in range(path_2.shape[0]):
+            distance = np.sqrt((path_1[i, 0] - path_2[j, 0]) ** 2 + (path_1[i, 1] - path_2[j, 1]) ** 2)
+            if i == 0 and j == 0:
+                current_row[j] = distance
+            elif i == 0:
+                current_row[j] = max(current_row[j - 1], distance)
+            elif j == 0:
+                current_row[j] = max(previous_row[0], distance)
+            else:
+                current_row[j] = max(min(previous_row[j], previous_row[j - 1], current_row[j - 1]), distance)
+        previous_row, current_row = current_row, previous_row
+    return previous_row[path_2.shape[0] - 1]
+
+
+def discrete_frechet_distance(path_1, path_2):
+    '''Discrete Frechet distance between two paths of shape (N, 2) and (M, 2), in O(N*M) time and O(M) memory'''
+    return _discrete_frechet_distance(np.ascontiguousarray(path_1, dtype=float),
+                                      np.ascontiguousarray(path_2, dtype=float))
+
+
+def _reverse_deviations(points, design_index):
+    # distances from the covered part of the design, at the density of the original design path, to the trajectory
+    return np.linalg.norm(offsets_to_polyline(design_index.covered_part(points, step=design_index.oversampling),
+                                              points), axis=1)
+
+
+def hausdorff_distance(points, design_index, symmetric=True, deviations=None):
+    '''
+    Hausdorff distance between the experimental trajectory and the part of the designed path it covers
+    (see DesignPathIndex.covered_part()). If not symmetric, only the largest distance from the trajectory
+    to the designed path is taken (directed Hausdorff distance). Deviations of the points from the designed path
+    are computed, unless given.
+    '''
+    points = np.asarray(points, dtype=float)
+    if deviations is None:
+        deviations = design_index.deviations(points)
+    directed_distance = np.max(deviations)
+    if not symmetric:
+        return directed_distance
+    return max(directed_distance, np.max(_reverse_deviations(points, design_index)))
+
+
+def compare_trajectories(trajectories, design_path, with_frechet=True, oversampling=8):
+    '''
+    Compares experimental trajectories with the designed path without assuming that either of them is
+    a function of x (unlike interpolation over x used before in match_scale_and_angle()).
+
+    :param trajectories: Array of shape (N, 2) or list of such arrays, already in coordinates of the designed path
+                         (e.g. as returned by match_scale_and_angle()).
+    :param design_path: Array of shape (M, 2) or DesignPathIndex. The index is built once for all trajectories, and
+                        the closest points of all trajectories are found by a single KD-tree query.
+    :param with_frechet: Whether to compute the discrete Frechet distance to the covered part of the design,
+                         which is the most expensive of the metrics. The trajectory is densified for it by arc
+                         length (see DesignPathIndex.densified()), so that it does not depend on how sparsely
+                         the trajectory is sampled.
+    :return: Dictionary (or list of dictionaries, for a list of trajectories) with per-point "deviations" and
+             "mean_closest_point_distance", "max_deviation", "hausdorff_distance" and "frechet_distance".
+    '''
+    if isinstance(trajectories, np.ndarray) and trajectories.ndim == 2:
+        return compare_trajectories([trajectories], design_path, with_frechet=with_frechet,
+                                    oversampling=oversampling)[0]
+    if isinstance(design_path, DesignPathIndex):
+        design_index = design_path
+    else:
+        design_index = DesignPathIndex(design_path, oversampling=oversampling)
+    trajectories = [np.asarray(trajectory, dtype=float) for trajectory in trajectories]
+    all_deviations = design_index.deviations(np.concatenate(trajectories))
+    split_indices = np.cumsum([trajectory.shape[0] for trajectory in trajectories])[:-1]
+    results = []
+    for trajectory, deviations in zip(trajectories, np.split(all_deviations, split_indices)):
+        result = {'deviations': deviations,
+                  'mean_closest_point_distance': np.mean(deviations),
+                  'max_deviation': np.max(deviations),
+                  'hausdorff_distance': hausdorff_distance(trajectory, design_index, deviations=deviations)}
+        if with_frechet:
+            # discrete Frechet distance is at least half of the largest gap between the points of either path,
+            # so the trajectory is densified to the spacing of the dense designed path
+            result['frechet_distance'] = discrete_frechet_distance(design_index.densified(trajectory),
+                                                                   design_index.covered_part(trajectory))
+        results.append(result)
+    return results